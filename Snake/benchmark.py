@@ -0,0 +1,390 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import json
+import time
+import random
+import platform
+import shutil
+import tempfile
+import subprocess
+import numpy as np
+
+import server
+
+
+def parse_command_line_args(args):
+    """ Parse command-line arguments and organize them into a single structured object. """
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Measure the hot paths of the environment, the agent and the GUI.')
+
+    parser.add_argument(
+        '--output',
+        type=str,
+        default='benchmark.json',
+        help='JSON file to write the results to.',
+    )
+    parser.add_argument(
+        '--compare',
+        type=str,
+        help='JSON file with baseline results to compare against.',
+    )
+    parser.add_argument(
+        '--tolerance',
+        type=float,
+        default=0.2,
+        help='Relative slowdown against the baseline that counts as a regression.',
+    )
+    parser.add_argument(
+        '--only',
+        type=str,
+        nargs='+',
+        choices=[name for name, _ in BENCHMARKS],
+        help='Run only the given benchmarks.',
+    )
+    parser.add_argument(
+        '--backend',
+        type=str,
+        choices=['nest', 'numpy'],
+        help='Simulation backend of the SNN (default from game/snn/parameters.py).',
+    )
+    parser.add_argument(
+        '--steps',
+        type=int,
+        default=100,
+        help='Number of agent steps to time.',
+    )
+    parser.add_argument(
+        '--resets',
+        type=int,
+        default=20,
+        help='Number of agent resets of the long-run benchmark, each followed by --steps steps.',
+    )
+    parser.add_argument(
+        '--seed',
+        type=int,
+        default=0,
+        help='The seed for random events.',
+    )
+
+    return parser.parse_args(args)
+
+
+class Results(object):
+    """ Collects named measurements, each with a unit and whether higher values are better. """
+
+    def __init__(self):
+        self.metrics = {}
+
+    def add(self, name, value, unit, higher_is_better=False):
+        self.metrics[name] = {'value': float(value), 'unit': unit, 'higher_is_better': higher_is_better}
+        print('{:45s} {:14.4f} {}'.format(name, value, unit))
+
+    def add_times(self, name, times):
+        """ Add the mean and the median of a list of durations in seconds as milliseconds. """
+        self.add(name + '.mean_ms', 1000 * np.mean(times), 'ms')
+        self.add(name + '.median_ms', 1000 * np.median(times), 'ms')
+
+
+def time_calls(function, number):
+    """ Call function number times and return the duration of every call in seconds. """
+    times = []
+    for _ in range(number):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def run_environment(env, steps):
+    """ Step the environment with random actions and return the timesteps per second. """
+    env.new_episode()
+    start = time.perf_counter()
+    for _ in range(steps):
+        env.choose_action(random.choice([0, 1, 2]))
+        if env.timestep().is_episode_end:
+            env.new_episode()
+    return steps / (time.perf_counter() - start)
+
+
+def time_startup(code, number=5):
+    """ Run code in number new interpreters and return the duration of every run in seconds. """
+    times = []
+    for _ in range(number):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(__file__)),
+                       stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def bench_startup(results, args):
+    from game.snn import parameters
+
+    # The interpreter alone, then the imports and agents of the headless modes of server.py.
+    # The agent starts with the backend of this run, so --backend numpy times it on hosts without NEST.
+    backend = 'parameters.backend = %r; ' % parameters.backend
+    results.add_times('startup.python', time_startup('pass'))
+    results.add_times('startup.server', time_startup('import server'))
+    results.add_times('startup.random_agent', time_startup("import server; server.create_agent('random')"))
+    model_dir = tempfile.mkdtemp(prefix='snake-benchmark-')
+    try:
+        results.add_times('startup.snn_agent', time_startup(
+            'import server; from game.snn import parameters; %sserver.game2D = True; '
+            'server.create_agent("snn", %r).store.close()' % (backend, os.path.join(model_dir, parameters.weights_file))))
+    finally:
+        shutil.rmtree(model_dir, ignore_errors=True)
+
+
+def bench_environment(results, args):
+    from game.environment import Environment
+
+    server.game2D = False
+    results.add('environment.steps_per_second', run_environment(Environment(), 20000), 'steps/s', True)
+    server.game2D = True
+    results.add('environment2d.steps_per_second', run_environment(server.create_snake_environment(), 20000), 'steps/s', True)
+
+
+def bench_field(results, args):
+    from game.entities import CellType, SnakeDirection
+
+    server.game2D = True
+    field = server.create_snake_environment().field
+    field.create_level()
+    number = 20000
+    points = [field.get_random_empty_cell() for _ in range(number)]
+
+    start = time.perf_counter()
+    for point in points:
+        field[point] = CellType.SNAKE_BODY
+        field[point] = CellType.EMPTY
+    results.add('field.setitem_us', 1e6 * (time.perf_counter() - start) / (2 * number), 'us')
+
+    start = time.perf_counter()
+    for point in points:
+        field[point]
+    results.add('field.getitem_us', 1e6 * (time.perf_counter() - start) / number, 'us')
+
+    start = time.perf_counter()
+    for _ in range(number):
+        field.get_random_empty_cell()
+    results.add('field.random_empty_cell_us', 1e6 * (time.perf_counter() - start) / number, 'us')
+
+    obstacles = (CellType.WALL, CellType.SNAKE_BODY, CellType.FRUIT)
+    start = time.perf_counter()
+    for point in points:
+        field.raycast(point, SnakeDirection.EAST, obstacles)
+    results.add('field.raycast_us', 1e6 * (time.perf_counter() - start) / number, 'us')
+
+
+def bench_agent(results, args):
+    from game.agent import SNNAgent2D, load_backend
+    from game.snn import parameters
+
+    server.game2D = True
+    env = server.create_snake_environment()
+    # Weights and statistics of the agent go to a scratch directory
+    model_dir = tempfile.mkdtemp(prefix='snake-benchmark-')
+    agent = SNNAgent2D(os.path.join(model_dir, parameters.weights_file), 0)
+    ai = load_backend()
+    timestep = env.new_episode()
+
+    # The phases of SNNAgent.act, timed separately
+    phases = {'set_reward': [], 'set_input': [], 'nest_simulate': [], 'get_results': []}
+    for _ in range(args.steps):
+        start = time.perf_counter()
+        agent.set_reward(timestep.reward, not agent.fused)
+        set_reward = time.perf_counter()
+        agent.snn.set_input(agent.prepare_input(timestep.observation))
+        set_input = time.perf_counter()
+        agent.snn.reset_neurons()
+        ai.nest_simulate()
+        simulate = time.perf_counter()
+        output = agent.snn.get_output()
+        agent.stats.append(agent.snn.get_weights)
+        end = time.perf_counter()
+
+        for phase, duration in zip(phases, (set_reward - start, set_input - set_reward, simulate - set_input, end - simulate)):
+            phases[phase].append(duration)
+
+        env.choose_action(agent.prepare_output(output))
+        timestep = env.timestep()
+        if timestep.is_episode_end:
+            timestep = env.new_episode()
+
+    for phase, times in phases.items():
+        results.add_times('agent.%s' % phase, times)
+
+    def act():
+        nonlocal timestep
+        env.choose_action(agent.act(timestep.observation, timestep.reward))
+        timestep = env.timestep()
+        if timestep.is_episode_end:
+            timestep = env.new_episode()
+    results.add_times('agent.act', time_calls(act, args.steps))
+
+    # The same with adaptive decision windows, which end as soon as an output neuron leads clearly
+    adaptive, parameters.adaptive_decision = parameters.adaptive_decision, True
+    agent.stats.reset()
+    results.add_times('agent.act_adaptive', time_calls(act, args.steps))
+    results.add('agent.adaptive_window_ms', agent.stats.mean_window, 'ms')
+    parameters.adaptive_decision = adaptive
+
+    # Weights file I/O
+    path = os.path.join(model_dir, 'model.h5')
+    results.add_times('snn.save_model', time_calls(lambda: agent.snn.save_model(agent.w, path), 20))
+    results.add_times('snn.try_restore_model', time_calls(lambda: agent.snn.try_restore_model(path), 20))
+    os.remove(path)
+
+    # Checkpoints of the weight store
+    from game.snn.checkpoint import WeightStore
+    store = WeightStore(path, interval=0)
+    results.add_times('store.update', time_calls(lambda: store.update(agent.w), 20))
+    results.add_times('store.load', time_calls(lambda: store.load(10), 20))
+    store.close()
+    agent.stats.flush()
+    shutil.rmtree(model_dir, ignore_errors=True)
+
+
+def bench_lifecycle(results, args):
+    from game.agent import SNNAgent2D
+    from game.snn import parameters
+
+    server.game2D = True
+    env = server.create_snake_environment()
+    model_dir = tempfile.mkdtemp(prefix='snake-benchmark-')
+    agent = SNNAgent2D(os.path.join(model_dir, parameters.weights_file), 0)
+    timestep = env.new_episode()
+
+    # Median latency of SNNAgent.act after every reset, it must not grow with the number of resets
+    latencies = []
+    for _ in range(args.resets):
+        agent.reset_agent(forget=True)
+        times = []
+        for _ in range(args.steps):
+            start = time.perf_counter()
+            action = agent.act(timestep.observation, timestep.reward)
+            times.append(time.perf_counter() - start)
+            env.choose_action(action)
+            timestep = env.timestep()
+            if timestep.is_episode_end:
+                timestep = env.new_episode()
+        latencies.append(np.median(times))
+
+    results.add('lifecycle.first_reset_ms', 1000 * latencies[0], 'ms')
+    results.add('lifecycle.last_reset_ms', 1000 * latencies[-1], 'ms')
+    results.add('lifecycle.growth', latencies[-1] / latencies[0], 'x')
+    agent.store.close()
+    agent.stats.flush()
+    shutil.rmtree(model_dir, ignore_errors=True)
+
+
+def bench_gui(results, args):
+    os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+    from game.gui import PyGameGUI
+
+    server.game2D = True
+    env = server.create_snake_environment()
+    env.new_episode()
+    gui = PyGameGUI()
+    gui.load_environment(env)
+
+    # A frame after every timestep, like PyGameGUI.run_episode
+    def render():
+        env.choose_action(random.choice([0, 1, 2]))
+        if env.timestep().is_episode_end:
+            env.new_episode()
+        start = time.perf_counter()
+        gui.render()
+        return time.perf_counter() - start
+    results.add_times('gui.render', [render() for _ in range(200)])
+    results.add_times('gui.render_frame', time_calls(gui.render_frame, 200))
+
+
+BENCHMARKS = [
+    ('startup', bench_startup),
+    ('environment', bench_environment),
+    ('field', bench_field),
+    ('agent', bench_agent),
+    ('lifecycle', bench_lifecycle),
+    ('gui', bench_gui),
+]
+
+
+def compare(metrics, baseline, tolerance):
+    """ Print the change of every metric against the baseline and return the names of the regressions. """
+    regressions = []
+    print('============================\nComparison with the baseline:')
+    for name, metric in sorted(metrics.items()):
+        if name not in baseline:
+            continue
+        old, new = baseline[name]['value'], metric['value']
+        if old == 0:
+            continue
+        # Relative slowdown, positive is worse
+        change = (old - new) / old if metric['higher_is_better'] else (new - old) / old
+        regression = change > tolerance
+        if regression:
+            regressions.append(name)
+        print('{:45s} {:12.4f} -> {:12.4f} {:+7.1%} slower{}'.format(name, old, new, change, '  REGRESSION' if regression else ''))
+    return regressions
+
+
+def main():
+    args = parse_command_line_args(sys.argv[1:])
+
+    if args.backend is not None:
+        from game.snn import parameters
+        parameters.backend = args.backend
+
+    random.seed(args.seed)
+    np.random.seed(args.seed)
+
+    results = Results()
+    skipped = {}
+    for name, benchmark in BENCHMARKS:
+        if args.only and name not in args.only:
+            continue
+        try:
+            benchmark(results, args)
+        except ImportError as err:
+            # e.g. NEST or pygame are not installed on this host
+            skipped[name] = str(err)
+            print('{:45s} skipped: {}'.format(name, err))
+        except subprocess.CalledProcessError as err:
+            # A startup failed in the child, e.g. the NEST agent on a host without NEST
+            reason = err.stderr.strip().splitlines()[-1] if err.stderr.strip() else str(err)
+            skipped[name] = reason
+            print('{:45s} skipped: {}'.format(name, reason))
+
+    from game.snn import parameters
+    report = {
+        'metadata': {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'backend': parameters.backend,
+            'steps': args.steps,
+            'resets': args.resets,
+        },
+        'skipped': skipped,
+        'results': results.metrics,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    print('Results written to %s' % args.output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results.metrics, baseline, args.tolerance)
+        if regressions:
+            print('%d regression(s) above %.0f%%: %s' % (len(regressions), 100 * args.tolerance, ', '.join(regressions)))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
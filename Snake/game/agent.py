@@ -1,9 +1,69 @@
+import os
 import random
+import warnings
 import numpy as np
 
 from .entities import CellType, SnakeAction, ALL_SNAKE_ACTIONS
-from .utils import print_me, AgentStatistics
-from .snn import snn as ai
+from .utils import print_me, AgentStatistics, DecisionCache, RewardWindow, read_trajectories
+from .snn import parameters as params
+from .snn.checkpoint import WeightStore
+
+ai = None   # SNN backend, imported by load_backend when the first SNN agent is created
+
+
+def load_backend():
+    """ Import the SNN backend selected by params.backend, so NEST is only loaded if a network is needed. """
+    global ai
+    if ai is None:
+        if params.backend == 'numpy':
+            from .snn import numpy_snn as backend
+        else:
+            from .snn import snn as backend
+        ai = backend
+    return ai
+
+
+def simulate_decision(networks, gap=0.):
+    """
+    Simulate the decision window of the networks and return its length in ms for each of them.
+
+    With adaptive_decision the window is simulated in chunks of decision_chunk ms. A network has decided as soon as
+    one output neuron leads by decision_margin spikes: its input is stopped and the spikes in flight arrive within
+    decision_flush ms, so they are paired with its decision and not with the next reward. The window ends when all
+    networks have decided, at the latest after decision_max_time ms.
+    """
+    if not params.adaptive_decision:
+        ai.nest_simulate(params.sim_time_step + gap)
+        return np.full(len(networks), params.sim_time_step)
+
+    if gap:
+        ai.nest_simulate(gap)
+    decided = np.full(len(networks), np.nan)
+    elapsed = 0.
+    while elapsed < params.decision_max_time:
+        duration = min(params.decision_chunk, params.decision_max_time - elapsed)
+        ai.nest_simulate(duration)
+        elapsed += duration
+
+        counts = np.sort(ai.get_spike_counts_all(networks), axis=1)
+        lead = counts[:, -1] - counts[:, -2]
+        new = np.isnan(decided) & (lead >= params.decision_margin)
+        if new.any():
+            ai.stop_input_all([networks[i] for i in np.flatnonzero(new)])
+            decided[new] = elapsed
+        if not np.isnan(decided).any():
+            break
+
+    # Hard cap, the input of a full window has ended decision_flush ms before its end already
+    undecided = np.isnan(decided)
+    decided[undecided] = elapsed
+    if elapsed < params.sim_time_step:
+        if undecided.any():
+            ai.stop_input_all([networks[i] for i in np.flatnonzero(undecided)])
+        ai.nest_simulate(params.decision_flush)
+        decided += params.decision_flush
+    return decided
+
 
 class AgentBase(object):
     """ Represents an intelligent agent for the Snake environment. """
@@ -52,36 +112,96 @@ class HumanAgent(AgentBase):
 class SNNAgent(AgentBase):
     """ Represents a snake agent which actions come from a SNN. """
 
-    def __init__(self, model=None, verbose=1):
+    def __init__(self, model=None, verbose=1, fused=None):
         self.model = model
         self.verbose = verbose
+        # In fused mode the reward is delivered in the same simulation window as the next input
+        self.fused = params.fused_reward if fused is None else fused
+        if self.fused and params.backend != 'numpy':
+            warnings.warn('Fused reward windows cannot clear the STDP traces in NEST, part of them carries over '
+                          'to the next input, see fused_reward in parameters.py')
+        # The weights are kept in memory across episodes and checkpointed to the model file in the background
+        self.store = WeightStore(model)
+        # The statistics are streamed to the training file next to the model
+        self.stats = AgentStatistics(None if model is None else os.path.join(os.path.dirname(model), params.training_file))
+        # Decisions for inputs seen before are drawn from the cache while the weights keep their version
+        self.cache = DecisionCache() if params.decision_cache else None
+        load_backend()
+        self.snn = None
         self.reset_agent()
 
+    @property
+    def w(self):
+        """ Weights of the left, forward and right output neuron, read lazily from the SNN. """
+        return self.snn.get_weights()
+
     def begin_episode(self):
-        self.w = self.snn.try_restore_model(self.model)
-        self.stats.append(self.w)
+        self.stats.append(self.snn.get_weights)
         #self.snn.set_weights(np.array([3000.,3000.,0,0,0,0]), np.array([0,0,3000.,3000.,0,0]), np.array([0,0,0,0,3000.,3000.]))
 
-    def set_reward(self, reward):
-        self.rewards.append(reward)
-
-        N = 1 # Number of element used in the rolling average
-        reward = [float(sum(y)) / N for y in zip(*self.rewards[-N:])]
+    def set_reward(self, reward, simulate=True):
+        reward = self.average_reward(reward)
+        replay = self.note_reward(reward)
+        if replay is not None:
+            # The rewarded decision came from the cache, simulate it so the reward finds its eligibility trace
+            self.snn.set_input(replay)
+            self.snn.reset_neurons()
+            simulate_decision([self.snn])
         self.snn.set_reward(reward)
 
-        self.snn.reset_neurons()
-        ai.nest_simulate()
-        self.w = self.snn.get_results()[1]
+        if simulate:
+            self.snn.reset_neurons()
+            ai.nest_simulate()
+        else:
+            # Without a reward window the traces of the previous input would pair with the next input
+            self.snn.reset_traces()
 
         return reward
 
-    def reset_agent(self):
-        self.w = []
-        self.rewards = []
-        self.snn = ai.SnakeSNN()
-        self.stats = AgentStatistics()
+    def note_reward(self, reward):
+        """
+        Keep the decision cache consistent with a reward that is about to be delivered.
 
-    def prepare_input(self, inputs):
+        Returns:
+            The input of the rewarded decision if it came from the cache and has to be simulated first, else None.
+        """
+        replay, self._replay = self._replay, None
+        if not any(reward):
+            return None
+        # The dopamine changes the weights
+        self._learned = True
+        return replay
+
+    def average_reward(self, reward):
+        """ Record the reward and return the aggregate delivered to the network, see reward_aggregation. """
+        return self.rewards.push(reward)
+
+    def reset_agent(self, forget=False):
+        """
+        Start over with the stored weights, or with initial weights if forget is set.
+        The network is created once and reinitialized in place, so resets add no nodes to the kernel.
+        """
+        self.rewards = RewardWindow()
+        self.weight_version = 0
+        self._version_weights = None
+        self._learned = True
+        self._replay = None
+        if self.cache is not None:
+            self.cache.clear()
+        if self.snn is None:
+            self.snn = ai.SnakeSNN()
+        else:
+            self.snn.reinitialize()
+        self.stats.reset()
+
+        if forget:
+            self.store.reset()
+        weights = self.store.latest()
+        if weights is not None:
+            self.snn.set_weights(*weights)
+
+    @staticmethod
+    def prepare_input(inputs):
         # Reflect negative values into positive ones onto the opposite sensor side and normalize them
         # E.g. [-0.3, 0, 0.7] => [0, 0, 0.7 - (-0.3)]/2 => [0, 0, 0.5]
         reflect = lambda a, b: max(0, (a - min(0, b))) / 2
@@ -94,42 +214,249 @@ class SNNAgent(AgentBase):
 
         return ALL_SNAKE_ACTIONS[random.choice(idx)]
 
+    def lookup_decision(self, observation, reward):
+        """
+        Look up the decision for the prepared observation in the cache.
+
+        Returns:
+            The cache key and the action, the action is None if the network has to simulate the decision.
+        """
+        if self.fused and any(reward):
+            # The reward of a fused window is only delivered by simulating it
+            return None, None
+        if self._learned:
+            # Weights change only while there is dopamine, a new version starts once they moved noticeably
+            self._learned = False
+            w = np.array(self.w)
+            if self._version_weights is None or np.abs(w - self._version_weights).max() > params.decision_cache_tolerance:
+                self.weight_version += 1
+                self._version_weights = w
+        key = self.cache.key(observation, self.weight_version)
+        action = self.cache.lookup(key)
+        # A reward for a decision from the cache has to simulate its input first, see set_reward
+        self._replay = None if action is None else observation
+        if action is not None:
+            self.stats.append(self._version_weights, 0.)
+            if self.verbose > 0:
+                print('Inp: %s, cached' % print_me(observation, '.2f'))
+        return key, action
+
     def act(self, observation, reward):
-        reward = self.set_reward(reward)
+        reward = self.set_reward(reward, not self.fused)
 
         observation = self.prepare_input(observation)
-        self.snn.set_input(observation)
+        key = None
+        if self.cache is not None:
+            key, action = self.lookup_decision(observation, reward)
+            if action is not None:
+                return action
+
+        # A fused window starts with a quiet gap, so the STDP traces of the previous input decay before the next
+        gap = params.fused_reward_gap if self.fused else 0.
+        self.snn.set_input(observation, gap)
 
         self.snn.reset_neurons()
-        ai.nest_simulate()
+        window = simulate_decision([self.snn], gap)[0]
 
-        output, self.w = self.snn.get_results()
-        self.stats.append(self.w)
+        output = self.snn.get_output()
+        self.stats.append(self.snn.get_weights, window)
 
         if self.verbose > 0:
             print('Rew: %s\n---' % (print_me(reward, '+.1f')))
-            print('Inp: %s, Out: %s' % (print_me(observation, '.2f'), print_me(output, '.2f')))
+            print('Inp: %s, Out: %s, Win: %.1f ms' % (print_me(observation, '.2f'), print_me(output, '.2f'), window))
             print('W_L-F-R: %s-%s-%s' % (print_me(self.w[0], '4.0f'), print_me(self.w[1], '4.0f'), print_me(self.w[2], '4.0f')))
 
         output = self.prepare_output(output)
+        if key is not None:
+            self.cache.record(key, output)
         return output
 
+    def learn(self, inputs, reward):
+        """ Deliver the reward and stimulate the network with prepared inputs like act, without choosing an action. """
+        self.set_reward(reward, not self.fused)
+
+        gap = params.fused_reward_gap if self.fused else 0.
+        self.snn.set_input(inputs, gap)
+
+        self.snn.reset_neurons()
+        window = simulate_decision([self.snn], gap)[0]
+
+        self.snn.get_output()
+        self.stats.append(self.snn.get_weights, window)
+
     def end_episode(self, observation, reward):
         reward = self.set_reward(reward)
 
         if self.verbose > 0:
             print('Rew: %s' % (print_me(reward, '+.1f')))
 
-        self.snn.save_model(self.w)
+        self.store.update(self.w)
         return self.w
 
 
 class SNNAgent2D(SNNAgent):
     """ Represents a snake agent in 2D which actions come from a SNN. """
-    def prepare_input(self, inputs):
+    @staticmethod
+    def prepare_input(inputs):
         # Reflect negative values into positive ones onto the oposite sensor side and normalize them
         # E.g. [-0.3, 0.7] => [0, 0.7 - (-0.3)]/2 => [0, 0.5]
         reflect = lambda a, b: max(0, (a - min(0, b))) / 2
         reflect2 = lambda a, b, c: max(0, (2 * a - (min(0, b) + min(0, c)))) / 4
 
         return [reflect(inputs[0], inputs[1]), inputs[3], reflect2(inputs[1], inputs[0], inputs[2]), inputs[4], reflect(inputs[2], inputs[1]), inputs[5]]
+
+
+class RateAgent(AgentBase):
+    """
+    Represents a snake agent which acts with the frozen weights of a trained SNN without simulating it.
+    The rate model gives the expected spike counts of the output neurons, they are turned into an action
+    like the spike counts of the SNN. The agent does not learn, it has no network, weight store or
+    decision cache and its statistics stay empty.
+    """
+
+    # Inputs and outputs are those of the SNN agent
+    prepare_input = staticmethod(SNNAgent.prepare_input)
+    prepare_output = SNNAgent.prepare_output
+
+    def __init__(self, model=None, verbose=1):
+        """
+        Args:
+            model: weights or policy file (default game/snn/weights.h5), or a RateModel.
+        """
+        from .snn.rate_model import RateModel
+
+        self.model = params.default_dir + params.weights_file if model is None else model
+        self.verbose = verbose
+        self.rate_model = self.model if isinstance(self.model, RateModel) else RateModel.load(self.model)
+        self.cache = None
+        self.stats = AgentStatistics()
+
+    @property
+    def w(self):
+        return self.rate_model.weights
+
+    def begin_episode(self):
+        pass
+
+    def reset_agent(self, forget=False):
+        pass
+
+    def act(self, observation, reward):
+        observation = self.prepare_input(observation)
+        output = self.rate_model.expected_counts(observation)
+
+        if self.verbose > 0:
+            print('Inp: %s, Out: %s' % (print_me(observation, '.2f'), print_me(output, '.2f')))
+
+        return self.prepare_output(output)
+
+    def end_episode(self, observation, reward):
+        return self.w
+
+
+class RateAgent2D(RateAgent):
+    """ Represents a snake agent in 2D which acts with the frozen weights of a trained SNN. """
+    prepare_input = staticmethod(SNNAgent2D.prepare_input)
+
+
+class SNNAgentHost(object):
+    """
+    Steps several SNN agents in lockstep. Their networks live in the same kernel, so every phase of
+    SNNAgent.act is done for all of them at once and every simulation window advances all networks:
+    a step costs as many simulations as the step of a single agent, two or one with fused windows.
+    """
+
+    def __init__(self, agents):
+        self.agents = list(agents)
+        # All networks share the simulation windows, so they have to agree on the fused mode
+        self.fused = self.agents[0].fused
+
+    def set_reward(self, agents, rewards, simulate=True):
+        """ Deliver the rewards to the agents like SNNAgent.set_reward, with one reward window for all of them. """
+        rewards = [agent.average_reward(reward) for agent, reward in zip(agents, rewards)]
+        replays = [(agent, agent.note_reward(reward)) for agent, reward in zip(agents, rewards)]
+        replays = [(agent, replay) for agent, replay in replays if replay is not None]
+        if replays:
+            # Rewarded decisions from the cache are simulated in one window first
+            networks = [agent.snn for agent, _ in replays]
+            ai.set_input_all(networks, [replay for _, replay in replays])
+            ai.reset_all(networks)
+            simulate_decision(networks)
+
+        networks = [agent.snn for agent in agents]
+        ai.set_reward_all(networks, rewards)
+        if simulate:
+            ai.reset_all(networks)
+            ai.nest_simulate()
+        else:
+            for network in networks:
+                network.reset_traces()
+        return rewards
+
+    def act(self, observations, rewards):
+        """ Return the actions of all agents, the observations and rewards are given in the order of the agents. """
+        rewards = self.set_reward(self.agents, rewards, not self.fused)
+
+        inputs = [agent.prepare_input(observation) for agent, observation in zip(self.agents, observations)]
+        actions = [None] * len(self.agents)
+        keys = [None] * len(self.agents)
+        for i, agent in enumerate(self.agents):
+            if agent.cache is not None:
+                keys[i], actions[i] = agent.lookup_decision(inputs[i], rewards[i])
+        deciding = [i for i, action in enumerate(actions) if action is None]
+        if not deciding:
+            return actions
+
+        networks = [self.agents[i].snn for i in deciding]
+        gap = params.fused_reward_gap if self.fused else 0.
+        ai.set_input_all(networks, [inputs[i] for i in deciding], gap)
+
+        ai.reset_all(networks)
+        windows = simulate_decision(networks, gap)
+
+        outputs = ai.get_output_all(networks)
+        for j, (i, window, output) in enumerate(zip(deciding, windows, outputs)):
+            agent = self.agents[i]
+            # Only sampled steps read the weights, the first one reads those of all networks in one call
+            agent.stats.append(lambda j=j: ai.get_weights_all(networks)[j], window)
+            actions[i] = agent.prepare_output(output)
+            if keys[i] is not None:
+                agent.cache.record(keys[i], actions[i])
+        return actions
+
+    def end_episode(self, agents, observations, rewards):
+        """ End the episodes of some of the agents, their last rewards are delivered in one window. """
+        self.set_reward(agents, rewards)
+        weights = ai.get_weights_all([agent.snn for agent in agents])
+        for agent, w in zip(agents, weights):
+            agent.store.update(w)
+        return weights
+
+
+def train_offline(agent, paths, passes=1):
+    """
+    Train the network of an SNN agent on recorded trajectories, without an environment.
+
+    Every step is replayed like SNNAgent.act: its reward is delivered and the network is stimulated with the
+    recorded input. The recorded action is not enforced, the rewards are given per output neuron and act on
+    the eligibility traces the network builds for the input. The weights are stored after every episode.
+
+    Args:
+        agent: an SNNAgent, its network continues from its current weights.
+        paths: trajectory files written by TrajectoryRecorder.
+        passes (int): how often all trajectories are replayed.
+
+    Returns:
+        The number of replayed episodes and steps.
+    """
+    episodes = steps = 0
+    for _ in range(passes):
+        for path in paths:
+            for inputs, rewards in read_trajectories(path):
+                agent.begin_episode()
+                for x, reward in zip(inputs[:-1], rewards[:-1]):
+                    agent.learn(x, reward)
+                agent.end_episode(None, rewards[-1])
+                episodes += 1
+                steps += len(inputs)
+    return episodes, steps
@@ -116,8 +116,19 @@ class Field(object):
             level_map: a list of strings representing the field objects (1 string per row).
         """
         self.level_map = level_map
+        # Cell types in a flat uint8 array, cell index = y * width + x, _cells is a (height, width) view of it
+        self._flat_cells = None
         self._cells = None
-        self._empty_cells = set()
+        self._width = len(level_map[0]) if level_map else 0
+        # Pool of the empty cell indices and the position of every cell in it (-1 if not empty)
+        self._empty_cells = []
+        self._empty_cell_positions = []
+        # Bitmasks of the cells of each non-empty type, bit x of row y and bit y of column x
+        self._row_masks = {}
+        self._column_masks = {}
+        # Indices of the cells changed since the last pop_changed_cells, None if changes are not tracked
+        self._changed_cells = None
+        self._all_cells_changed = False
         self._level_map_to_cell_type = {
             'S': CellType.SNAKE_HEAD,
             's': CellType.SNAKE_BODY,
@@ -138,14 +149,42 @@ class Field(object):
     def __setitem__(self, point, cell_type):
         """ Update the type of cell at the given point. """
         x, y = point
+        height, width = self._cells.shape
+        if not (0 <= x < width and 0 <= y < height):
+            # The bitmasks cannot wrap around like array indices, so points outside the field are rejected.
+            raise IndexError('Point ({}, {}) is outside the {}x{} field'.format(x, y, width, height))
+        old_cell_type = int(self._cells[y, x])
         self._cells[y, x] = cell_type
+        if self._changed_cells is not None:
+            self._changed_cells.append(y * self._width + x)
+
+        # Keep the row and column masks up to date for raycasts.
+        if old_cell_type != CellType.EMPTY:
+            self._row_masks[old_cell_type][y] &= ~(1 << x)
+            self._column_masks[old_cell_type][x] &= ~(1 << y)
+        if cell_type != CellType.EMPTY:
+            self._row_masks[cell_type][y] |= 1 << x
+            self._column_masks[cell_type][x] |= 1 << y
 
         # Do some internal bookkeeping to not rely on random selection of blank cells.
         if cell_type == CellType.EMPTY:
-            self._empty_cells.add(point)
-        else:
-            if point in self._empty_cells:
-                self._empty_cells.remove(point)
+            if old_cell_type != CellType.EMPTY:
+                self._add_empty_cell(y * self._width + x)
+        elif old_cell_type == CellType.EMPTY:
+            self._remove_empty_cell(y * self._width + x)
+
+    def _add_empty_cell(self, index):
+        self._empty_cell_positions[index] = len(self._empty_cells)
+        self._empty_cells.append(index)
+
+    def _remove_empty_cell(self, index):
+        # Move the last empty cell into the gap to remove in O(1).
+        position = self._empty_cell_positions[index]
+        last = self._empty_cells.pop()
+        if last != index:
+            self._empty_cells[position] = last
+            self._empty_cell_positions[last] = position
+        self._empty_cell_positions[index] = -1
 
     def __str__(self):
         return '\n'.join(
@@ -163,22 +202,103 @@ class Field(object):
         """ Get the size of the field (size == width == height). """
         return len(self.level_map)
 
+    def cell_index(self, point):
+        """ Get the index of the cell at the given point in the flat cell array. """
+        return point.y * self._width + point.x
+
+    def cell_point(self, index):
+        """ Get the point of the cell with the given index in the flat cell array. """
+        return Point(index % self._width, index // self._width)
+
+    def track_changes(self):
+        """ Start recording the cells that change, e.g. to redraw only these. """
+        self._changed_cells = []
+        self._all_cells_changed = True
+
+    def pop_changed_cells(self):
+        """
+        Get the indices of the cells changed since the last call and forget them.
+
+        Returns:
+            A list of flat cell indices (may contain duplicates),
+            or None if the whole field has changed, e.g. because a new level was created.
+        """
+        if self._all_cells_changed:
+            self._all_cells_changed = False
+            self._changed_cells = []
+            return None
+        changed, self._changed_cells = self._changed_cells, []
+        return changed
+
     def create_level(self):
         """ Create a new field based on the level map. """
         try:
-            self._cells = np.array([
-                [self._level_map_to_cell_type[symbol] for symbol in line]
+            self._flat_cells = np.array([
+                self._level_map_to_cell_type[symbol]
                 for line in self.level_map
-            ])
-            self._empty_cells = {
-                Point(x, y)
-                for y in range(self.height)
-                for x in range(self.width)
-                if self[(x, y)] == CellType.EMPTY
-            }
+                for symbol in line
+            ], dtype=np.uint8)
         except KeyError as err:
             raise ValueError('Unknown level map symbol: "{err.args[0]}"')
 
+        self._width = self.width
+        self._cells = self._flat_cells.reshape(self.height, self.width)
+        self._all_cells_changed = True
+        self._empty_cells = np.flatnonzero(self._flat_cells == CellType.EMPTY).tolist()
+        self._empty_cell_positions = [-1] * self._flat_cells.size
+        for position, index in enumerate(self._empty_cells):
+            self._empty_cell_positions[index] = position
+
+        self._row_masks = {
+            cell_type: [sum(1 << int(x) for x in np.flatnonzero(row == cell_type)) for row in self._cells]
+            for cell_type in self._cell_type_to_level_map if cell_type != CellType.EMPTY
+        }
+        self._column_masks = {
+            cell_type: [sum(1 << int(y) for y in np.flatnonzero(column == cell_type)) for column in self._cells.T]
+            for cell_type in self._cell_type_to_level_map if cell_type != CellType.EMPTY
+        }
+
+    def raycast(self, origin, direction, cell_types):
+        """
+        Find the first cell of one of the given types in a straight line.
+
+        Args:
+            origin: the point to look from (not included).
+            direction: one of the SnakeDirection offsets.
+            cell_types: the cell types that stop the ray.
+
+        Returns:
+            The distance in cells and the type of the first cell found,
+            or the distance to the first cell outside of the field and None.
+        """
+        if direction.y == 0:
+            masks, position, line, size = self._row_masks, origin.x, origin.y, self.width
+            step = direction.x
+        else:
+            masks, position, line, size = self._column_masks, origin.y, origin.x, self.height
+            step = direction.y
+
+        mask = 0
+        for cell_type in cell_types:
+            mask |= masks[cell_type][line]
+
+        if step > 0:
+            ahead = mask >> (position + 1)
+            if not ahead:
+                return size - position, None
+            hit = position + (ahead & -ahead).bit_length()
+            distance = hit - position
+        else:
+            ahead = mask & ((1 << max(position, 0)) - 1)
+            if not ahead:
+                return position + 1, None
+            hit = ahead.bit_length() - 1
+            distance = position - hit
+
+        for cell_type in cell_types:
+            if masks[cell_type][line] >> hit & 1:
+                return distance, cell_type
+
     def find_snake_head(self):
         """ Find the snake's head on the field. """
         for y in range(self.height):
@@ -189,7 +309,7 @@ class Field(object):
 
     def get_random_empty_cell(self):
         """ Get the coordinates of a random empty cell. """
-        return random.choice(list(self._empty_cells))
+        return self.cell_point(random.choice(self._empty_cells))
 
     def place_snake(self, snake):
         """ Put the snake on the field and fill the cells with its body. """
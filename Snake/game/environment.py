@@ -3,6 +3,21 @@ import numpy as np
 
 from .entities import Snake, Field, CellType, SnakeDirection, SnakeAction, ALL_SNAKE_DIRECTIONS, ALL_SNAKE_ACTIONS
 
+_ray_values = [1.0]
+
+
+def ray_value(distance):
+    """ Get the value of a raycast that ends after distance cells, it decreases by 0.1 per empty cell down to 0.2. """
+    while len(_ray_values) < distance:
+        _ray_values.append(max(0.2, _ray_values[-1] - 0.1))
+    return _ray_values[distance - 1]
+
+
+def raycast(field, origin, direction, obstacles):
+    """ Look from origin in direction: positive value for a fruit, negative for an obstacle or the field border. """
+    distance, cell_type = field.raycast(origin, direction, obstacles + (CellType.FRUIT,))
+    return ray_value(distance) if cell_type == CellType.FRUIT else -ray_value(distance)
+
 class Environment(object):
     """
     Represents the environment for Snake that implements the game logic,
@@ -16,6 +31,7 @@ class Environment(object):
         self.initial_snake_length = 1
         self.is_game_over = False
         self.stats = EpisodeStatistics()
+        self._observation = None
 
     def new_episode(self):
         """ Reset the environment and begin a new episode. """
@@ -26,6 +42,7 @@ class Environment(object):
         self.field.place_snake(self.snake)
         self.generate_fruit()
         self.is_game_over = False
+        self._observation = None
 
         result = TimestepResult(
             observation=self.get_observation(),
@@ -36,30 +53,21 @@ class Environment(object):
         return result
 
     def get_observation(self):
-        """ Observe the state of the environment. """
-
-        def raycast(field, initial, increment, value=1.0):
-            next_point = initial + increment
-            try:
-                as_next = field[next_point]
-            except:
-                return -value
-
-            if as_next == CellType.WALL:
-                return -value
-            elif as_next == CellType.FRUIT:
-                return value
-            else:
-                value = max(0.2, value - 0.1)
-                return raycast(field, next_point, increment, value)
-
-        right = raycast(self.field, self.snake.head, SnakeDirection.EAST)
-        left = raycast(self.field, self.snake.head, SnakeDirection.WEST)
+        """ Observe the state of the environment, computed once per timestep. """
+        if self._observation is None:
+            self._observation = self.observe()
+        return self._observation
+
+    def observe(self):
+        """ Compute the observation of the current state. """
+        right = raycast(self.field, self.snake.head, SnakeDirection.EAST, (CellType.WALL,))
+        left = raycast(self.field, self.snake.head, SnakeDirection.WEST, (CellType.WALL,))
 
         return np.array([left, 0, right])
 
     def choose_action(self, action):
         """ Choose the action that will be taken at the next timestep. """
+        self._observation = None
         if action == SnakeAction.GO_LEFT and self.snake.direction != SnakeDirection.WEST:
             self.snake.change_direction()
         elif action == SnakeAction.GO_RIGHT and self.snake.direction != SnakeDirection.EAST:
@@ -68,6 +76,7 @@ class Environment(object):
     def timestep(self):
         """ Execute the timestep and return the new observable state. """
         self.stats.increment_timestep()
+        self._observation = None
 
         old_head = self.snake.head
         old_tail = self.snake.tail
@@ -144,30 +153,16 @@ class Environment2D(Environment):
     Represents the environment for Snake in 2D that implements the game logic,
     provides rewards for the agent and keeps track of game statistics.
     """
-    def get_observation(self):
-        """ Observe the state of the environment. """
-        def raycast(field, initial, increment, value=1.0):
-            next_point = initial + increment
-            try:
-                as_next = field[next_point]
-            except:
-                return -value
-
-            if as_next == CellType.WALL or as_next == CellType.SNAKE_BODY:
-                return -value
-            elif as_next == CellType.FRUIT:
-                return value
-            else:
-                value = max(0.2, value - 0.1)
-                return raycast(field, next_point, increment, value)
-
+    def observe(self):
+        """ Compute the observation of the current state. """
+        obstacles = (CellType.WALL, CellType.SNAKE_BODY)
         direction_idx = ALL_SNAKE_DIRECTIONS.index(self.snake.direction)
         left_direction = ALL_SNAKE_DIRECTIONS[(direction_idx - 1) % len(ALL_SNAKE_DIRECTIONS)]
         right_direction = ALL_SNAKE_DIRECTIONS[(direction_idx + 1) % len(ALL_SNAKE_DIRECTIONS)]
 
-        front = raycast(self.field, self.snake.head, self.snake.direction)
-        right = raycast(self.field, self.snake.head, right_direction)
-        left = raycast(self.field, self.snake.head, left_direction)
+        front = raycast(self.field, self.snake.head, self.snake.direction, obstacles)
+        right = raycast(self.field, self.snake.head, right_direction, obstacles)
+        left = raycast(self.field, self.snake.head, left_direction, obstacles)
 
         # Calculate distance from the snake head to the fruit
         head = self.snake.head
@@ -189,6 +184,7 @@ class Environment2D(Environment):
     def choose_action(self, action):
         """ Choose the action that will be taken at the next timestep. """
         self.last_action = action
+        self._observation = None
 
         if action == SnakeAction.GO_LEFT:
             self.snake.change_direction(-1)
@@ -198,6 +194,7 @@ class Environment2D(Environment):
     def timestep(self):
         """ Execute the timestep and return the new observable state. """
         self.stats.increment_timestep()
+        self._observation = None
 
         old_head = self.snake.head
         old_tail = self.snake.tail
@@ -253,6 +250,231 @@ class Environment2D(Environment):
         return TimestepResult(observation=self.get_observation(), reward=reward, is_episode_end=self.is_game_over)
 
 
+class RecordingEnvironment(object):
+    """
+    Wraps an Environment or Environment2D and records every step of its episodes with a TrajectoryRecorder.
+
+    A step is recorded when the action for it is chosen, together with the observation and the reward of the
+    timestep the action answers. prepare maps an observation to the input of the SNN, e.g.
+    SNNAgent2D.prepare_input. An episode that is left before its end is closed with a zero reward.
+    """
+
+    def __init__(self, env, recorder, prepare):
+        self.env = env
+        self.recorder = recorder
+        self.prepare = prepare
+        self._timestep = None
+
+    def __getattr__(self, name):
+        return getattr(self.env, name)
+
+    def new_episode(self):
+        if self._timestep is not None and not self._timestep.is_episode_end:
+            observation = self._timestep.observation
+            self.recorder.end_episode(observation, self.prepare(observation), np.zeros(len(self._timestep.reward)))
+        self._timestep = self.env.new_episode()
+        return self._timestep
+
+    def choose_action(self, action):
+        observation, reward = self._timestep.observation, self._timestep.reward
+        self.recorder.append(observation, self.prepare(observation), reward, action)
+        self.env.choose_action(action)
+
+    def timestep(self):
+        self._timestep = self.env.timestep()
+        if self._timestep.is_episode_end:
+            observation = self._timestep.observation
+            self.recorder.end_episode(observation, self.prepare(observation), self._timestep.reward)
+        return self._timestep
+
+
+class VecEnvironment2D(object):
+    """
+    Represents num_envs independent Snake 2D environments that are stepped together.
+    The game logic, observations and rewards are the same as in Environment2D, but all
+    fields are kept in one (num_envs, height, width) array and the snake bodies in ring
+    buffers of flat cell indices, so a timestep for all snakes is a few NumPy operations.
+    Finished episodes are restarted automatically.
+    """
+
+    # Offsets of ALL_SNAKE_DIRECTIONS and the index of each SnakeAction in ALL_SNAKE_ACTIONS
+    DX = np.array([direction.x for direction in ALL_SNAKE_DIRECTIONS])
+    DY = np.array([direction.y for direction in ALL_SNAKE_DIRECTIONS])
+    TURN = np.zeros(3, dtype=int)
+    TURN[SnakeAction.GO_LEFT], TURN[SnakeAction.GO_RIGHT] = -1, 1
+    ACTION_INDEX = np.array([ALL_SNAKE_ACTIONS.index(action) for action in range(3)])
+
+    def __init__(self, num_envs, level_map):
+        self.num_envs = num_envs
+        self.max_timesteps = 1000
+        self.reward_noise = 0.01
+
+        field = Field(level_map=level_map)
+        field.create_level()
+        self.width, self.height = field.width, field.height
+        self.size = self.width * self.height
+        start = field.find_snake_head()
+        self._start = start.y * self.width + start.x
+
+        # One extra wall cell behind every field, rays and moves leaving the map end there
+        self._template = np.append(field._cells.reshape(-1), CellType.WALL).astype(np.uint8)
+        self._cells = np.tile(self._template, (num_envs, 1))
+        self.fields = self._cells[:, :self.size].reshape(num_envs, self.height, self.width)
+
+        self._envs = np.arange(num_envs)
+        self._body = np.zeros((num_envs, self.size + 1), dtype=int)
+        self._head = np.zeros(num_envs, dtype=int)
+        self._length = np.zeros(num_envs, dtype=int)
+        self.directions = np.zeros(num_envs, dtype=int)
+        self.fruits_position = np.zeros(num_envs, dtype=int)
+
+        # Raycast values after 0, 1, 2, ... empty cells, computed like Environment2D does
+        ray_length = max(self.width, self.height)
+        self._ray_steps = np.arange(1, ray_length + 1)
+        self._ray_values = np.zeros(ray_length)
+        value = 1.0
+        for i in range(ray_length):
+            self._ray_values[i] = value
+            value = max(0.2, value - 0.1)
+
+        self.timesteps = np.zeros(num_envs, dtype=int)
+        self.fruits = np.zeros(num_envs, dtype=int)
+        self.episode_timesteps = np.zeros(num_envs, dtype=int)
+        self.episode_fruits = np.zeros(num_envs, dtype=int)
+        self.terminal_observation = np.zeros((num_envs, 6))
+
+    @property
+    def heads(self):
+        """ Get the flat cell index of every snake's head. """
+        return self._body[self._envs, self._head]
+
+    def reset(self):
+        """ Begin a new episode in all environments and return their observations. """
+        self._new_episodes(self._envs)
+        return self.get_observation()
+
+    def _new_episodes(self, envs):
+        self._cells[envs] = self._template
+        self._head[envs] = 0
+        self._body[envs, 0] = self._start
+        self._length[envs] = 1
+        self.directions[envs] = np.random.choice([1, 3], len(envs))
+        self.timesteps[envs] = 0
+        self.fruits[envs] = 0
+        self._generate_fruits(envs)
+
+    def _generate_fruits(self, envs):
+        """ Generate a new fruit at a random empty cell in each of the given environments. """
+        keys = np.random.random((len(envs), self.size))
+        keys[self._cells[envs, :self.size] != CellType.EMPTY] = -1
+        self.fruits_position[envs] = np.argmax(keys, axis=1)
+        self._cells[envs, self.fruits_position[envs]] = CellType.FRUIT
+
+    def get_observation(self, envs=None):
+        """ Observe the state of the given (default all) environments, one row per environment. """
+        envs = self._envs if envs is None else envs
+        heads = self._body[envs, self._head[envs]]
+        head_x, head_y = heads % self.width, heads // self.width
+        directions = self.directions[envs]
+
+        # Raycasts to the left, front and right
+        ray_directions = (directions[:, None] + np.array([-1, 0, 1])) % len(ALL_SNAKE_DIRECTIONS)
+        x = head_x[:, None, None] + self.DX[ray_directions][:, :, None] * self._ray_steps
+        y = head_y[:, None, None] + self.DY[ray_directions][:, :, None] * self._ray_steps
+        inside = (x >= 0) & (x < self.width) & (y >= 0) & (y < self.height)
+        cells = self._cells[envs[:, None, None], np.where(inside, y * self.width + x, self.size)]
+        hit = (cells == CellType.WALL) | (cells == CellType.SNAKE_BODY) | (cells == CellType.FRUIT)
+        first = np.argmax(hit, axis=2)
+        is_fruit = np.take_along_axis(cells, first[:, :, None], axis=2)[:, :, 0] == CellType.FRUIT
+        rays = np.where(is_fruit, 1, -1) * self._ray_values[first]
+
+        # Smell the fruit like Environment2D.get_observation
+        diff_x = self.fruits_position[envs] % self.width - head_x
+        diff_y = self.fruits_position[envs] // self.width - head_y
+        dir_x, dir_y = self.DX[directions], self.DY[directions]
+        smells = np.stack([
+            np.maximum(0, diff_x * dir_y) + np.maximum(0, diff_y * -dir_x),
+            np.maximum(0, diff_y * dir_y) + np.maximum(0, diff_x * dir_x),
+            np.maximum(0, diff_x * -dir_y) + np.maximum(0, diff_y * dir_x),
+        ], axis=1)
+        max_val = np.amax(smells, axis=1, keepdims=True)
+        p1norm = np.sum(smells, axis=1, keepdims=True) + 0.0000001
+        smells = np.where(smells == 0, 0, max_val - smells + 1) / (4 * p1norm)
+
+        return np.concatenate([rays, smells], axis=1)
+
+    def step(self, actions):
+        """
+        Take one action in every environment and execute the timestep.
+
+        Args:
+            actions: one SnakeAction per environment.
+
+        Returns:
+            A TimestepResult with one row per environment. Environments whose episode ended are
+            restarted: their observation is the first one of the new episode, the terminal one is
+            kept in terminal_observation and the statistics in episode_fruits/episode_timesteps.
+        """
+        actions = np.asarray(actions)
+        envs = self._envs
+        self.timesteps += 1
+        self.directions = (self.directions + self.TURN[actions]) % len(ALL_SNAKE_DIRECTIONS)
+
+        old_head = self.heads
+        old_tail = self._body[envs, (self._head + self._length - 1) % self._body.shape[1]]
+        x = old_head % self.width + self.DX[self.directions]
+        y = old_head // self.width + self.DY[self.directions]
+        inside = (x >= 0) & (x < self.width) & (y >= 0) & (y < self.height)
+        new_head = np.where(inside, y * self.width + x, self.size)
+
+        # Grow when eating the fruit, otherwise move forward
+        eaten = new_head == self.fruits_position
+        self.fruits += eaten
+        self._head = (self._head - 1) % self._body.shape[1]
+        self._body[envs, self._head] = new_head
+        self._length += eaten
+        if eaten.any():
+            self._generate_fruits(envs[eaten])
+
+        # Update the fields like Field.update_snake_footprint and check for collisions
+        self._cells[envs, old_head] = CellType.SNAKE_BODY
+        self._cells[envs, old_tail] = CellType.EMPTY
+        target = self._cells[envs, new_head]
+        dead = ((target == CellType.WALL) | (target == CellType.SNAKE_BODY)) & (new_head != old_tail)
+        self._cells[envs, new_head] = CellType.SNAKE_HEAD
+        is_episode_end = dead | (self.timesteps >= self.max_timesteps)
+
+        # Apply the reward to the last action and the negative reward divided by 2 to the other actions
+        reward_value = np.where(dead, -2., np.where(eaten, 1., 0.))
+        reward = np.repeat(-reward_value[:, None] / 2.0, 3, axis=1)
+        reward[envs, self.ACTION_INDEX[actions]] = reward_value
+
+        # Give reward to the last action when the fruit is in front of the snake head
+        observation = self.get_observation()
+        front = observation[:, 1]
+        ahead = front > 0
+        patterns = np.zeros((3, 3))
+        patterns[SnakeAction.GO_LEFT] = [1, -1, -0.5]
+        patterns[SnakeAction.GO_RIGHT] = [-0.5, -1, 1]
+        patterns[SnakeAction.MAINTAIN_DIRECTION] = [-0.125, 0.25, -0.125]
+        reward[ahead] = patterns[actions[ahead]] * front[ahead, None]
+
+        # Noise reward in 1% of the cases
+        noise = np.random.random(self.num_envs) < self.reward_noise
+        reward[noise] = np.random.uniform(-1.0, 1.0, (np.count_nonzero(noise), 3))
+
+        # Restart finished episodes
+        if is_episode_end.any():
+            ended = envs[is_episode_end]
+            self.terminal_observation[ended] = observation[ended]
+            self.episode_fruits[ended] = self.fruits[ended]
+            self.episode_timesteps[ended] = self.timesteps[ended]
+            self._new_episodes(ended)
+            observation[ended] = self.get_observation(ended)
+
+        return TimestepResult(observation=observation, reward=reward, is_episode_end=is_episode_end)
+
+
 class TimestepResult(object):
     """ Represents the information provided to the agent after each timestep. """
 
@@ -1,3 +1,4 @@
+import threading
 import numpy as np
 import pygame
 
@@ -11,7 +12,9 @@ class PyGameGUI:
     TIMESTEP_MACHINE = 120
     TIMESTEP_HUMAN = 800
     CELL_SIZE = 50
+    MAX_DIRTY_CELLS = 64
     CAPTION = "Snake meets SNN!"
+    LATE_DECISIONS = ('wait', 'repeat', 'skip')
 
     SNAKE_CONTROL_KEYS = [
         pygame.K_SPACE,
@@ -19,14 +22,26 @@ class PyGameGUI:
         pygame.K_RIGHT
     ]
 
-    def __init__(self):
+    def __init__(self, late_decision=None):
+        """
+        Args:
+            late_decision: (optional) compute the actions of the agent on a background thread and, if an
+                action is not ready when the timestep is due, 'wait' for it, 'repeat' the previous direction
+                or 'skip' the timestep until it is ready. By default the agent acts inline.
+        """
+        if late_decision is not None and late_decision not in self.LATE_DECISIONS:
+            raise ValueError('Unknown late decision policy: %s' % late_decision)
         pygame.init()
+        self.late_decision = late_decision
+        self.worker = None
         self.agent = None
         self.env = None
         self.screen = None
         self.running = True
         self.fps_clock = None
         self.timestep_watch = Stopwatch()
+        self.tiles = None
+        self.tile_pixels = None
 
     def load_environment(self, env):
         """ Load the environment into the GUI. """
@@ -36,27 +51,33 @@ class PyGameGUI:
         self.screen.fill(Colors.SCREEN_BACKGROUND)
         pygame.display.set_caption(self.CAPTION)
 
+        # Prerendered tiles per cell type, as surfaces for single cells and as pixels for whole frames
+        cell_types = range(max(Colors.CELL_TYPE) + 1)
+        self.tiles = [self.render_tile(cell_type) for cell_type in cell_types]
+        self.tile_pixels = np.stack([pygame.surfarray.array3d(tile) for tile in self.tiles])
+        self.env.field.track_changes()
+
     def load_agent(self, agent):
         """ Load the RL agent into the GUI. """
         self.agent = agent
 
-    def render_cell(self, x, y):
-        """ Draw the cell specified by the field coordinates. """
-        cell_coords = pygame.Rect(
-            x * self.CELL_SIZE,
-            y * self.CELL_SIZE,
-            self.CELL_SIZE,
-            self.CELL_SIZE,
-        )
-        if self.env.field[x, y] == CellType.EMPTY:
-            pygame.draw.rect(self.screen, Colors.SCREEN_BACKGROUND, cell_coords)
-        else:
-            color = Colors.CELL_TYPE[self.env.field[x, y]]
-            pygame.draw.rect(self.screen, color, cell_coords, 1)
+    def render_tile(self, cell_type):
+        """ Draw a cell of the given type on a new surface of the size of one cell. """
+        tile = pygame.Surface((self.CELL_SIZE, self.CELL_SIZE))
+        tile.fill(Colors.SCREEN_BACKGROUND)
+        if cell_type in Colors.CELL_TYPE:
+            cell_coords = tile.get_rect()
+            color = Colors.CELL_TYPE[cell_type]
+            pygame.draw.rect(tile, color, cell_coords, 1)
 
             internal_padding = self.CELL_SIZE // 6 * 2
             internal_square_coords = cell_coords.inflate((-internal_padding, -internal_padding))
-            pygame.draw.rect(self.screen, color, internal_square_coords)
+            pygame.draw.rect(tile, color, internal_square_coords)
+        return tile
+
+    def render_cell(self, x, y):
+        """ Draw the cell specified by the field coordinates and return its screen rectangle. """
+        return self.screen.blit(self.tiles[self.env.field[x, y]], (x * self.CELL_SIZE, y * self.CELL_SIZE))
 
     def map_key_to_snake_action(self, key):
         """ Convert a keystroke to an environment action. """
@@ -68,24 +89,44 @@ class PyGameGUI:
             self.env.snake.change_direction()
 
     def render(self):
-        """ Draw the entire game frame. """
-        for x in range(self.env.field.width):
-            for y in range(self.env.field.height):
-                self.render_cell(x, y)
+        """ Draw the cells changed since the last frame and return the screen rectangles to update. """
+        field = self.env.field
+        changed = field.pop_changed_cells()
+        if changed is None or len(changed) > self.MAX_DIRTY_CELLS:
+            self.render_frame()
+            return [self.screen.get_rect()]
+
+        return [self.render_cell(*field.cell_point(index)) for index in set(changed)]
+
+    def render_frame(self):
+        """ Draw the entire game frame at once by mapping every cell to the pixels of its tile. """
+        cells = self.env.field._cells
+        if cells is None:
+            return
+        # (height, width, tile x, tile y, rgb) -> (x pixels, y pixels, rgb) as expected by surfarray
+        pixels = self.tile_pixels[cells].transpose(1, 2, 0, 3, 4)
+        pygame.surfarray.blit_array(self.screen, pixels.reshape(cells.shape[1] * self.CELL_SIZE, cells.shape[0] * self.CELL_SIZE, 3))
 
     def run(self, num_episodes=1):
         """ Run the GUI player for the specified number of episodes. """
         pygame.display.update()
         self.fps_clock = pygame.time.Clock()
         self.running = True
+        if self.late_decision is not None and not isinstance(self.agent, HumanAgent):
+            self.worker = InferenceWorker(self.agent)
 
-        for episode in range(num_episodes):
-            if not self.running:
-                break
+        try:
+            for episode in range(num_episodes):
+                if not self.running:
+                    break
 
-            self.run_episode()
-            print('Episode [%d/%d] - Fruits: %d' % (episode + 1, num_episodes, self.env.stats.fruits))
-            pygame.time.wait(1500)
+                self.run_episode()
+                print('Episode [%d/%d] - Fruits: %d' % (episode + 1, num_episodes, self.env.stats.fruits))
+                pygame.time.wait(1500)
+        finally:
+            if self.worker is not None:
+                self.worker.stop()
+                self.worker = None
 
     def run_episode(self):
         """ Run the GUI player for a single episode. """
@@ -95,6 +136,8 @@ class PyGameGUI:
         timestep_result = self.env.new_episode()
         self.agent.begin_episode()
         is_human_agent = isinstance(self.agent, HumanAgent)
+        if self.worker is not None:
+            self.worker.submit(timestep_result.observation, timestep_result.reward)
 
         # Main game loop.
         game_over = False
@@ -116,25 +159,122 @@ class PyGameGUI:
             timestep_timed_out = self.timestep_watch.time() >= (self.TIMESTEP_HUMAN if is_human_agent else self.TIMESTEP_MACHINE)
             human_made_move = is_human_agent and action != SnakeAction.MAINTAIN_DIRECTION
 
+            if self.worker is not None and timestep_timed_out:
+                action = self.worker.poll()
+                if action is None and self.late_decision == 'wait':
+                    action = self.worker.wait()
+                elif action is None and self.late_decision == 'repeat':
+                    # Actions are relative to the heading, keeping it repeats the previous direction
+                    action = SnakeAction.MAINTAIN_DIRECTION
+                elif action is None:
+                    # Skip: keep drawing and handling events, the timestep is taken once the action is ready
+                    timestep_timed_out = False
+
             if timestep_timed_out or human_made_move:
                 self.timestep_watch.reset()
 
-                if not is_human_agent:
+                if not is_human_agent and self.worker is None:
                     action = self.agent.act(timestep_result.observation, timestep_result.reward)
 
                 self.env.choose_action(action)
                 timestep_result = self.env.timestep()
 
                 if timestep_result.is_episode_end:
+                    if self.worker is not None:
+                        self.worker.wait()
                     self.agent.end_episode(timestep_result.observation, timestep_result.reward)
                     game_over = True
+                elif self.worker is not None:
+                    self.worker.submit(timestep_result.observation, timestep_result.reward)
 
             # Render.
-            self.render()
+            dirty_rects = self.render()
             pygame.display.set_caption(self.CAPTION + '  [Score: %d]' % self.env.stats.fruits)
-            pygame.display.update()
+            pygame.display.update(dirty_rects)
             self.fps_clock.tick(self.FPS_LIMIT)
 
+class InferenceWorker(object):
+    """ Lets an agent choose its actions on a background thread, for the latest observation only.
+
+    A request replaces the one still waiting in the slot, superseded observations are dropped without
+    simulating them, so a slow agent never builds up a backlog. An exception of the agent ends the thread
+    and is raised again by poll and wait.
+    """
+
+    def __init__(self, agent):
+        self.agent = agent
+        self.condition = threading.Condition()
+        self.request = None
+        self.submitted = 0
+        self.done = 0
+        self.taken = 0
+        self.dropped = 0
+        self.action = None
+        self.error = None
+        self.stopping = False
+        self.thread = threading.Thread(target=self._run, name='InferenceWorker', daemon=True)
+        self.thread.start()
+
+    def submit(self, observation, reward):
+        """ Ask for the action for the observation. A request that has not been started yet is dropped. """
+        with self.condition:
+            self.submitted += 1
+            if self.request is not None:
+                self.dropped += 1
+            self.request = (self.submitted, observation, reward)
+            self.condition.notify_all()
+
+    def poll(self):
+        """
+        Get the action of the latest finished request, or None if no request has finished since the last call.
+        The action may belong to an earlier request than the last one if the agent is slower than the timesteps.
+        """
+        with self.condition:
+            self._raise_error()
+            if self.done == self.taken:
+                return None
+            self.taken = self.done
+            return self.action
+
+    def wait(self):
+        """ Block until the action for the last request is ready and return it. """
+        with self.condition:
+            self.condition.wait_for(lambda: self.done == self.submitted or self.error is not None)
+            self._raise_error()
+            self.taken = self.done
+            return self.action
+
+    def stop(self):
+        """ Finish the current request and end the thread. """
+        with self.condition:
+            self.stopping = True
+            self.request = None
+            self.condition.notify_all()
+        self.thread.join()
+
+    def _raise_error(self):
+        if self.error is not None:
+            raise RuntimeError('The agent failed on the inference thread') from self.error
+
+    def _run(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.request is not None or self.stopping)
+                if self.stopping:
+                    break
+                request, self.request = self.request, None
+            number, observation, reward = request
+            try:
+                action = self.agent.act(observation, reward)
+            except Exception as err:
+                with self.condition:
+                    self.error = err
+                    self.condition.notify_all()
+                break
+            with self.condition:
+                self.done, self.action = number, action
+                self.condition.notify_all()
+
 class Stopwatch(object):
     """ Measures the time elapsed since the last checkpoint. """
 
@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import atexit
+import threading
+import h5py
+import numpy as np
+
+from .parameters import *
+
+# Layout of the weights file:
+#   weights   float (versions, output_layer_size, input_layer_size), extendable, one chunk per snapshot
+#   versions  int (versions,), version of each snapshot in ascending order
+#   attrs['reset']  version at which the weights were reset, older snapshots are history only
+#   attrs['source']  model file the versions continue from, if it is not the weights file itself
+# Files written by save_model or exported policies with a single dataset 'w' are only read, never written.
+# Their weights are version 0, the store appends the later versions to a checkpoint file next to them.
+
+_pending = set()        # Stores with versions that have not been written yet, written at exit
+
+
+def checkpoint_path(path):
+    """Path of the file the versions of a weights file with a single dataset 'w' are written to."""
+    return os.path.splitext(path)[0] + '_checkpoints.h5'
+
+
+def is_model_file(path):
+    """Whether the file holds a single dataset 'w' instead of the versions of a weight store."""
+    try:
+        with h5py.File(path, 'r') as h5f:
+            return 'w' in h5f and 'weights' not in h5f
+    except IOError as _:
+        return False
+
+
+class WeightStore(object):
+    """Keeps the weights of a network in memory and checkpoints them in the background.
+    Every update creates a new version. A writer thread appends the latest version to the weights file
+    every checkpoint_interval seconds, so a crash loses at most one interval. Older versions stay in the
+    file and can be loaded again with load(version). A model file with a single dataset 'w' is only read,
+    the versions are written to its checkpoint file and continue from there.
+    """
+
+    def __init__(self, path=None, interval=checkpoint_interval):
+        self.source = default_dir + weights_file if path is None else path
+        self.path = checkpoint_path(self.source) if is_model_file(self.source) else self.source
+        self.interval = interval
+        self.weights = None
+        self.version = 0
+        self._loaded = False
+        self._written = 0
+        self._reset = None
+        self._lock = threading.Lock()
+        self._io_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._closed = False
+        self._writer = None
+
+    def latest(self):
+        """Return the latest weights, the file is only read the first time."""
+        if not self._loaded:
+            self._loaded = True
+            weights, version = self._read()
+            with self._lock:
+                # Continue the versions of the file, even if its weights have been reset
+                self.weights, self.version, self._written = weights, version, version
+        return self.weights
+
+    def load(self, version):
+        """Return the weights of the given version, the weights in memory if it is the latest one.
+        :param version: Version of the weights
+        :return: Weights of the left, forward and right neuron or None if the version does not exist
+        """
+        with self._lock:
+            if version == self.version and self.weights is not None:
+                return self.weights
+        return self._read(version)[0]
+
+    def update(self, weights):
+        """Store new weights in memory, they are written by the writer thread.
+        The writer thread ends once everything is written and is started again by the next update.
+        :param weights: Weights of the left, forward and right neuron
+        """
+        self.latest()
+        with self._lock:
+            self.weights = np.array(weights, dtype=float)
+            self.version += 1
+            _pending.add(self)
+            start = self.interval > 0 and self._writer is None and not self._closed
+            if start:
+                self._writer = threading.Thread(target=self._run, name='WeightStore', daemon=True)
+        if self.interval <= 0:
+            self.flush()
+        elif start:
+            self._writer.start()
+
+    def reset(self):
+        """Forget the weights, so the network starts from its initial weights. The file keeps the history."""
+        self.latest()
+        with self._lock:
+            self.weights = None
+            self._reset = self.version
+        self.flush()
+
+    def flush(self):
+        """Write the latest version to the file if it has not been written yet."""
+        with self._io_lock:
+            with self._lock:
+                weights, version, reset = self.weights, self.version, self._reset
+                self._reset = None
+            pending = weights is not None and version != self._written
+            if not pending and reset is None:
+                return
+            try:
+                with h5py.File(self.path, 'a') as h5f:
+                    if 'weights' not in h5f:
+                        self._create(h5f)
+                    if pending:
+                        snapshots, versions = h5f['weights'], h5f['versions']
+                        snapshots.resize(len(snapshots) + 1, axis=0)
+                        versions.resize(len(versions) + 1, axis=0)
+                        snapshots[-1], versions[-1] = weights, version
+                    if reset is not None:
+                        h5f.attrs['reset'] = reset
+                self._written = version
+            except:
+                print('Unexpected error:', sys.exc_info()[0])
+            with self._lock:
+                if self.version == self._written:
+                    _pending.discard(self)
+
+    def close(self):
+        """Stop the writer thread and write the latest version."""
+        self._closed = True
+        self._wake.set()
+        writer = self._writer
+        if writer is not None and writer is not threading.current_thread():
+            writer.join()
+        self.flush()
+
+    def _run(self):
+        while not self._closed:
+            self._wake.wait(self.interval)
+            self.flush()
+            with self._lock:
+                if self.version == self._written:
+                    # Nothing left to write, the thread does not keep the store alive
+                    self._writer = None
+                    return
+        with self._lock:
+            self._writer = None
+
+    def _create(self, h5f):
+        shape = (output_layer_size, input_layer_size)
+        h5f.create_dataset('weights', (0,) + shape, maxshape=(None,) + shape, chunks=(1,) + shape, dtype=float)
+        h5f.create_dataset('versions', (0,), maxshape=(None,), chunks=(1024,), dtype=np.int64)
+        h5f.attrs['reset'] = -1
+        if self.path != self.source:
+            # The weights of the model file are version 0, the file itself is left as it is
+            print('Checkpoint the weights of %s to %s' % (self.source, self.path))
+            with h5py.File(self.source, 'r') as source:
+                legacy = np.array(source['w'])
+            h5f.attrs['source'] = self.source
+            h5f['weights'].resize(1, axis=0)
+            h5f['versions'].resize(1, axis=0)
+            h5f['weights'][0], h5f['versions'][0] = legacy, 0
+
+    def _read(self, version=None):
+        """Read a version from the file, the latest one after the last reset if version is None.
+        :return: weights, version or None, 0 if there is no such version
+        """
+        with self._io_lock:
+            # Until the first checkpoint the weights are those of the model file
+            path = self.path if self.path == self.source or os.path.exists(self.path) else self.source
+            try:
+                with h5py.File(path, 'r') as h5f:
+                    if 'weights' not in h5f:
+                        return (np.array(h5f['w']), 0) if 'w' in h5f and version in (None, 0) else (None, 0)
+                    versions = h5f['versions'][()]
+                    if version is None:
+                        reset = int(h5f.attrs['reset'])
+                        if len(versions) == 0 or versions[-1] <= reset:
+                            return None, max(reset, 0)
+                        index = len(versions) - 1
+                    else:
+                        index = np.searchsorted(versions, version)
+                        if index == len(versions) or versions[index] != version:
+                            return None, 0
+                    return h5f['weights'][index], int(versions[index])
+            except IOError as _:
+                return None, 0
+            except:
+                print('Unexpected error:', sys.exc_info()[0])
+                return None, 0
+
+
+@atexit.register
+def _flush_stores():
+    for store in list(_pending):
+        store.close()
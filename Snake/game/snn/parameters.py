@@ -5,6 +5,14 @@ default_dir = './game/snn/'					# Default dir if scrips are called without dir
 weights_file = 'weights.h5'					# Trained weights
 training_file = 'training_data.h5'			# Results from training
 evaluation_file = 'evaluation_data.h5'		# Results from evaluation
+checkpoint_interval = 10.			# Seconds between two background writes of the weights, 0 writes every update
+stats_sample_every = 1				# Record the weights for the statistics every k steps
+stats_record = True				# Stream the sampled weights to the training file
+stats_chunk_size = 1024				# Samples kept in memory before they are appended to the training file
+stats_max_points = 10000			# Samples of the decimated overview used for plotting
+
+# Simulation backend
+backend = 'nest'					# 'nest' or 'numpy' (pure NumPy simulation without NEST)
 
 # Network parameters
 input_layer_size = 6
@@ -14,6 +22,25 @@ forward_neuron = 1
 right_neuron = 2
 
 sim_time_step = 50.0				# Length of network simulation during each step in ms
+# A fused window clears the STDP traces of the previous input before the next one with the numpy backend.
+# NEST keeps them inside its synapses and neurons and does not let them be set, they only decay during
+# fused_reward_gap: with tau_plus = tau_minus = 20 ms a gap of 20 ms leaves exp(-1) = 37% of them, so
+# fused windows with NEST learn differently from the numpy backend and the agent warns about it.
+fused_reward = False				# Deliver the reward in the decision window instead of a separate one
+fused_reward_gap = 20.				# Quiet time before the input of a fused window in ms, lets the STDP traces decay
+reward_aggregation = 'mean'			# Reward delivered to the network: 'mean' of the last reward_window rewards or 'discounted'
+reward_window = 1					# Number of rewards in the rolling mean, 1 delivers every reward as it is
+reward_discount = 0.5				# Weight of the previous rewards in the exponentially discounted average
+adaptive_decision = False			# End the decision window early once an output neuron leads by decision_margin spikes
+decision_margin = 3					# Lead in spikes of the winning output neuron that ends an adaptive window
+decision_chunk = 5.					# Simulation time between two checks of the lead in ms
+decision_flush = 2.					# Simulation time after the input stopped until its last spikes arrived in ms
+decision_max_time = sim_time_step	# Hard cap of an adaptive window in ms, a full window by default
+decision_cache = False				# Serve decisions for known inputs from an LRU cache instead of simulating them
+decision_cache_size = 1024			# Entries of the decision cache
+decision_cache_samples = 5			# Simulated decisions of an entry before it serves decisions
+decision_cache_resolution = 0.005		# Quantization of the cache keys, the prepared raycasts step in 0.005
+decision_cache_tolerance = 1.		# Change of a weight since the last weight version that starts a new one
 V_reset = -70.						# Reset pontential of the membrane in mV
 t_ref = 2.							# Refractory period in ms
 time_resolution = 0.01				# Network simulation time resolution in ms
@@ -26,6 +53,35 @@ nest_kernel_status = {				# Nest Kernel initialization options
 	"resolution": time_resolution
 }
 
+# Precision profiles, they bundle the settings that trade the accuracy of the simulation for speed
+precision_profiles = {
+	"reference": {"time_resolution": 0.01, "local_num_threads": 1, "sim_time_step": 50., "max_poisson_freq": 1000.},
+	"coarse": {"time_resolution": 0.1, "local_num_threads": 1, "sim_time_step": 50., "max_poisson_freq": 1000.},
+	# Half the input time at twice the rate, the number of input spikes stays the same
+	"fast": {"time_resolution": 0.1, "local_num_threads": 1, "sim_time_step": 30., "max_poisson_freq": 2000.},
+}
+precision_profile = "reference"
+
+
+def use_precision_profile(name):
+	"""Apply a precision profile and update the settings derived from it.
+	The SNN backends read these settings whenever they use them. NEST applies the resolution and the number
+	of threads when the first network is created, so with NEST this has to be called before.
+	:param name: Name of the profile in precision_profiles
+	"""
+	global precision_profile, time_resolution, sim_time_step, max_poisson_freq, n_max, decision_max_time
+	profile = precision_profiles[name]
+	full_window = decision_max_time == sim_time_step
+	precision_profile = name
+	time_resolution = profile["time_resolution"]
+	sim_time_step = profile["sim_time_step"]
+	max_poisson_freq = profile["max_poisson_freq"]
+	n_max = float(sim_time_step//t_ref)
+	if full_window:
+		decision_max_time = sim_time_step
+	nest_kernel_status["local_num_threads"] = profile["local_num_threads"]
+	nest_kernel_status["resolution"] = time_resolution
+
 # R-STDP parameters
 w_min = 0.							# Minimum weight value in mV
 w_max = 3000.						# Maximum weight value in mV
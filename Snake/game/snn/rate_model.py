@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+
+import math
+import h5py
+import numpy as np
+
+from .parameters import *
+from . import parameters as params
+from .numpy_snn import neuron_params
+from .checkpoint import WeightStore
+
+# Analytic inference for a network whose weights are frozen, no spikes are simulated.
+# Every output neuron is an iaf_psc_alpha neuron driven by independent Poisson inputs. Its free membrane
+# potential has the mean mu and the variance sigma^2 / 2 of shot noise with the alpha PSP kernel, and its
+# stationary firing rate follows from the Siegert formula of the diffusion approximation:
+#   1 / rate = t_ref + tau_m * sqrt(pi) * integral from (V_reset - mu) / sigma to (V_th - mu) / sigma of erfcx(-u) du
+# Threshold and reset are shifted by sigma * synaptic_shift * sqrt(tau_syn / tau_m) for the filtering by the
+# synaptic current (Fourcaud & Brunel (2002). Dynamics of the firing probability of noisy integrate-and-fire
+# neurons. Neural Comput., 14(9), 2057-2110). The integral of erfcx is tabulated once, so a decision is a handful
+# of NumPy operations on arrays of the size of the layers.
+
+siegert_min = -6.                   # Lower end of the table, below the integrand is 1 / (sqrt(pi) * |u|)
+siegert_max = 12.                   # Upper end, a neuron whose threshold is further above the mean does not fire
+siegert_points = 20001              # Points of the table
+synaptic_shift = 1.0326             # |zeta(1/2)| / sqrt(2)
+psp_resolution = 0.01               # Time step in ms of the numerical integral of the squared PSP kernel
+
+_siegert_table = []                 # Points and integral of erfcx(-u) from siegert_min, computed on first use
+
+
+def siegert_integral(y):
+    """Integral of erfcx(-u) = exp(u^2) * erfc(-u) from siegert_min to y.
+    :param y: Upper limits, at most siegert_max
+    :return: Integral for each limit, negative below siegert_min
+    """
+    if not _siegert_table:
+        u = np.linspace(siegert_min, siegert_max, siegert_points)
+        g = np.exp(u * u) * np.array([math.erfc(-v) for v in u])
+        _siegert_table.extend([u, np.concatenate([[0.], np.cumsum((g[1:] + g[:-1]) / 2. * np.diff(u))])])
+    u, integral = _siegert_table
+    y = np.asarray(y, dtype=float)
+    # Far below the table erfcx(-u) is 1 / (sqrt(pi) * |u|), its integral is a logarithm
+    tail = (math.log(-siegert_min) - np.log(-np.minimum(y, siegert_min))) / math.sqrt(math.pi)
+    return np.where(y < siegert_min, tail, np.interp(y, u, integral))
+
+
+def squared_psp_integral(tau_syn, neuron):
+    """Integral of the squared membrane response to a single 1 pA alpha shaped synaptic current.
+    :param tau_syn: Rise time of the synaptic current in ms
+    :param neuron: iaf_psc_alpha parameters
+    :return: Integral in mV^2 ms
+    """
+    tau_m, C_m = neuron["tau_m"], neuron["C_m"]
+    t = np.arange(int(round(20 * max(tau_m, tau_syn) / psp_resolution))) * psp_resolution
+    a = 1. / tau_syn - 1. / tau_m
+    if abs(a) < 1e-12:
+        response = t * t / 2.
+    else:
+        response = (1. - np.exp(-a * t) * (1. + a * t)) / (a * a)
+    psp = np.e / (tau_syn * C_m) * np.exp(-t / tau_m) * response
+    return np.sum(psp * psp) * psp_resolution
+
+
+class RateModel(object):
+    """Expected spike counts of the output neurons of a network with frozen weights, see the comment above.
+    The counts are those of a decision window of the SNN: the inputs fire at input * max_rate for the
+    window - 10 ms of the window in which the backends stimulate the network.
+    """
+
+    def __init__(self, weights, neuron=None, window=None, max_rate=None):
+        self.weights = np.array(weights, dtype=float)
+        self.neuron = dict(neuron_params if neuron is None else neuron)
+        # The window and the rate of the precision profile in use, like the backends read them
+        self.window = float(params.sim_time_step if window is None else window)
+        self.max_rate = float(params.max_poisson_freq if max_rate is None else max_rate)
+        self.input_time = self.window - 10.
+
+        # Contribution of one input spike per ms to the mean and to the variance of each output neuron
+        neuron = self.neuron
+        tau_syn = np.where(self.weights >= 0, neuron["tau_syn_ex"], neuron["tau_syn_in"])
+        kernel = np.where(self.weights >= 0, squared_psp_integral(neuron["tau_syn_ex"], neuron),
+                          squared_psp_integral(neuron["tau_syn_in"], neuron))
+        self._mean = self.weights * np.e * tau_syn * neuron["tau_m"] / neuron["C_m"]
+        self._variance = self.weights * self.weights * kernel
+        self._shift = synaptic_shift * np.sqrt(tau_syn.max() / neuron["tau_m"])
+
+    def rates(self, inputs):
+        """Stationary firing rates of the output neurons.
+        :param inputs: Activity of the input neurons in [0, 1], like SnakeSNN.set_input
+        :return: Rates in spikes per ms
+        """
+        neuron = self.neuron
+        input_rates = np.clip(inputs, 0, 1) * (self.max_rate / 1000.)
+        mu = neuron["E_L"] + self._mean.dot(input_rates)
+        sigma = np.sqrt(2. * self._variance.dot(input_rates)) + 1e-9
+        shift = sigma * self._shift
+        upper = (neuron["V_th"] + shift - mu) / sigma
+        lower = (neuron["V_reset"] + shift - mu) / sigma
+        silent = upper > siegert_max
+        upper = np.minimum(upper, siegert_max)
+        interval = neuron["t_ref"] + neuron["tau_m"] * math.sqrt(math.pi) * (siegert_integral(upper) - siegert_integral(lower))
+        return np.where(silent, 0., 1. / interval)
+
+    def expected_counts(self, inputs):
+        """Expected number of spikes of the output neurons in a decision window.
+        :param inputs: Activity of the input neurons in [0, 1], like SnakeSNN.set_input
+        :return: Array of output_layer_size counts
+        """
+        return self.rates(inputs) * self.input_time
+
+    def save(self, path):
+        """Write the policy: the weights in the layout of save_model, so every agent can load them, and the
+        settings of the model as attributes.
+        :param path: File to write
+        """
+        with h5py.File(path, 'w') as h5f:
+            h5f.create_dataset('w', data=self.weights)
+            h5f.attrs.update(self.neuron)
+            h5f.attrs['window'] = self.window
+            h5f.attrs['max_rate'] = self.max_rate
+
+    @classmethod
+    def load(cls, path):
+        """Create the model from a policy written by save or from the latest weights of a weights file.
+        The settings of a weights file are taken from the parameters.
+        :param path: Policy or weights file
+        :return: RateModel
+        """
+        store = WeightStore(path)
+        weights = store.latest()
+        store.close()
+        if weights is None:
+            raise ValueError('No weights in %s' % path)
+        with h5py.File(path, 'r') as h5f:
+            attrs = dict(h5f.attrs)
+        if 'window' not in attrs:
+            return cls(weights)
+        neuron = {key: float(attrs[key]) for key in neuron_params}
+        return cls(weights, neuron, attrs['window'], attrs['max_rate'])
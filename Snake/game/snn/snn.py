@@ -1,16 +1,39 @@
 #!/usr/bin/env python
 
 import sys
+import itertools
 import nest
 import h5py
 import numpy as np
 
 from .parameters import *
+from . import parameters as params
 
-print("Reset NEST kernel")
-nest.set_verbosity('M_WARNING')
-nest.ResetKernel()
-nest.SetKernelStatus(nest_kernel_status)
+_simulations = 0    # Number of nest_simulate calls, weights read before the last call are outdated
+_synapse_models = 0 # Number of R-STDP synapse models copied for the networks in the kernel
+_kernel_ready = False
+
+
+def init_kernel():
+    """Reset the NEST kernel and apply nest_kernel_status, done once when the first network is created."""
+    global _kernel_ready
+    if _kernel_ready:
+        return
+    print("Reset NEST kernel")
+    nest.set_verbosity('M_WARNING')
+    nest.ResetKernel()
+    nest.SetKernelStatus(nest_kernel_status)
+    _kernel_ready = True
+
+
+def reset_kernel():
+    """Remove all networks from the NEST kernel, networks created before must not be used any more.
+    Use SnakeSNN.reinitialize to start over with a network instead, it adds no nodes to the kernel.
+    """
+    global _kernel_ready, _synapse_models
+    _kernel_ready = False
+    _synapse_models = 0
+    init_kernel()
 
 
 def create_input_layer(n):
@@ -46,9 +69,13 @@ def create_output_layer(n):
 def connect_all_to_all_r_stdp(first_layer, second_layer):
     """Connect the first layer to the second layer with stdp dopamine synapses (r-stdp).
     The layers are connected all to all method.
+    Every call copies the synapse model with its own volume transmitter, the volume transmitter and
+    the R-STDP parameters are common to all synapses of a model and would otherwise be shared by
+    all networks in the kernel.
     :param first_layer: The neurons of the first layer
     :param second_layer: The neurons of the second layer
     """
+    global _synapse_models
     vt = nest.Create("volume_transmitter")
     r_stdp_synapse_defaults = {
         "vt": vt[0],
@@ -59,24 +86,38 @@ def connect_all_to_all_r_stdp(first_layer, second_layer):
         "A_plus": A_plus,
         "A_minus": A_minus
     }
-    nest.SetDefaults("stdp_dopamine_synapse", r_stdp_synapse_defaults)
-    nest.Connect(first_layer, second_layer, "all_to_all", syn_spec=r_stdp_synapse_options)
+    model = "%s_%d" % (r_stdp_synapse_options["model"], _synapse_models)
+    _synapse_models += 1
+    nest.CopyModel(r_stdp_synapse_options["model"], model, r_stdp_synapse_defaults)
+    nest.Connect(first_layer, second_layer, "all_to_all", syn_spec=dict(r_stdp_synapse_options, model=model))
+
+
+def get_connections(first_layer, second_layer):
+    """Get the handles of all connections from the first to the second layer.
+    The handles are ordered by target and then by source, so values read from or written to them
+    can be reshaped to (len(second_layer), len(first_layer)).
+    :param first_layer: The neurons of the first layer
+    :param second_layer: The neurons of the second layer
+    :return: Tuple of connection handles
+    """
+    connections = nest.GetConnections(source=first_layer, target=second_layer)
+    order = np.lexsort((nest.GetStatus(connections, "source"), nest.GetStatus(connections, "target")))
+    return tuple(connections[i] for i in order)
 
 
-def set_inputs(spike_generators, inputs):
+def set_inputs(spike_generators, inputs, start=0.):
     """Reset the spike generators and set the inputs.
     The i-th input is assigned to the i-th spike_generator.
     All input values must be in [0;1]
+    Origin, start, stop and rates of all generators are sent in a single call.
     :param spike_generators: The spike generators
     :param inputs: Inputs for the network
+    :param start: Delay of the input from now in ms
     """
     time = nest.GetKernelStatus("time")
-    nest.SetStatus(spike_generators, {"origin": time})
-    nest.SetStatus(spike_generators, {"stop": sim_time_step - 10})
-
-    poisson_rates = np.multiply(np.clip(inputs, 0, 1), max_poisson_freq)
-    for i, r in enumerate(poisson_rates):
-        nest.SetStatus([spike_generators[i]], {"rate": r})
+    poisson_rates = np.multiply(np.clip(inputs, 0, 1), params.max_poisson_freq)
+    nest.SetStatus(spike_generators, [{"origin": time, "start": start, "stop": start + params.sim_time_step - 10, "rate": r}
+                                      for r in poisson_rates])
 
 
 def set_weights(connections, weights):
@@ -85,16 +126,16 @@ def set_weights(connections, weights):
     :param connections: Connections
     :param weights: Weights
     """
-    w = [{'weight': w} for w in weights.reshape(weights.size)]
-    nest.SetStatus(connections, w)
+    nest.SetStatus(connections, "weight", np.ravel(weights).tolist())
 
 
 def set_reward(connections, reward):
     """Set the dopamine level in connections to reward
+    Reward can be a single value or one value per connection.
     :param connections: The connections to be rewarded
     :param reward: The reward
     """
-    nest.SetStatus(connections, {"n": reward})
+    nest.SetStatus(connections, "n", np.ravel(reward).tolist() if np.ndim(reward) else reward)
 
 
 def get_dopamine(connections):
@@ -104,6 +145,22 @@ def get_dopamine(connections):
     return nest.GetStatus(connections, keys="n")
 
 
+def get_eligibility(connections):
+    """Get the eligibility traces of the connections
+    :param connections: The connections
+    :return: Numpy array of eligibility traces
+    """
+    return np.array(nest.GetStatus(connections, keys="c"))
+
+
+def set_eligibility(connections, eligibility):
+    """Set the eligibility traces of the connections, e.g. to values read before with get_eligibility
+    :param connections: The connections
+    :param eligibility: One eligibility trace per connection
+    """
+    nest.SetStatus(connections, "c", np.ravel(eligibility).tolist())
+
+
 def get_multimeter(multimeter):
     """Get the dopamine level in connections
     :param multimeter: The multimeter to get the voltage/spike information
@@ -119,10 +176,25 @@ def get_output(spike_detectors):
     """
     output = np.array(nest.GetStatus(spike_detectors, keys="n_events"))
     nest.SetStatus(spike_detectors, {"n_events": 0})
-    output = output / n_max
+    output = output / params.n_max
     return output
 
 
+def get_spike_counts(spike_detectors):
+    """Read the number of spikes from the spike detectors without resetting them.
+    :param spike_detectors: The spike detectors
+    :return: Number of spikes of each output neuron
+    """
+    return np.array(nest.GetStatus(spike_detectors, keys="n_events"))
+
+
+def stop_inputs(spike_generators):
+    """Stop the spike trains of the generators, spikes already sent still arrive.
+    :param spike_generators: The spike generators
+    """
+    nest.SetStatus(spike_generators, {"rate": 0.})
+
+
 def get_weights(connections):
     """Returns the weights of the connections
     :param connections:
@@ -131,10 +203,83 @@ def get_weights(connections):
     return np.array(nest.GetStatus(connections, keys="weight"))
 
 
-def nest_simulate():
+def nest_simulate(duration=None):
     """Simulate all networks
+    :param duration: Simulation time in ms, sim_time_step by default
     """
-    nest.Simulate(sim_time_step)
+    if duration is None:
+        duration = params.sim_time_step
+    global _simulations
+    nest.Simulate(duration)
+    _simulations += 1
+
+
+def reset_all(networks):
+    """Reset the neurons and spike detectors of several networks, one call for all of them.
+    :param networks: The networks
+    """
+    reset_status(tuple(itertools.chain.from_iterable(network.output_layer for network in networks)),
+                 tuple(itertools.chain.from_iterable(network.spike_detectors for network in networks)))
+
+
+def set_reward_all(networks, rewards):
+    """Set the reward of several networks in one call.
+    :param networks: The networks
+    :param rewards: One reward per output neuron for each network
+    """
+    set_reward(tuple(itertools.chain.from_iterable(network.connections for network in networks)),
+               np.repeat(np.ravel(rewards), input_layer_size))
+
+
+def set_input_all(networks, states, start=0.):
+    """Set the inputs of several networks in one call.
+    :param networks: The networks
+    :param states: One input per input neuron for each network
+    :param start: Delay of the input from now in ms
+    """
+    set_inputs(tuple(itertools.chain.from_iterable(network.spike_generators for network in networks)),
+               np.ravel(states), start)
+
+
+def get_output_all(networks):
+    """Read the normalized firing rates of several networks in one call and reset their spike detectors.
+    :param networks: The networks
+    :return: Array of shape (len(networks), output_layer_size)
+    """
+    spike_detectors = tuple(itertools.chain.from_iterable(network.spike_detectors for network in networks))
+    return get_output(spike_detectors).reshape(len(networks), output_layer_size)
+
+
+def get_spike_counts_all(networks):
+    """Read the number of spikes of several networks in one call without resetting them.
+    :param networks: The networks
+    :return: Array of shape (len(networks), output_layer_size)
+    """
+    spike_detectors = tuple(itertools.chain.from_iterable(network.spike_detectors for network in networks))
+    return get_spike_counts(spike_detectors).reshape(len(networks), output_layer_size)
+
+
+def stop_input_all(networks):
+    """Stop the inputs of several networks in one call.
+    :param networks: The networks
+    """
+    stop_inputs(tuple(itertools.chain.from_iterable(network.spike_generators for network in networks)))
+
+
+def get_weights_all(networks):
+    """Read the weights of several networks in one call, see SnakeSNN.get_weights.
+    :param networks: The networks
+    :return: List with the weights of the left, forward and right neuron for each network
+    """
+    outdated = [network for network in networks
+                if network._weights is None or network._weights_simulation != _simulations]
+    if outdated:
+        connections = tuple(itertools.chain.from_iterable(network.connections for network in outdated))
+        weights = get_weights(connections).reshape(len(outdated), output_layer_size, input_layer_size)
+        for network, w in zip(outdated, weights):
+            network._weights = [w[left_neuron], w[forward_neuron], w[right_neuron]]
+            network._weights_simulation = _simulations
+    return [network._weights for network in networks]
 
 
 def reset_status(neurons, spike_detectors):
@@ -148,40 +293,81 @@ def reset_status(neurons, spike_detectors):
 
 class SnakeSNN:
     def __init__(self):
+        init_kernel()
         self.spike_generators, self.input_layer = create_input_layer(input_layer_size)
         self.output_layer, self.spike_detectors = create_output_layer(output_layer_size)
         connect_all_to_all_r_stdp(self.input_layer, self.output_layer)
 
-        # Create connection handles
-        self.conn_l = nest.GetConnections(target=[self.output_layer[left_neuron]])
-        self.conn_f = nest.GetConnections(target=[self.output_layer[forward_neuron]])
-        self.conn_r = nest.GetConnections(target=[self.output_layer[right_neuron]])
+        # Create connection handles, ordered as (output neuron, input neuron)
+        self.connections = get_connections(self.input_layer, self.output_layer)
+        self._weights = None
+        self._weights_simulation = None
 
         #self.multimeter = nest.Create("multimeter", params={"withtime":True, "record_from":["V_m"]})
         #nest.Connect(self.multimeter, [self.output_layer[forward_neuron]])
 
+    def reinitialize(self):
+        """Draw new initial weights and clear the state of the network in place, without creating new nodes.
+        The eligibility traces, the dopamine, the inputs, the membrane potentials and the spike counts are reset.
+        """
+        synapse = r_stdp_synapse_options["weight"]
+        set_weights(self.connections, np.random.uniform(synapse["low"], synapse["high"], len(self.connections)))
+        nest.SetStatus(self.connections, {"c": 0., "n": 0.})
+        stop_inputs(self.spike_generators)
+        reset_status(self.output_layer, self.spike_detectors)
+        self._weights = None
+
     def reset_neurons(self):
         reset_status(self.output_layer, self.spike_detectors)
 
     def set_reward(self, reward):
-        set_reward(self.conn_l, reward[left_neuron])
-        set_reward(self.conn_f, reward[forward_neuron])
-        set_reward(self.conn_r, reward[right_neuron])
+        set_reward(self.connections, np.repeat(reward, input_layer_size))
+
+    def reset_traces(self):
+        """Forget the STDP traces of the spikes before, the eligibility traces are kept for the reward.
+        NEST keeps the traces inside stdp_dopamine_synapse and the neurons and does not let them be set,
+        here they only decay during the quiet gap of a fused window, see fused_reward in parameters.py.
+        """
+        pass
+
+    def get_eligibility(self):
+        return get_eligibility(self.connections)
 
-    def set_input(self, state):
-        set_inputs(self.spike_generators, state)
+    def set_eligibility(self, eligibility):
+        set_eligibility(self.connections, eligibility)
+
+    def set_input(self, state, start=0.):
+        set_inputs(self.spike_generators, state, start)
+
+    def stop_input(self):
+        stop_inputs(self.spike_generators)
 
     def set_weights(self, weights_l, weights_f, weights_r):
-        set_weights(self.conn_l, weights_l)
-        set_weights(self.conn_f, weights_f)
-        set_weights(self.conn_r, weights_r)
+        weights = np.zeros((output_layer_size, input_layer_size))
+        weights[left_neuron] = weights_l
+        weights[forward_neuron] = weights_f
+        weights[right_neuron] = weights_r
+        set_weights(self.connections, weights)
+        self._weights = None
+
+    def get_output(self):
+        return get_output(self.spike_detectors)
+
+    def get_spike_counts(self):
+        return get_spike_counts(self.spike_detectors)
+
+    def get_weights(self):
+        """Return the weights of the left, forward and right neuron.
+        The weights are only read from NEST again if the network has been simulated since the last read.
+        """
+        if self._weights is None or self._weights_simulation != _simulations:
+            weights = get_weights(self.connections).reshape(output_layer_size, input_layer_size)
+            self._weights = [weights[left_neuron], weights[forward_neuron], weights[right_neuron]]
+            self._weights_simulation = _simulations
+        return self._weights
 
     def get_results(self):
-        output = get_output(self.spike_detectors)
-        weights_l = get_weights(self.conn_l)
-        weights_f = get_weights(self.conn_f)
-        weights_r = get_weights(self.conn_r)
-        return output, [weights_l, weights_f, weights_r]
+        return self.get_output(), self.get_weights()
 
     def try_restore_model(self, model=None):
         try:
@@ -196,11 +382,13 @@ class SnakeSNN:
         except:
             print('Unexpected error:', sys.exc_info()[0])
 
-        return self.get_results()[1:]
+        return self.get_weights()
 
-    def save_model(self, model):
+    def save_model(self, model, path=None):
         try:
-            with h5py.File(default_dir + weights_file, 'w') as h5f:
+            path = default_dir + weights_file if path is None else path
+
+            with h5py.File(path, 'w') as h5f:
                 h5f.create_dataset('w', data=model)
                 h5f.close()
         except:
@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+
+import sys
+import json
+import time
+import random
+import shutil
+import tempfile
+import multiprocessing
+import numpy as np
+
+import server
+
+
+def parse_command_line_args(args):
+    """ Parse command-line arguments and organize them into a single structured object. """
+
+    import argparse
+    from game.snn import parameters
+
+    parser = argparse.ArgumentParser(
+        description='Compare the decisions and the speed of the precision profiles and of the rate model.')
+
+    parser.add_argument(
+        '--profiles',
+        type=str,
+        nargs='+',
+        choices=sorted(parameters.precision_profiles),
+        help='Profiles to compare (default: all).',
+    )
+    parser.add_argument(
+        '--reference',
+        type=str,
+        default='reference',
+        choices=sorted(parameters.precision_profiles),
+        help='Profile whose decisions the others are compared with.',
+    )
+    parser.add_argument(
+        '--backend',
+        type=str,
+        choices=['nest', 'numpy'],
+        help='Simulation backend of the SNN (default from game/snn/parameters.py).',
+    )
+    parser.add_argument(
+        '--observations',
+        type=int,
+        default=50,
+        help='Number of observations recorded from random play.',
+    )
+    parser.add_argument(
+        '--weights',
+        type=int,
+        default=5,
+        help='Number of weight states, the initial weights and random ones.',
+    )
+    parser.add_argument(
+        '--model',
+        type=str,
+        nargs='+',
+        default=[],
+        help='Weights files of trained agents, their latest weights are compared as well.',
+    )
+    parser.add_argument(
+        '--repeats',
+        type=int,
+        default=10,
+        help='Decisions per observation and weight state, the input spike trains are random.',
+    )
+    parser.add_argument(
+        '--output',
+        type=str,
+        default='precision.json',
+        help='JSON file to write the results to.',
+    )
+    parser.add_argument(
+        '--seed',
+        type=int,
+        default=0,
+        help='The seed for random events.',
+    )
+
+    return parser.parse_args(args)
+
+
+def record_observations(num_observations):
+    """ Observations of the 2D environment along the episodes of a random agent. """
+    server.game2D = True
+    env = server.create_snake_environment()
+    timestep = env.new_episode()
+    observations = []
+    while len(observations) < num_observations:
+        observations.append(list(timestep.observation))
+        env.choose_action(random.choice([0, 1, 2]))
+        timestep = env.timestep()
+        if timestep.is_episode_end:
+            timestep = env.new_episode()
+    return np.array(observations)
+
+
+def record_weights(num_weights):
+    """ The initial weights of the network followed by random weights, one (3, input_layer_size) array each. """
+    from game.snn import parameters
+
+    shape = (parameters.output_layer_size, parameters.input_layer_size)
+    weights = [np.random.uniform(parameters.w0_min, parameters.w0_max, shape)]
+    while len(weights) < num_weights:
+        weights.append(np.random.uniform(parameters.w_min, parameters.w_max, shape))
+    return np.array(weights)
+
+
+def replay(profile, backend, observations, weights, repeats, seed):
+    """
+    Decide for every weight state and observation repeats times with the given profile in this process.
+
+    The reward stays 0, so the network does not learn and every decision sees the same weights.
+
+    Returns:
+        The actions with shape (weight states, observations, repeats) and the duration of every decision in seconds.
+    """
+    from game.snn import parameters
+    if backend is not None:
+        parameters.backend = backend
+    parameters.use_precision_profile(profile)
+    # NEST draws the spike trains from its own generators
+    threads = parameters.nest_kernel_status['local_num_threads']
+    parameters.nest_kernel_status.update(grng_seed=seed, rng_seeds=list(range(seed + 1, seed + 1 + threads)))
+    server.game2D = True
+    server.use_seed(seed)
+
+    from game.agent import SNNAgent2D, simulate_decision
+    model_dir = tempfile.mkdtemp(prefix='snake-precision-')
+    try:
+        agent = SNNAgent2D(model_dir + '/' + parameters.weights_file, 0)
+        actions = np.zeros((len(weights), len(observations), repeats), dtype=int)
+        times = []
+        for i, w in enumerate(weights):
+            for j, observation in enumerate(observations):
+                agent.snn.set_weights(*w)
+                agent.snn.set_reward([0.] * parameters.output_layer_size)
+                for k in range(repeats):
+                    start = time.perf_counter()
+                    agent.snn.set_input(agent.prepare_input(observation))
+                    agent.snn.reset_neurons()
+                    simulate_decision([agent.snn])
+                    actions[i, j, k] = agent.prepare_output(agent.snn.get_output())
+                    times.append(time.perf_counter() - start)
+        agent.store.close()
+    finally:
+        shutil.rmtree(model_dir, ignore_errors=True)
+    return actions, times
+
+
+def replay_rate(profile, observations, weights, repeats):
+    """
+    Decide like replay with the rate model of the weights and the settings of the profile.
+
+    Returns:
+        The actions with shape (weight states, observations, repeats) and the duration of every decision in seconds.
+    """
+    from game.snn import parameters
+    from game.snn.rate_model import RateModel
+    from game.agent import RateAgent2D
+
+    settings = parameters.precision_profiles[profile]
+    actions = np.zeros((len(weights), len(observations), repeats), dtype=int)
+    times = []
+    for i, w in enumerate(weights):
+        agent = RateAgent2D(RateModel(w, window=settings['sim_time_step'], max_rate=settings['max_poisson_freq']), 0)
+        for j, observation in enumerate(observations):
+            for k in range(repeats):
+                start = time.perf_counter()
+                actions[i, j, k] = agent.act(observation, 0)
+                times.append(time.perf_counter() - start)
+    return actions, times
+
+
+def run_replay(*args):
+    """ Run replay in a new process, every profile needs its own kernel. """
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(1) as pool:
+        return pool.apply(replay, args)
+
+
+def agreement(actions, reference):
+    """
+    Compare the decisions of a profile with the reference.
+
+    Returns:
+        The share of the observations and weight states on which the most frequent action is the same, and the
+        mean overlap of the distributions of the actions (1 if they choose every action equally often).
+    """
+    counts = np.stack([(actions == action).sum(axis=-1) for action in range(3)], axis=-1)
+    reference_counts = np.stack([(reference == action).sum(axis=-1) for action in range(3)], axis=-1)
+    same_mode = np.argmax(counts, axis=-1) == np.argmax(reference_counts, axis=-1)
+    overlap = np.minimum(counts, reference_counts).sum(axis=-1) / actions.shape[-1]
+    return np.mean(same_mode), np.mean(overlap)
+
+
+def main():
+    args = parse_command_line_args(sys.argv[1:])
+    from game.snn import parameters
+
+    random.seed(args.seed)
+    np.random.seed(args.seed)
+    observations = record_observations(args.observations)
+    weights = record_weights(args.weights)
+    if args.model:
+        from game.snn.checkpoint import WeightStore
+        trained = [WeightStore(path).latest() for path in args.model]
+        weights = np.concatenate([weights, [w for w in trained if w is not None]])
+    profiles = args.profiles or sorted(parameters.precision_profiles)
+
+    # All profiles are compared on other spike trains than the reference run. The reference with other spike
+    # trains shows the agreement that any profile can reach at best.
+    other_seed = args.seed + 1000
+    runs = [(args.reference, args.seed), (args.reference, other_seed)]
+    runs += [(profile, other_seed) for profile in profiles if profile != args.reference]
+    replays = {}
+    for profile, seed in runs:
+        print('Replaying %d decisions with profile %s' % (weights.shape[0] * len(observations) * args.repeats, profile))
+        replays[profile, seed] = run_replay(profile, args.backend, observations, weights, args.repeats, seed)
+    print('Deciding with the rate model of profile %s' % args.reference)
+    replays['rate model', None] = replay_rate(args.reference, observations, weights, args.repeats)
+
+    reference_actions, reference_times = replays[args.reference, args.seed]
+    print('============================')
+    print('{:20s} {:>10s} {:>8s} {:>9s} {:>7s} {:>12s} {:>8s} {:>10s} {:>8s}'.format(
+        'profile', 'resolution', 'window', 'rate', 'threads', 'ms/decision', 'speedup', 'same mode', 'overlap'))
+    report = {}
+    for (profile, seed), (actions, times) in replays.items():
+        if (profile, seed) == (args.reference, args.seed):
+            continue
+        name = profile + ' (repeat)' if profile == args.reference else profile
+        same_mode, overlap = agreement(actions, reference_actions)
+        # The rate model uses the window and the input rate of the reference, it does not simulate
+        settings = parameters.precision_profiles.get(profile, dict(parameters.precision_profiles[args.reference],
+                                                                   time_resolution=0., local_num_threads=0))
+        report[name] = dict(settings, ms_per_decision=1000 * np.mean(times),
+                            speedup=np.mean(reference_times) / np.mean(times), same_mode=same_mode, overlap=overlap)
+        print('{:20s} {:10.2f} {:8.1f} {:9.0f} {:7d} {:12.3f} {:7.2f}x {:10.1%} {:8.1%}'.format(
+            name, settings['time_resolution'], settings['sim_time_step'], settings['max_poisson_freq'],
+            settings['local_num_threads'], report[name]['ms_per_decision'], report[name]['speedup'], same_mode, overlap))
+    print('The repeat of %s shows how much two runs of the same profile agree, the spike trains are random.' % args.reference)
+    print('The rate model decides on the expected spike counts, without spike trains.')
+
+    with open(args.output, 'w') as f:
+        json.dump({
+            'metadata': {
+                'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'backend': args.backend or parameters.backend,
+                'reference': args.reference,
+                'reference_ms_per_decision': 1000 * np.mean(reference_times),
+                'observations': len(observations),
+                'weights': len(weights),
+                'repeats': args.repeats,
+            },
+            'results': report,
+        }, f, indent=2, sort_keys=True)
+    print('Results written to %s' % args.output)
+
+
+if __name__ == '__main__':
+    main()
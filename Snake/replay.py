@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+
+import sys
+import time
+
+import server
+
+
+def parse_command_line_args(args):
+    """ Parse command-line arguments and organize them into a single structured object. """
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Train the SNN offline on trajectories recorded with server.py --record.')
+
+    parser.add_argument(
+        'trajectories',
+        type=str,
+        nargs='+',
+        help='Trajectory files to replay.',
+    )
+    parser.add_argument(
+        '--model',
+        type=str,
+        help='Weights file to continue from and to write to (default game/snn/weights.h5).',
+    )
+    parser.add_argument(
+        '--passes',
+        type=int,
+        default=1,
+        help='How often all trajectories are replayed.',
+    )
+    parser.add_argument(
+        '--forget',
+        action='store_true',
+        help='Start from initial weights instead of the weights of --model.',
+    )
+    parser.add_argument(
+        '--backend',
+        type=str,
+        choices=['nest', 'numpy'],
+        help='Simulation backend of the SNN (default from game/snn/parameters.py).',
+    )
+    parser.add_argument(
+        '--fused',
+        action='store_true',
+        help='Deliver the reward and the next input in one simulation window.',
+    )
+    parser.add_argument(
+        '--seed',
+        type=int,
+        help='The seed for random events.',
+    )
+
+    return parser.parse_args(args)
+
+
+def main():
+    args = parse_command_line_args(sys.argv[1:])
+    from game.snn import parameters
+
+    if args.seed is not None:
+        server.use_seed(args.seed)
+    if args.backend is not None:
+        parameters.backend = args.backend
+
+    from game.agent import SNNAgent, train_offline
+    # The recorded inputs are prepared already, so the agent for 1D and 2D is the same
+    agent = SNNAgent(args.model, 0, True if args.fused else None)
+    if args.forget:
+        agent.reset_agent(forget=True)
+
+    for i in range(args.passes):
+        start = time.time()
+        episodes, steps = train_offline(agent, args.trajectories)
+        duration = time.time() - start
+        print('Pass {:3d} / {:3d} | Episodes {:5d} | Steps {:7d} | {:.0f} steps/s'.format(
+            i + 1, args.passes, episodes, steps, steps / duration))
+        print('W_L-F-R: %s-%s-%s' % tuple(server.print_me(w, '4.0f') for w in agent.w))
+
+    agent.store.close()
+    agent.stats.flush()
+    print('Weights written to %s' % agent.store.path)
+
+
+if __name__ == '__main__':
+    main()
@@ -4,6 +4,11 @@ import sys
 import numpy as np
 from game.utils import print_me
 import os
+import queue
+import random
+import shutil
+import tempfile
+import multiprocessing
 
 game2D = False
 
@@ -11,6 +16,7 @@ def parse_command_line_args(args):
     """ Parse command-line arguments and organize them into a single structured object. """
 
     import argparse
+    from game.snn import parameters
 
     parser = argparse.ArgumentParser()
 
@@ -18,14 +24,30 @@ def parse_command_line_args(args):
         '--agent',
         type=str,
         default="snn",
-        choices=['human', 'random', 'snn'],
-        help='Player agent to use.',
+        choices=['human', 'random', 'snn', 'rate'],
+        help='Player agent to use, rate acts with the frozen weights of --model without simulating the SNN.',
+    )
+    parser.add_argument(
+        '--backend',
+        type=str,
+        choices=['nest', 'numpy'],
+        help='Simulation backend of the SNN (default from game/snn/parameters.py).',
     )
     parser.add_argument(
         '--model',
         type=str,
         help='File containing a pre-trained agent model.',
     )
+    parser.add_argument(
+        '--export-policy',
+        type=str,
+        help='Write the frozen weights of --model with the settings of the rate model to this file and exit.',
+    )
+    parser.add_argument(
+        '--record',
+        type=str,
+        help='Append every step (observation, SNN input, reward, action) to this trajectory file for ./replay.py.',
+    )
     parser.add_argument(
         '--num-episodes',
         type=int,
@@ -48,6 +70,59 @@ def parse_command_line_args(args):
         action='store_true',
         help='Disables GUI for fast training.',
     )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        help='Number of processes running the runs of --test in parallel (default: number of CPUs).',
+    )
+    parser.add_argument(
+        '--population',
+        type=int,
+        help='Train this many fresh networks in lockstep in one process, each in its own 2D environment.',
+    )
+    parser.add_argument(
+        '--precision',
+        type=str,
+        choices=sorted(parameters.precision_profiles),
+        help='Precision profile of the simulation, see precision_profiles in game/snn/parameters.py.',
+    )
+    parser.add_argument(
+        '--threads',
+        type=int,
+        help='Number of threads of the NEST kernel (default from the precision profile).',
+    )
+    parser.add_argument(
+        '--fused',
+        action='store_true',
+        help='Deliver the reward and the next input in one simulation window.',
+    )
+    parser.add_argument(
+        '--adaptive',
+        action='store_true',
+        help='End every decision window as soon as an output neuron leads by decision_margin spikes.',
+    )
+    parser.add_argument(
+        '--cache',
+        action='store_true',
+        help='Draw the decisions for inputs seen before with the same weights from a cache instead of simulating them.',
+    )
+    parser.add_argument(
+        '--validate-fused',
+        action='store_true',
+        help='With --test, run the test with and without --fused and compare the learning curves.',
+    )
+    parser.add_argument(
+        '--equivalence-margin',
+        type=float,
+        default=0.5,
+        help='With --validate-fused, largest difference of the fruits per episode that counts as equivalent.',
+    )
+    parser.add_argument(
+        '--late-decision',
+        type=str,
+        choices=['wait', 'repeat', 'skip'],
+        help='Let the agent act on a background thread in the GUI and wait for, repeat or skip late decisions.',
+    )
     parser.add_argument(
         '--two-d',
         action='store_true',
@@ -67,6 +142,20 @@ def parse_command_line_args(args):
     return parser.parse_args(args)
 
 
+level_map2D = ["#############",
+               "#...........#",
+               "#...........#",
+               "#...........#",
+               "#...........#",
+               "#...........#",
+               "#.....S.....#",
+               "#...........#",
+               "#...........#",
+               "#...........#",
+               "#...........#",
+               "#...........#",
+               "#############"]
+
 def create_snake_environment():
     """ Create a new Snake environment. """
 
@@ -74,35 +163,34 @@ def create_snake_environment():
 
     global game2D
     if game2D:
-        return Environment2D(level_map=["#############", 
-                                        "#...........#", 
-                                        "#...........#", 
-                                        "#...........#", 
-                                        "#...........#", 
-                                        "#...........#", 
-                                        "#.....S.....#", 
-                                        "#...........#", 
-                                        "#...........#", 
-                                        "#...........#", 
-                                        "#...........#", 
-                                        "#...........#", 
-                                        "#############"])
+        return Environment2D(level_map=level_map2D)
     else:
         return Environment()
 
-def create_agent(name, model=None, verbose=0):
+def record_environment(env, path):
+    """ Wrap the environment, so its steps are recorded to the trajectory file at path. """
+
+    from game.agent import SNNAgent, SNNAgent2D
+    from game.environment import RecordingEnvironment
+    from game.utils import TrajectoryRecorder
+
+    global game2D
+    return RecordingEnvironment(env, TrajectoryRecorder(path), (SNNAgent2D if game2D else SNNAgent).prepare_input)
+
+def create_agent(name, model=None, verbose=0, fused=None):
     """
     Create a specific type of Snake AI agent.
 
     Args:
         name (str): key identifying the agent type.
         model: (optional) a pre-trained model.
+        fused: (optional) deliver the reward and the next input in one simulation window.
 
     Returns:
         An instance of Snake agent.
     """
 
-    from game.agent import HumanAgent, RandomAgent, SNNAgent, SNNAgent2D
+    from game.agent import HumanAgent, RandomAgent, SNNAgent, SNNAgent2D, RateAgent, RateAgent2D
 
     if name == 'human':
         return HumanAgent()
@@ -110,27 +198,34 @@ def create_agent(name, model=None, verbose=0):
         return RandomAgent()
     elif name == 'snn':
         global game2D
-        return (SNNAgent2D if game2D else SNNAgent)(model,verbose)
+        return (SNNAgent2D if game2D else SNNAgent)(model, verbose, fused)
+    elif name == 'rate':
+        return (RateAgent2D if game2D else RateAgent)(model, verbose)
 
     raise KeyError('Unknown agent type: %s' % name)
 
 
+def play_episode(env, agent):
+    """ Play a single episode without GUI and return the result of agent.end_episode. """
+    timestep = env.new_episode()
+    agent.begin_episode()
+    game_over = False
+
+    while not game_over:
+        action = agent.act(timestep.observation, timestep.reward)
+        env.choose_action(action)
+        timestep = env.timestep()
+        game_over = timestep.is_episode_end
+    return agent.end_episode(timestep.observation, timestep.reward)
+
+
 def play_cli(env, agent, num_episodes=10):
     stats = []
 
     print('Playing:')
 
     for episode in range(num_episodes):
-        timestep = env.new_episode()
-        agent.begin_episode()
-        game_over = False
-
-        while not game_over:
-            action = agent.act(timestep.observation, timestep.reward)
-            env.choose_action(action)
-            timestep = env.timestep()
-            game_over = timestep.is_episode_end
-        agent.end_episode(timestep.observation, timestep.reward)
+        play_episode(env, agent)
 
         stats.append([env.stats.fruits, env.stats.timesteps])
 
@@ -140,46 +235,257 @@ def play_cli(env, agent, num_episodes=10):
     fruits = [stat[0] for stat in stats]
     print('Fruits eaten: {:.1f} +/- stddev {:.1f}'.format(np.mean(fruits), np.std(fruits)))
     print('Fruits per 100 timesteps: {:.1f} '.format(np.mean([100 * stat[0] / stat[1] for stat in stats])))
+    print_cache_summary(agent)
+
+
+def print_test_episode(run, num_runs, episode, num_episodes, fruits, timesteps, label='Run'):
+    summary = label + ' {:3d} / {:3d} | Episode {:3d} / {:3d} | Timesteps {:4d} | Fruits {:3d}'
+    print(summary.format(run + 1, num_runs, episode + 1, num_episodes, int(timesteps), int(fruits)))
+
+
+def print_test_run(run, num_runs, fruits, timesteps, weights, label='Run'):
+    print(label + ' {:3d} / {:3d}'.format(run + 1, num_runs))
+    print('Fruits eaten: {:.1f} +/- stddev {:.1f}'.format(np.mean(fruits), np.std(fruits)))
+    print('Fruits per 100 timesteps: {:.1f} '.format(np.mean(100 * fruits / timesteps)))
+    print('W_L-F-R: %s-%s-%s' % (print_me(weights[0], '4.0f'), print_me(weights[1], '4.0f'), print_me(weights[2], '4.0f')))
+
+
+def print_cache_summary(agent):
+    cache = getattr(agent, 'cache', None)
+    if cache is not None:
+        print(cache.summary().capitalize())
+
+
+def print_test_summary(fruits, label='runs'):
+    num_runs, num_episodes = fruits.shape
+    means = fruits.mean(axis=1)
+    print('============================\nFinished running. Results:')
+    print('After {:3d} {} and {:3d} episodes each: Fruits eaten: {:.1f} +/- stddev {:.1f}'.format(num_runs, label, num_episodes, np.mean(means), np.std(means)))
 
 
 def test(env, agent, num_episodes=10, num_runs=10):
-    means = []
+    """ Train a fresh agent num_runs times and return the fruits of every run and episode. """
+    fruits = np.zeros((num_runs, num_episodes))
+    timesteps = np.zeros((num_runs, num_episodes))
     print('Testing:')
 
     for run in range(num_runs):
-        if os.path.isfile("./game/snn/weights.h5"):
-            os.remove("./game/snn/weights.h5")
-        agent.reset_agent()
-        stats = []
+        agent.reset_agent(forget=True)
         for episode in range(num_episodes):
-            timestep = env.new_episode()
-            agent.begin_episode()
-            game_over = False
+            weights = play_episode(env, agent)
+            fruits[run, episode], timesteps[run, episode] = env.stats.fruits, env.stats.timesteps
+            print_test_episode(run, num_runs, episode, num_episodes, fruits[run, episode], timesteps[run, episode])
 
-            while not game_over:
-                action = agent.act(timestep.observation, timestep.reward)
-                env.choose_action(action)
-                timestep = env.timestep()
-                game_over = timestep.is_episode_end
-            weights = agent.end_episode(timestep.observation, timestep.reward)
+        print_test_run(run, num_runs, fruits[run], timesteps[run], weights)
 
-            stats.append([env.stats.fruits, env.stats.timesteps])
+    print_test_summary(fruits)
+    print_cache_summary(agent)
+    return fruits
 
-            summary = 'Run {:3d} / {:3d} | Episode {:3d} / {:3d} | Timesteps {:4d} | Fruits {:3d}'
-            print(summary.format(run + 1, num_runs, episode + 1, num_episodes, stats[-1][1], stats[-1][0]))
 
-        fruits = [stat[0] for stat in stats]
-        means.append(np.mean(fruits))
-        print('Run {:3d} / {:3d}'.format(run + 1, num_runs))
-        print('Fruits eaten: {:.1f} +/- stddev {:.1f}'.format(np.mean(fruits), np.std(fruits)))
-        print('Fruits per 100 timesteps: {:.1f} '.format(np.mean([100 * stat[0] / stat[1] for stat in stats])))
-        print('W_L-F-R: %s-%s-%s' % (print_me(weights[0], '4.0f'), print_me(weights[1], '4.0f'), print_me(weights[2], '4.0f')))
+def test_run(run, num_episodes, options, results):
+    """
+    Train a fresh agent for one run of a parallel test in a worker process.
 
-    print('============================\nFinished running. Results:')
-    print('After {:3d} runs and {:3d} episodes: Fruits eaten: {:.1f} +/- stddev {:.1f}'.format(num_runs, num_episodes, np.mean(means), np.std(means)))
+    Args:
+        run (int): index of the run.
+        num_episodes (int): the number of episodes to train.
+        options (dict): two_d, backend, precision, threads, adaptive, cache, agent, fused and seed of the run.
+        results: queue receiving ('episode', run, episode, fruits, timesteps) after every
+            episode and ('run', run, weights) at the end.
+    """
+    global game2D
+    game2D = options['two_d']
+    if options['backend'] is not None:
+        from game.snn import parameters
+        parameters.backend = options['backend']
+    if options['precision'] is not None:
+        from game.snn import parameters
+        parameters.use_precision_profile(options['precision'])
+    if options['threads'] is not None:
+        from game.snn import parameters
+        parameters.nest_kernel_status['local_num_threads'] = options['threads']
+    if options['adaptive']:
+        from game.snn import parameters
+        parameters.adaptive_decision = True
+    if options['cache']:
+        from game.snn import parameters
+        parameters.decision_cache = True
+    use_seed(options['seed'])
+
+    # Every run trains its own weights file, so runs never share or delete each other's weights.
+    model_dir = tempfile.mkdtemp(prefix='snake-test-')
+    try:
+        env = create_snake_environment()
+        agent = create_agent(options['agent'], os.path.join(model_dir, 'weights.h5'), 0, options['fused'])
+        for episode in range(num_episodes):
+            weights = play_episode(env, agent)
+            results.put(('episode', run, episode, env.stats.fruits, env.stats.timesteps))
+        agent.store.close()
+        agent.stats.flush()
+        results.put(('run', run, weights))
+    finally:
+        shutil.rmtree(model_dir, ignore_errors=True)
+
+
+def test_parallel(options, num_episodes=10, num_runs=10, workers=2):
+    """
+    Like test, but spread the runs over a pool of worker processes.
 
+    Every run gets a new process with its own NEST kernel, weights file and seed. The results of
+    the episodes are streamed back and printed as they arrive, followed by the same summary as test.
+    """
+    print('Testing with %d workers:' % workers)
+    fruits = np.zeros((num_runs, num_episodes))
+    timesteps = np.zeros((num_runs, num_episodes))
+    base_seed = np.random.randint(2 ** 31 - num_runs) if options['seed'] is None else options['seed']
+
+    context = multiprocessing.get_context('spawn')
+    results = context.Manager().Queue()
+    pool = context.Pool(workers, maxtasksperchild=1)
+    jobs = [pool.apply_async(test_run, (run, num_episodes, dict(options, seed=base_seed + run), results))
+            for run in range(num_runs)]
+    pool.close()
+
+    finished = 0
+    while finished < num_runs:
+        try:
+            message = results.get(timeout=1)
+        except queue.Empty:
+            # Raise the error of a failed run instead of waiting for it forever
+            for job in jobs:
+                if job.ready():
+                    job.get()
+            continue
+
+        if message[0] == 'episode':
+            _, run, episode, run_fruits, run_timesteps = message
+            fruits[run, episode], timesteps[run, episode] = run_fruits, run_timesteps
+            print_test_episode(run, num_runs, episode, num_episodes, run_fruits, run_timesteps)
+        else:
+            _, run, weights = message
+            print_test_run(run, num_runs, fruits[run], timesteps[run], weights)
+            finished += 1
+    pool.join()
+
+    print_test_summary(fruits)
+    return fruits
+
+
+def train_population(agent_name, num_members, num_episodes=10, fused=None):
+    """
+    Train num_members fresh networks in lockstep in one process and return the fruits of every member and episode.
 
-def play_gui(env, agent, num_episodes):
+    Every member plays in its own environment of a VecEnvironment2D and all networks share one kernel, so
+    a step costs the simulations of a single agent for the whole population (see SNNAgentHost). Finished episodes restart
+    independently; the terminal reward is delivered in the reward window of the next step, so episode ends
+    need no extra simulation. Members that have played num_episodes keep playing until all members are done,
+    their further episodes are not recorded.
+    """
+    from game.agent import SNNAgentHost
+    from game.environment import VecEnvironment2D
+
+    if agent_name != 'snn':
+        raise KeyError('Population training needs SNN agents, not: %s' % agent_name)
+
+    print('Training a population of %d:' % num_members)
+    fruits = np.zeros((num_members, num_episodes))
+    timesteps = np.zeros((num_members, num_episodes))
+    episodes = np.zeros(num_members, dtype=int)
+
+    # Every member trains its own weights file
+    model_dir = tempfile.mkdtemp(prefix='snake-population-')
+    try:
+        agents = [create_agent(agent_name, os.path.join(model_dir, 'weights_%d.h5' % member), 0, fused)
+                  for member in range(num_members)]
+        for agent in agents:
+            agent.reset_agent(forget=True)
+            agent.begin_episode()
+        host = SNNAgentHost(agents)
+
+        env = VecEnvironment2D(num_members, level_map2D)
+        observations = env.reset()
+        rewards = np.zeros((num_members, 3))
+        ended = []
+        while episodes.min() < num_episodes:
+            actions = host.act(observations, rewards)
+            # The members that ended in the last step have learned from their terminal reward now
+            for member in ended:
+                agents[member].store.update(agents[member].w)
+                agents[member].begin_episode()
+
+            timestep = env.step(actions)
+            observations, rewards = timestep.observation, timestep.reward
+            ended = np.flatnonzero(timestep.is_episode_end)
+            for member in ended:
+                episode = episodes[member]
+                if episode < num_episodes:
+                    fruits[member, episode] = env.episode_fruits[member]
+                    timesteps[member, episode] = env.episode_timesteps[member]
+                    print_test_episode(member, num_members, episode, num_episodes, fruits[member, episode],
+                                       timesteps[member, episode], 'Member')
+                episodes[member] += 1
+
+        for member, agent in enumerate(agents):
+            print_test_run(member, num_members, fruits[member], timesteps[member], agent.w, 'Member')
+            print_cache_summary(agent)
+            agent.store.close()
+            agent.stats.flush()
+    finally:
+        shutil.rmtree(model_dir, ignore_errors=True)
+
+    print_test_summary(fruits, 'members')
+    return fruits
+
+
+def bootstrap_interval(a, b, confidence, num_resamples=10000):
+    """ Percentile bootstrap confidence interval of the difference of the means of the samples b and a. """
+    a, b = np.asarray(a), np.asarray(b)
+    differences = np.empty(num_resamples)
+    for i in range(num_resamples):
+        differences[i] = np.random.choice(b, len(b)).mean() - np.random.choice(a, len(a)).mean()
+    tail = (1. - confidence) / 2. * 100.
+    return np.percentile(differences, tail), np.percentile(differences, 100. - tail)
+
+
+def validate_fused(run_test, num_episodes=10, num_runs=10, margin=0.5, alpha=0.05):
+    """
+    Compare the learning curves of the agent with separate and with fused reward windows.
+
+    The modes count as equivalent if the mean fruits per episode of a run differ by less than margin.
+    This is tested with two one-sided tests at level alpha: the modes are equivalent if the 1 - 2 alpha
+    confidence interval of the difference lies within [-margin, margin]. An interval that is too wide
+    for that means the runs do not suffice to tell, not that the modes differ.
+
+    Args:
+        run_test: function running the test with fused (True) or separate (False) reward
+            windows and returning the fruits of every run and episode.
+        margin (float): largest difference of the fruits per episode that counts as equivalent.
+    """
+    curves = []
+    for fused in (False, True):
+        print('============================\nFused reward: %s' % fused)
+        curves.append(run_test(fused))
+
+    print('============================\nLearning curves (mean fruits per episode over all runs):')
+    print('Separate: %s' % print_me(curves[0].mean(axis=0), '4.1f'))
+    print('Fused:    %s' % print_me(curves[1].mean(axis=0), '4.1f'))
+
+    # Compare the mean fruits of each run and of the second half of the episodes (learned behaviour)
+    for name, start in (('all episodes', 0), ('second half', num_episodes // 2)):
+        separate, fused = curves[0][:, start:].mean(axis=1), curves[1][:, start:].mean(axis=1)
+        low, high = bootstrap_interval(separate, fused, 1. - 2. * alpha)
+        if -margin < low and high < margin:
+            verdict = 'equivalent'
+        elif high < -margin or low > margin:
+            verdict = 'different'
+        else:
+            verdict = 'inconclusive, more runs needed'
+        print('Fruits per episode ({}): fused - separate = {:+.2f}, {:.0f}% CI [{:+.2f}, {:+.2f}] -> {} (margin +/- {})'.format(
+            name, fused.mean() - separate.mean(), 100. * (1. - 2. * alpha), low, high, verdict, margin))
+
+
+def play_gui(env, agent, num_episodes, late_decision=None):
     """
     Play using the specified Snake agent and the interactive graphical interface.
 
@@ -187,16 +493,17 @@ def play_gui(env, agent, num_episodes):
         env: an instance of Snake environment.
         agent: an instance of Snake agent.
         num_episodes (int): the number of episodes to run.
+        late_decision: (optional) act on a background thread with this policy for late actions.
     """
     from game.gui import PyGameGUI
 
-    gui = PyGameGUI()
+    gui = PyGameGUI(late_decision)
     gui.load_environment(env)
     gui.load_agent(agent)
     gui.run(num_episodes=num_episodes)
 
 
-def use_seed(self, value):
+def use_seed(value):
     """ Initialize the random state to make results reproducible. """
     random.seed(value)
     np.random.seed(value)
@@ -209,19 +516,93 @@ def main():
         use_seed(parsed_args.seed)
         print("App is using seed: %d" % parsed_args.seed)
 
+    if parsed_args.backend is not None:
+        from game.snn import parameters
+        parameters.backend = parsed_args.backend
+
+    if parsed_args.precision is not None:
+        from game.snn import parameters
+        parameters.use_precision_profile(parsed_args.precision)
+
+    if parsed_args.adaptive:
+        from game.snn import parameters
+        parameters.adaptive_decision = True
+
+    if parsed_args.cache:
+        from game.snn import parameters
+        parameters.decision_cache = True
+
+    if parsed_args.threads is not None:
+        from game.snn import parameters
+        parameters.nest_kernel_status['local_num_threads'] = parsed_args.threads
+
     if parsed_args.two_d:
         global game2D
         game2D = True
 
-    env = create_snake_environment()
-    agent = create_agent(parsed_args.agent, parsed_args.model, not (parsed_args.fast_train or parsed_args.test))
-
-    if parsed_args.test:
-        test(env, agent, num_episodes=parsed_args.num_episodes, num_runs=parsed_args.num_runs)
+    if parsed_args.population is not None and not game2D:
+        sys.exit('--population trains in 2D environments, pass --two-d')
+
+    if parsed_args.population is not None and parsed_args.record is not None:
+        sys.exit('--record does not record the environments of --population')
+
+    if parsed_args.export_policy is not None:
+        from game.snn import parameters
+        from game.snn.rate_model import RateModel
+        RateModel.load(parsed_args.model or parameters.default_dir + parameters.weights_file).save(parsed_args.export_policy)
+        print("Policy written to %s" % parsed_args.export_policy)
+        return
+
+    fused = True if parsed_args.fused else None
+    workers = min(parsed_args.workers or os.cpu_count(), parsed_args.num_runs)
+
+    if parsed_args.population is not None:
+        train_population(parsed_args.agent, parsed_args.population, parsed_args.num_episodes, fused)
+        return
+
+    # The workers train fresh networks, a rate agent has nothing to train and is tested in this process,
+    # like the runs that are recorded
+    if parsed_args.test and workers > 1 and parsed_args.agent != 'rate' and parsed_args.record is None:
+        agent = None
+        options = {
+            'two_d': game2D,
+            'backend': parsed_args.backend,
+            'precision': parsed_args.precision,
+            'threads': parsed_args.threads,
+            'adaptive': parsed_args.adaptive,
+            'cache': parsed_args.cache,
+            'agent': parsed_args.agent,
+            'seed': parsed_args.seed,
+        }
+
+        def run_test(fused):
+            return test_parallel(dict(options, fused=fused), parsed_args.num_episodes, parsed_args.num_runs, workers)
     else:
-        (play_cli if parsed_args.fast_train else play_gui)(env, agent, num_episodes=parsed_args.num_episodes)
+        env = create_snake_environment()
+        if parsed_args.record is not None:
+            env = record_environment(env, parsed_args.record)
+        agent = create_agent(parsed_args.agent, parsed_args.model, not (parsed_args.fast_train or parsed_args.test), fused)
+
+        def run_test(fused):
+            if fused is not None:
+                agent.fused = fused
+            return test(env, agent, num_episodes=parsed_args.num_episodes, num_runs=parsed_args.num_runs)
+
+    if parsed_args.test and parsed_args.validate_fused:
+        validate_fused(run_test, num_episodes=parsed_args.num_episodes, num_runs=parsed_args.num_runs,
+                       margin=parsed_args.equivalence_margin)
+    elif parsed_args.test:
+        run_test(fused)
+    elif parsed_args.fast_train:
+        play_cli(env, agent, num_episodes=parsed_args.num_episodes)
+    else:
+        play_gui(env, agent, num_episodes=parsed_args.num_episodes, late_decision=parsed_args.late_decision)
+
+    if parsed_args.record is not None:
+        env.recorder.flush()
+        print('Recorded %d steps of %d episodes to %s' % (env.recorder.steps, env.recorder.episodes, parsed_args.record))
 
-    if parsed_args.plot:
+    if parsed_args.plot and agent is not None:
         agent.stats.plot()
 
 if __name__ == '__main__':
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The game package is imported like server.py does, from the Snake directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
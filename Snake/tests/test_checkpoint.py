@@ -0,0 +1,79 @@
+import h5py
+import numpy as np
+
+from game.snn import parameters as params
+from game.snn.checkpoint import WeightStore, checkpoint_path
+
+SHAPE = (params.output_layer_size, params.input_layer_size)
+
+
+def weights(value):
+    return np.full(SHAPE, value, dtype=float)
+
+
+def test_round_trip(tmp_path):
+    path = str(tmp_path / 'weights.h5')
+    store = WeightStore(path, interval=0)
+    assert store.latest() is None
+    for value in range(1, 4):
+        store.update(weights(value))
+    store.close()
+
+    store = WeightStore(path, interval=0)
+    np.testing.assert_array_equal(store.latest(), weights(3))
+    assert store.version == 3
+    np.testing.assert_array_equal(store.load(1), weights(1))
+    assert store.load(4) is None
+    store.update(weights(4))
+    assert store.version == 4
+    np.testing.assert_array_equal(WeightStore(path).load(4), weights(4))
+
+
+def test_background_writer(tmp_path):
+    path = str(tmp_path / 'weights.h5')
+    store = WeightStore(path, interval=60.)
+    store.update(weights(1))
+    store.update(weights(2))
+    store.close()
+    assert store._writer is None
+
+    with h5py.File(path, 'r') as h5f:
+        assert h5f['versions'][()].tolist() == [2]
+    np.testing.assert_array_equal(WeightStore(path).latest(), weights(2))
+
+
+def test_reset_keeps_history(tmp_path):
+    path = str(tmp_path / 'weights.h5')
+    store = WeightStore(path, interval=0)
+    store.update(weights(1))
+    store.reset()
+    assert store.latest() is None
+
+    store = WeightStore(path, interval=0)
+    assert store.latest() is None
+    np.testing.assert_array_equal(store.load(1), weights(1))
+    store.update(weights(2))
+    assert store.version == 2
+    np.testing.assert_array_equal(WeightStore(path).latest(), weights(2))
+
+
+def test_model_file_is_only_read(tmp_path):
+    path = str(tmp_path / 'model.h5')
+    with h5py.File(path, 'w') as h5f:
+        h5f.create_dataset('w', data=weights(7))
+    with open(path, 'rb') as f:
+        content = f.read()
+
+    store = WeightStore(path, interval=0)
+    assert store.path == checkpoint_path(path)
+    np.testing.assert_array_equal(store.latest(), weights(7))
+    assert store.version == 0
+    store.update(weights(8))
+    store.close()
+
+    with open(path, 'rb') as f:
+        assert f.read() == content
+    store = WeightStore(path, interval=0)
+    np.testing.assert_array_equal(store.latest(), weights(8))
+    np.testing.assert_array_equal(store.load(0), weights(7))
+    assert store.version == 1
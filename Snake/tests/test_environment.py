@@ -0,0 +1,74 @@
+import random
+
+import numpy as np
+
+from game import environment
+from game.entities import CellType, ALL_SNAKE_DIRECTIONS, ALL_SNAKE_ACTIONS
+from game.environment import Environment2D, VecEnvironment2D
+
+LEVEL_MAP = ['#########',
+             '#.......#',
+             '#.......#',
+             '#.......#',
+             '#...S...#',
+             '#.......#',
+             '#.......#',
+             '#.......#',
+             '#########']
+
+
+def synchronize(env, vec):
+    """ Start env from the random direction and move its fruit to the random fruit of vec. """
+    env.snake.direction = ALL_SNAKE_DIRECTIONS[vec.directions[0]]
+    env.field[env.fruit] = CellType.EMPTY
+    env.generate_fruit(env.field.cell_point(int(vec.fruits_position[0])))
+    env._observation = None
+
+
+def test_vec_environment_matches_environment(monkeypatch):
+    # No reward noise in either environment
+    monkeypatch.setattr(environment.random, 'randint', lambda a, b: b)
+    random.seed(3)
+    np.random.seed(3)
+    env = Environment2D(level_map=LEVEL_MAP)
+    vec = VecEnvironment2D(1, LEVEL_MAP)
+    vec.reward_noise = 0
+    env.new_episode()
+    vec.reset()
+    synchronize(env, vec)
+
+    episodes, fruits = 0, 0
+    for _ in range(3000):
+        observation = vec.get_observation()[0]
+        np.testing.assert_allclose(observation, env.get_observation())
+        np.testing.assert_array_equal(vec.fields[0], env.field._cells)
+
+        # Mostly follow the smell of the fruit, so the snake grows and can hit its body
+        if random.random() < 0.8:
+            action = ALL_SNAKE_ACTIONS[int(np.argmax(observation[3:]))]
+        else:
+            action = random.choice(ALL_SNAKE_ACTIONS)
+        env.choose_action(action)
+        length = env.snake.length
+        result = env.timestep()
+        vec_result = vec.step([action])
+
+        assert vec_result.is_episode_end[0] == result.is_episode_end
+        if env.snake.length > length:
+            fruits += 1
+            if not result.is_episode_end:
+                # The new fruits are random, the reward depends on where they are
+                synchronize(env, vec)
+                continue
+        else:
+            np.testing.assert_allclose(vec_result.reward[0], result.reward)
+
+        if result.is_episode_end:
+            episodes += 1
+            np.testing.assert_allclose(vec.terminal_observation[0], result.observation)
+            assert vec.episode_fruits[0] == env.stats.fruits
+            assert vec.episode_timesteps[0] == env.stats.timesteps
+            env.new_episode()
+            synchronize(env, vec)
+
+    assert episodes > 10 and fruits > 10
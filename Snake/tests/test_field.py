@@ -0,0 +1,88 @@
+import random
+
+import numpy as np
+import pytest
+
+from game.entities import Field, Point, CellType, ALL_SNAKE_DIRECTIONS
+from game.environment import raycast
+
+
+def recursive_raycast(field, initial, increment, obstacles, value=1.0):
+    """ The raycast of Environment2D.get_observation before the field was indexed, walking cell by cell. """
+    next_point = initial + increment
+    if not (0 <= next_point.x < field.width and 0 <= next_point.y < field.height):
+        return -value
+    cell = field[next_point]
+    if cell in obstacles:
+        return -value
+    elif cell == CellType.FRUIT:
+        return value
+    return recursive_raycast(field, next_point, increment, obstacles, max(0.2, value - 0.1))
+
+
+def random_level_map(width, height, border):
+    symbols = '....s#O' if border else '.....sO'
+    rows = [[random.choice(symbols) for x in range(width)] for y in range(height)]
+    if border:
+        for y in range(height):
+            rows[y][0] = rows[y][-1] = '#'
+        rows[0] = rows[-1] = ['#'] * width
+    return [''.join(row) for row in rows]
+
+
+@pytest.mark.parametrize('border', [True, False])
+def test_raycast_matches_recursive_raycast(border):
+    random.seed(1)
+    obstacles = (CellType.WALL, CellType.SNAKE_BODY)
+    for _ in range(20):
+        field = Field(level_map=random_level_map(random.randint(2, 17), random.randint(2, 17), border))
+        field.create_level()
+        for _ in range(20):
+            # Change some cells, the masks of the raycast have to follow
+            field[Point(random.randrange(field.width), random.randrange(field.height))] = random.choice(
+                [CellType.EMPTY, CellType.WALL, CellType.SNAKE_BODY, CellType.FRUIT])
+        for y in range(field.height):
+            for x in range(field.width):
+                for direction in ALL_SNAKE_DIRECTIONS:
+                    assert raycast(field, Point(x, y), direction, obstacles) == pytest.approx(
+                        recursive_raycast(field, Point(x, y), direction, obstacles))
+
+
+def test_raycast_returns_distance_and_cell_type():
+    field = Field(level_map=['#######',
+                             '#..O..#',
+                             '#.....#',
+                             '#..s..#',
+                             '#######'])
+    field.create_level()
+    origin = Point(3, 2)
+    assert field.raycast(origin, Point(0, -1), (CellType.WALL, CellType.FRUIT)) == (1, CellType.FRUIT)
+    assert field.raycast(origin, Point(0, 1), (CellType.WALL, CellType.SNAKE_BODY)) == (1, CellType.SNAKE_BODY)
+    assert field.raycast(origin, Point(0, 1), (CellType.WALL,)) == (2, CellType.WALL)
+    assert field.raycast(origin, Point(-1, 0), (CellType.FRUIT,)) == (4, None)
+
+
+def test_empty_cells_follow_updates():
+    random.seed(2)
+    field = Field(level_map=random_level_map(9, 7, True))
+    field.create_level()
+    for _ in range(500):
+        point = Point(random.randrange(field.width), random.randrange(field.height))
+        field[point] = random.choice([CellType.EMPTY, CellType.WALL, CellType.SNAKE_BODY])
+        empty = field._flat_cells == CellType.EMPTY
+        assert sorted(field._empty_cells) == np.flatnonzero(empty).tolist()
+        if empty.any():
+            assert field[field.get_random_empty_cell()] == CellType.EMPTY
+
+
+@pytest.mark.parametrize('point', [Point(-1, 2), Point(2, -1), Point(5, 2), Point(2, 3)])
+def test_setting_a_point_outside_the_field_raises(point):
+    field = Field(level_map=['#####',
+                             '#...#',
+                             '#####'])
+    field.create_level()
+    before = str(field)
+    with pytest.raises(IndexError):
+        field[point] = CellType.WALL
+    assert str(field) == before
+    assert sorted(field._empty_cells) == np.flatnonzero(field._flat_cells == CellType.EMPTY).tolist()
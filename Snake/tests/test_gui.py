@@ -0,0 +1,74 @@
+import threading
+import time
+
+import pytest
+
+pytest.importorskip('pygame')
+from game.gui import InferenceWorker
+
+
+class BlockingAgent(object):
+    """ Acts only when released, the action is the observation. """
+
+    def __init__(self):
+        self.release = threading.Semaphore(0)
+        self.observations = []
+
+    def act(self, observation, reward):
+        self.release.acquire()
+        if observation is None:
+            raise ValueError('no observation')
+        self.observations.append(observation)
+        return observation
+
+
+def wait_until(predicate):
+    while not predicate():
+        time.sleep(0.001)
+
+
+def test_superseded_requests_are_dropped():
+    agent = BlockingAgent()
+    worker = InferenceWorker(agent)
+    worker.submit(1, 0)
+    # Wait until the worker is busy with the first request, the next ones replace each other
+    wait_until(lambda: worker.request is None)
+    for observation in (2, 3, 4):
+        worker.submit(observation, 0)
+    assert worker.poll() is None
+
+    agent.release.release()
+    agent.release.release()
+    assert worker.wait() == 4
+    assert agent.observations == [1, 4]
+    assert worker.dropped == 2
+    assert worker.poll() is None
+    worker.stop()
+
+
+def test_poll_returns_late_actions_once():
+    agent = BlockingAgent()
+    worker = InferenceWorker(agent)
+    worker.submit(1, 0)
+    wait_until(lambda: worker.request is None)
+    worker.submit(2, 0)
+    agent.release.release()
+    wait_until(lambda: worker.done)
+    # The action of the first request arrives after the second one has been submitted
+    assert worker.poll() == 1
+    assert worker.poll() is None
+    agent.release.release()
+    assert worker.wait() == 2
+    worker.stop()
+
+
+def test_agent_errors_are_raised():
+    agent = BlockingAgent()
+    worker = InferenceWorker(agent)
+    worker.submit(None, 0)
+    agent.release.release()
+    with pytest.raises(RuntimeError):
+        worker.wait()
+    with pytest.raises(RuntimeError):
+        worker.poll()
+    worker.stop()
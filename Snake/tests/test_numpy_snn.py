@@ -0,0 +1,19 @@
+import numpy as np
+
+from game.snn import numpy_snn
+from game.snn import parameters as params
+
+
+def test_precision_profile_applies_after_import():
+    # The backend is imported above, before the profile is applied
+    network = numpy_snn.SnakeSNN()
+    numpy_snn.reset_kernel()
+    try:
+        params.use_precision_profile('fast')
+        network.set_input(np.ones(params.input_layer_size))
+        assert network.input_steps == int(round((30. - 10.) / 0.1))
+        assert network.rates.max() == 2000.
+        network.n_events[:] = 15
+        assert np.allclose(network.get_output(), 1.)
+    finally:
+        params.use_precision_profile('reference')
@@ -0,0 +1,93 @@
+import gc
+import random
+import weakref
+
+import numpy as np
+import pytest
+
+from game import utils
+from game.utils import AgentStatistics, DecisionCache, RewardWindow
+
+
+def test_decision_cache_serves_after_enough_samples():
+    random.seed(4)
+    cache = DecisionCache(size=4, samples=3, resolution=0.005)
+    key = cache.key([0.1, 0.2, 0.3], 7)
+    # Inputs within the resolution share the entry, other weight versions do not
+    assert cache.key([0.101, 0.199, 0.3], 7) == key
+    assert cache.key([0.1, 0.2, 0.3], 8) != key
+
+    for action in (0, 2):
+        cache.record(key, action)
+        assert cache.lookup(key) is None
+    cache.record(key, 2)
+    assert {cache.lookup(key) for _ in range(100)} == {0, 2}
+    assert (cache.hits, cache.misses) == (100, 2)
+
+
+def test_decision_cache_evicts_least_recently_used():
+    cache = DecisionCache(size=3, samples=1, resolution=0.005)
+    keys = [cache.key([i], 0) for i in range(5)]
+    for key in keys[:3]:
+        cache.record(key, 1)
+    # Using the oldest entry makes the second one the least recently used
+    assert cache.lookup(keys[0]) == 1
+    cache.record(keys[3], 1)
+    assert len(cache) == 3 and cache.evictions == 1
+    assert cache.lookup(keys[1]) is None
+    # Recording refreshes an entry as well
+    cache.record(keys[2], 1)
+    cache.record(keys[4], 1)
+    assert cache.lookup(keys[0]) is None
+    assert [cache.lookup(key) for key in keys[2:]] == [1, 1, 1]
+    assert cache.evictions == 2
+
+    cache.clear()
+    assert len(cache) == 0
+
+
+def test_reward_window_mean_matches_rolling_mean():
+    np.random.seed(5)
+    window = RewardWindow('mean', size=4)
+    rewards = np.random.uniform(-2, 1, (50, 3))
+    for i, reward in enumerate(rewards):
+        # Divided by size also while the window is not full yet
+        expected = rewards[max(0, i - 3):i + 1].sum(axis=0) / 4
+        np.testing.assert_allclose(window.push(reward), expected)
+
+    window.reset()
+    np.testing.assert_allclose(window.push([1., 0., -1.]), [0.25, 0., -0.25])
+
+
+def test_reward_window_of_one_delivers_every_reward():
+    window = RewardWindow('mean', size=1)
+    for reward in ([1., -0.5, -0.5], [0., 0., 0.], [-2., 1., 1.]):
+        assert window.push(reward) == reward
+
+
+def test_reward_window_discounted():
+    window = RewardWindow('discounted', discount=0.5)
+    np.testing.assert_allclose(window.push([1., 0., 0.]), [0.5, 0., 0.])
+    np.testing.assert_allclose(window.push([0., 1., 0.]), [0.25, 0.5, 0.])
+    with pytest.raises(ValueError):
+        RewardWindow('median')
+
+
+def test_statistics_are_not_kept_alive_by_unwritten_samples(tmp_path):
+    stats = AgentStatistics(str(tmp_path / 'training_data.h5'), sample_every=1, chunk_size=8, record=True)
+    stats.append(np.zeros(3))
+    assert stats in utils._pending
+    reference = weakref.ref(stats)
+    del stats
+    gc.collect()
+    assert reference() is None
+
+
+def test_statistics_without_record_write_nothing(tmp_path):
+    path = tmp_path / 'training_data.h5'
+    stats = AgentStatistics(str(path), sample_every=1, chunk_size=2, record=False)
+    for step in range(5):
+        stats.append(np.full(3, step), 50.)
+    stats.flush()
+    assert not path.exists()
+    assert stats.w.shape == (5, 3) and stats.mean_window == 50.
@@ -1,17 +1,44 @@
 import time
 import random
+import argparse
+import threading
 import os, sys
 import snn.parameters as params
 
+if __name__ == "__main__":
+    # Options that change what the imports below load, parse_command_line_args documents them
+    early_parser = argparse.ArgumentParser(add_help=False)
+    early_parser.add_argument('--local', action='store_true')
+    early_args, _ = early_parser.parse_known_args()
+    if early_args.local:
+        # Play against the in-process stand-in of the traze client instead of the server
+        import traze_local
+        traze_local.install()
+
 from traze.bot import Action, BotBase
 from traze.client import World
-from snn.agent import SNNAgent
+from snn.agent import SNNAgent, RateAgent
+from snn.utils import TrajectoryRecorder
+from occupancy import OccupancyGrid
+from speculation import SpeculativeAgent
 
 
 class SNNBot(BotBase):
-    def __init__(self, game, name="SLab-ML Muenchen"):
+    # Seconds between checks of alive while waiting, in case the client does not call back
+    WAIT_INTERVAL = 1.
+
+    def __init__(self, game, name="SLab-ML Muenchen", agent=None, recorder=None):
         super(SNNBot, self).__init__(game, name)
-        self.agent = SNNAgent(verbose=0)
+        # Records every decision for offline training with replay.py if set
+        self.recorder = recorder
+        # Set by the first update of the bike and by the client when the bike died, play waits on them
+        self._joined = threading.Event()
+        self._died = threading.Event()
+        self.agent = SNNAgent(verbose=0) if agent is None else agent
+        # Decides for the next tick while the bike is moving, answers within the decision budget
+        self.speculation = SpeculativeAgent(self.agent, params.decision_budget)
+        # Mirror of the grid, rays are looked up in its run-length tables instead of walking the grid
+        self.occupancy = OccupancyGrid()
         self.reset_bot()
 
     def reset_bot(self):
@@ -19,33 +46,47 @@ class SNNBot(BotBase):
         self._nextAction = None
         self._reward = [0, 0, 0]
         self._last_position = [0, 0]
+        self._last_observation = None
+        self.speculation.cancel()
 
-    def next_action(self, actions):
-        def raycast(field, initial, action, value=1.0):
-            next_point = [initial[0] + action.dX, initial[1] + action.dY]
+    def observe(self, position, action):
+        """ Rays left, forward and right of a bike at position heading in the direction of action. """
+        def raycast(field, initial, action):
+            # 1.0 for an obstacle right ahead, 0.05 less for every free cell in between, at least 0.1
+            return -max(0.1, 1.0 - 0.05 * field.free_cells(initial, action.dX, action.dY))
 
-            if not self.game.grid.valid(next_point[0], next_point[1]):
-                return -value
-            else:
-                value = max(0.1, value - 0.05)
-                return raycast(field, next_point, action, value)
+        direction_idx = action.index
+        left_direction_idx = (direction_idx - 1) % len(list(Action))
+        right_direction_idx = (direction_idx + 1) % len(list(Action))
 
+        front = raycast(self.occupancy, position, action)
+        right = raycast(self.occupancy, position, list(Action)[right_direction_idx])
+        left = raycast(self.occupancy, position, list(Action)[left_direction_idx])
+        return [left, front, right]
+
+    def next_action(self, actions):
+        # The client only asks a bike that has joined the game
+        self._joined.set()
         # this method is called more than once per step, therefore it needs to be returned after first call
         if self.x == self._last_position[0] and self.y == self._last_position[1]:
             return self._lastAction
 
         self._last_position = [self.x, self.y]
+        self.occupancy.update(self.game.grid)
         output = None
+        late = False
         if self._lastAction in list(Action):
             direction_idx = self._lastAction.index
-            left_direction_idx = (direction_idx - 1) % len(list(Action))
-            right_direction_idx = (direction_idx + 1) % len(list(Action))
+            left, front, right = self.observe((self.x, self.y), self._lastAction)
 
-            front = raycast(self.game.grid.tiles, (self.x, self.y), self._lastAction)
-            right = raycast(self.game.grid.tiles, (self.x, self.y), list(Action)[right_direction_idx])
-            left = raycast(self.game.grid.tiles, (self.x, self.y), list(Action)[left_direction_idx])
-
-            output = self.agent.act([left, front, right], self._reward)
+            output = self.speculation.act([left, front, right], self._reward)
+            if self.recorder is not None:
+                self._last_observation = [left, front, right]
+                self.recorder.append(self._last_observation, self.agent.prepare_input(self._last_observation),
+                                     self._reward, 0 if output is None else output)
+            if output is None:
+                # No decision within the budget, keep the direction and reward nothing the SNN did not decide
+                output, late = 0, True
             new_direction_idx = (direction_idx + output) % len(list(Action))
             self._nextAction = list(Action)[new_direction_idx]
             self._reward = [0, 0, 0]
@@ -62,7 +103,7 @@ class SNNBot(BotBase):
             else:
                 self._nextAction = random.choice(tuple(actions))
         else:
-            new_front = raycast(self.game.grid.tiles, [self.x, self.y], self._nextAction)
+            new_front = self.observe((self.x, self.y), self._nextAction)[1]
             # Reward if first object forward after action is further away than before or if the action was maintain direction reward if the object forward is furtheraway than objects left and right
             if new_front > front:
                 self._reward = [-0.1, -0.1, -0.1]
@@ -71,37 +112,156 @@ class SNNBot(BotBase):
                 self._reward = [-0.05, -0.05, -0.05]
                 self._reward[output + 1] = 0.1
 
+        if late:
+            self._reward = [0, 0, 0]
+        elif output is not None and self._nextAction in actions:
+            # The bike moves one cell in the chosen direction, decide for the next tick in the meantime
+            position = (self.x + self._nextAction.dX, self.y + self._nextAction.dY)
+            self.speculation.speculate(self.observe(position, self._nextAction), self._reward)
+
         self._lastAction = self._nextAction
         return self._nextAction
 
+    def on_dead(self):
+        """ Called by the client when the ticker reports the bike as casualty. """
+        super(SNNBot, self).on_dead()
+        self._died.set()
+
+    def _wait(self, event, condition, deadline=None):
+        """ Wait until event is set or condition() holds, False if the deadline passed first. """
+        while not event.is_set() and not condition():
+            timeout = self.WAIT_INTERVAL if deadline is None else min(self.WAIT_INTERVAL, deadline - time.time())
+            if timeout <= 0:
+                return False
+            event.wait(timeout)
+        return True
+
     def play(self, max_time):
+        """ Play games until max_time seconds have passed, every game starts as soon as the previous one ended. """
         start_time = time.time()
+        deadline = start_time + max_time
         i = 1
-        while time.time() - start_time < max_time:
+        while time.time() < deadline:
             self.agent.begin_episode()
+            self._joined.clear()
+            self._died.clear()
             self.join()
+            if not self._wait(self._joined, lambda: self.alive, deadline):
+                # The join was not accepted before the deadline
+                break
             print("start game", i)
 
-            # wait for death
-            while self.alive:
-                time.sleep(0.5)
-            self.agent.end_episode(self._reward)
+            # wait for death, a game still running at the deadline is played to its end
+            self._wait(self._died, lambda: not self.alive)
+            self.speculation.end_episode(self._reward)
+            if self.recorder is not None and self._last_observation is not None:
+                # The bike is gone, the episode ends with the last observation and the terminal reward
+                self.recorder.end_episode(self._last_observation, self.agent.prepare_input(self._last_observation),
+                                          self._reward)
             self.reset_bot()
             print("end game", i)
             i += 1
 
+        duration = time.time() - start_time
+        summary = "%d games in %.1f minutes, %.0f games per hour" % (i - 1, duration / 60, 3600 * (i - 1) / duration)
+        summary += ", " + self.speculation.summary()
+        if self.agent.stats.window_count:
+            summary += ", mean decision window %.1f ms" % self.agent.stats.mean_window
+        if self.agent.cache is not None:
+            summary += ", " + self.agent.cache.summary()
+        print(summary)
+        if self.recorder is not None:
+            self.recorder.flush()
         self.agent.reset_agent()
         return self
 
+def parse_command_line_args(args):
+    """ Parse command-line arguments and organize them into a single structured object. """
+
+    parser = argparse.ArgumentParser(description='SNN bot for Traze.')
+
+    parser.add_argument(
+        'minutes_until_reset',
+        type=float,
+        help='Minutes until the bot resets its weights.',
+    )
+    parser.add_argument(
+        'bot_name',
+        nargs='?',
+        default="SLab-ML Muenchen",
+        help='Name of the bot in the game.',
+    )
+    parser.add_argument(
+        '--precision',
+        type=str,
+        choices=sorted(params.precision_profiles),
+        help='Precision profile of the simulation, see precision_profiles in snn/parameters.py.',
+    )
+    parser.add_argument(
+        '--threads',
+        type=int,
+        help='Number of threads of the NEST kernel (default from the precision profile).',
+    )
+    parser.add_argument(
+        '--adaptive',
+        action='store_true',
+        help='End every decision window as soon as an output neuron leads by decision_margin spikes.',
+    )
+    parser.add_argument(
+        '--cache',
+        action='store_true',
+        help='Draw the decisions for inputs seen before with the same weights from a cache instead of simulating them.',
+    )
+    parser.add_argument(
+        '--policy',
+        type=str,
+        help='Play with the frozen weights of this weights or policy file without simulating the SNN.',
+    )
+    parser.add_argument(
+        '--record',
+        type=str,
+        help='Append every decision (observation, SNN input, reward, action) to this trajectory file for replay.py.',
+    )
+    parser.add_argument(
+        '--stats',
+        action='store_true',
+        help='Stream the weights of every stats_sample_every-th decision to training_data.h5 next to the weights.',
+    )
+    parser.add_argument(
+        '--local',
+        action='store_true',
+        help='Play in a local in-process game instead of on the server.',
+    )
+    parser.add_argument(
+        '--opponents',
+        type=int,
+        default=3,
+        help='Number of opponents in the local game.',
+    )
+
+    return parser.parse_args(args)
+
+
 if __name__ == "__main__":
-    if len(sys.argv) < 2 or not sys.argv[1].isdigit():
-        print("Usage: python %s <minutes_until_reset> [bot_name]" % sys.argv[0])
-        exit(1)
-    weights_path = params.default_dir + params.weights_file
-    bot = SNNBot(World().games[0], *sys.argv[2:3])
+    parsed_args = parse_command_line_args(sys.argv[1:])
+    # NEST applies the kernel settings when the first network is created, so they are set before the agent
+    if parsed_args.precision is not None:
+        params.use_precision_profile(parsed_args.precision)
+    if parsed_args.threads is not None:
+        params.nest_kernel_status['local_num_threads'] = parsed_args.threads
+    if parsed_args.adaptive:
+        params.adaptive_decision = True
+    if parsed_args.cache:
+        params.decision_cache = True
+    if parsed_args.stats:
+        params.stats_record = True
+    world = World(opponents=parsed_args.opponents) if parsed_args.local else World()
+    agent = None if parsed_args.policy is None else RateAgent(parsed_args.policy, verbose=0)
+    recorder = None if parsed_args.record is None else TrajectoryRecorder(parsed_args.record)
+    bot = SNNBot(world.games[0], parsed_args.bot_name, agent, recorder)
     
     while True:
-        if os.path.exists(weights_path):
-            os.remove(weights_path)
-            print("Deleted weights file.")
-        bot.play(int(sys.argv[1]) * 60)
+        if agent is None:
+            bot.agent.reset_agent(forget=True)
+            print("Reset weights.")
+        bot.play(parsed_args.minutes_until_reset * 60)
@@ -0,0 +1,104 @@
+import numpy as np
+
+
+class OccupancyGrid(object):
+    """
+    NumPy mirror of the occupied tiles of a Traze grid with the free distances in all four directions.
+
+    Cells are indexed like Grid.valid, [x][y]. For every cell the run-length tables hold the number of free
+    cells in each direction before the next occupied cell or the border, so a ray is a single lookup.
+    Occupying a cell only rewrites the runs of its row and column. The mirror follows the grid
+    incrementally from the heads of the bikes and is rebuilt from the tiles when cells become free
+    (a bike died), when the size changes and every resync_interval updates as a safety net.
+    """
+
+    def __init__(self, resync_interval=100):
+        self.resync_interval = resync_interval
+        self.occupied = np.zeros((0, 0), dtype=bool)
+        self._ahead = {}
+        self._tiles = None
+        self._bikes = None
+        self._updates = 0
+
+    @property
+    def shape(self):
+        return self.occupied.shape
+
+    def update(self, grid):
+        """ Follow a grid update, calls with the same tiles as the last call are ignored. """
+        tiles = grid.tiles
+        if tiles is self._tiles:
+            return
+        self._tiles = tiles
+        self._updates += 1
+
+        bikes = self._bike_heads(grid)
+        if (bikes is None or self._bikes is None or not set(self._bikes) <= set(bikes)
+                or np.shape(tiles) != self.shape or self._updates % self.resync_interval == 0):
+            self.sync(tiles)
+        else:
+            for x, y in bikes.values():
+                if 0 <= x < self.shape[0] and 0 <= y < self.shape[1] and not self.occupied[x, y]:
+                    self.occupy(x, y)
+        self._bikes = bikes
+
+    def sync(self, tiles):
+        """ Rebuild the mirror and the run-length tables from the tiles. """
+        self.occupied = np.asarray(tiles) != 0
+        if self.occupied.ndim != 2:
+            self.occupied = self.occupied.reshape(len(tiles), -1)
+        self._ahead = {
+            (1, 0): self._runs(self.occupied, forward=True),
+            (-1, 0): self._runs(self.occupied, forward=False),
+            (0, 1): self._runs(self.occupied.T, forward=True).T,
+            (0, -1): self._runs(self.occupied.T, forward=False).T,
+        }
+
+    def occupy(self, x, y):
+        """ Mark a free cell as occupied and shorten the runs of the cells in its row and column. """
+        self.occupied[x, y] = True
+        ahead = self._ahead
+
+        # Cells before (x, y) now end their run at it, cells after it start a new run from it. This includes
+        # the occupied cells that bound the runs, a ray can start on them (e.g. at the head of a bike).
+        width, height = self.shape
+        start = max(x - ahead[(-1, 0)][x, y] - 1, 0)
+        ahead[(1, 0)][start:x, y] = np.arange(x - start - 1, -1, -1)
+        end = min(x + ahead[(1, 0)][x, y] + 2, width)
+        ahead[(-1, 0)][x + 1:end, y] = np.arange(end - x - 1)
+
+        start = max(y - ahead[(0, -1)][x, y] - 1, 0)
+        ahead[(0, 1)][x, start:y] = np.arange(y - start - 1, -1, -1)
+        end = min(y + ahead[(0, 1)][x, y] + 2, height)
+        ahead[(0, -1)][x, y + 1:end] = np.arange(end - y - 1)
+
+    def free_cells(self, point, dx, dy):
+        """ Number of free cells from point (not included) in the direction (dx, dy). """
+        return int(self._ahead[(dx, dy)][point[0], point[1]])
+
+    @staticmethod
+    def _runs(occupied, forward):
+        """ Free cells after each cell along the first axis, towards higher indices if forward. """
+        size = occupied.shape[0]
+        index = np.arange(size)[:, None]
+        if forward:
+            # Index of the next occupied cell (or the border) at or after each cell
+            blocked = np.where(occupied, index, size)
+            blocked = np.minimum.accumulate(blocked[::-1], axis=0)[::-1]
+            after = np.vstack([blocked[1:], np.full((1, occupied.shape[1]), size)])
+            return after - index - 1
+        blocked = np.where(occupied, index, -1)
+        blocked = np.maximum.accumulate(blocked, axis=0)
+        before = np.vstack([np.full((1, occupied.shape[1]), -1), blocked[:-1]])
+        return index - before - 1
+
+    @staticmethod
+    def _bike_heads(grid):
+        """ Current location of every bike by player id, None if the grid does not report bikes. """
+        bikes = getattr(grid, 'bikes', None)
+        if bikes is None:
+            return None
+        try:
+            return {bike['playerId']: tuple(bike['currentLocation']) for bike in bikes}
+        except (KeyError, TypeError):
+            return None
@@ -0,0 +1,56 @@
+import time
+import argparse
+import sys
+
+from snn.agent import SNNAgent, train_offline
+from snn.utils import print_me
+
+
+def parse_command_line_args(args):
+    """ Parse command-line arguments and organize them into a single structured object. """
+
+    parser = argparse.ArgumentParser(description='Train the SNN of the bot offline on trajectories recorded with SNNBot.py --record.')
+
+    parser.add_argument(
+        'trajectories',
+        type=str,
+        nargs='+',
+        help='Trajectory files to replay.',
+    )
+    parser.add_argument(
+        '--model',
+        type=str,
+        help='Weights file to continue from and to write to (default weights.h5).',
+    )
+    parser.add_argument(
+        '--passes',
+        type=int,
+        default=1,
+        help='How often all trajectories are replayed.',
+    )
+    parser.add_argument(
+        '--forget',
+        action='store_true',
+        help='Start from initial weights instead of the weights of --model.',
+    )
+
+    return parser.parse_args(args)
+
+
+if __name__ == "__main__":
+    parsed_args = parse_command_line_args(sys.argv[1:])
+    agent = SNNAgent(parsed_args.model, verbose=0)
+    if parsed_args.forget:
+        agent.reset_agent(forget=True)
+
+    for i in range(parsed_args.passes):
+        start = time.time()
+        episodes, steps = train_offline(agent, parsed_args.trajectories)
+        duration = time.time() - start
+        print("Pass %d / %d: %d episodes, %d steps, %.0f steps per second"
+              % (i + 1, parsed_args.passes, episodes, steps, steps / duration))
+        print('W_L-F-R: %s-%s-%s' % tuple(print_me(w, '4.0f') for w in agent.w))
+
+    agent.store.close()
+    agent.stats.flush()
+    print("Weights written to %s" % agent.store.path)
@@ -1,41 +1,162 @@
+import os
+import copy
 import random
+import warnings
 import numpy as np
 
-from .utils import print_me, AgentStatistics
-import snn.snn as ai
+from .utils import print_me, AgentStatistics, DecisionCache, RewardWindow, read_trajectories
+import snn.parameters as params
+from snn.checkpoint import WeightStore
+
+ai = None   # SNN backend, imported by load_backend when the first SNN agent is created
+
+
+def load_backend():
+    """ Import the SNN backend selected by params.backend, so NEST is only loaded if a network is needed. """
+    global ai
+    if ai is None:
+        if params.backend == 'numpy':
+            import snn.numpy_snn as backend
+        else:
+            import snn.snn as backend
+        ai = backend
+    return ai
+
+
+def simulate_decision(networks, gap=0.):
+    """
+    Simulate the decision window of the networks and return its length in ms for each of them.
+
+    With adaptive_decision the window is simulated in chunks of decision_chunk ms. A network has decided as soon as
+    one output neuron leads by decision_margin spikes: its input is stopped and the spikes in flight arrive within
+    decision_flush ms, so they are paired with its decision and not with the next reward. The window ends when all
+    networks have decided, at the latest after decision_max_time ms.
+    """
+    if not params.adaptive_decision:
+        ai.nest_simulate(params.sim_time_step + gap)
+        return np.full(len(networks), params.sim_time_step)
+
+    if gap:
+        ai.nest_simulate(gap)
+    decided = np.full(len(networks), np.nan)
+    elapsed = 0.
+    while elapsed < params.decision_max_time:
+        duration = min(params.decision_chunk, params.decision_max_time - elapsed)
+        ai.nest_simulate(duration)
+        elapsed += duration
+
+        counts = np.sort(ai.get_spike_counts_all(networks), axis=1)
+        lead = counts[:, -1] - counts[:, -2]
+        new = np.isnan(decided) & (lead >= params.decision_margin)
+        if new.any():
+            ai.stop_input_all([networks[i] for i in np.flatnonzero(new)])
+            decided[new] = elapsed
+        if not np.isnan(decided).any():
+            break
+
+    # Hard cap, the input of a full window has ended decision_flush ms before its end already
+    undecided = np.isnan(decided)
+    decided[undecided] = elapsed
+    if elapsed < params.sim_time_step:
+        if undecided.any():
+            ai.stop_input_all([networks[i] for i in np.flatnonzero(undecided)])
+        ai.nest_simulate(params.decision_flush)
+        decided += params.decision_flush
+    return decided
+
 
 ALL_SNAKE_ACTIONS = [-1, 0, 1]  # [turn_left, maintain_direction, turn_right]
 
 class SNNAgent():
     """ Represents a snake agent which actions come from a SNN. """
 
-    def __init__(self, model=None, verbose=1):
+    def __init__(self, model=None, verbose=1, fused=None):
         self.model = model
         self.verbose = verbose
+        # In fused mode the reward is delivered in the same simulation window as the next input
+        self.fused = params.fused_reward if fused is None else fused
+        if self.fused and params.backend != 'numpy':
+            warnings.warn('Fused reward windows cannot clear the STDP traces in NEST, part of them carries over '
+                          'to the next input, see fused_reward in parameters.py')
+        # The weights are kept in memory across episodes and checkpointed to the model file in the background
+        self.store = WeightStore(model)
+        # The statistics are streamed to the training file next to the model
+        self.stats = AgentStatistics(None if model is None else os.path.join(os.path.dirname(model), params.training_file))
+        # Decisions for inputs seen before are drawn from the cache while the weights keep their version
+        self.cache = DecisionCache() if params.decision_cache else None
+        load_backend()
+        self.snn = None
         self.reset_agent()
 
+    @property
+    def w(self):
+        """ Weights of the left, forward and right output neuron, read lazily from the SNN. """
+        return self.snn.get_weights()
+
     def begin_episode(self):
-        self.w = self.snn.try_restore_model(self.model)
-        self.stats.append(self.w)
+        self.stats.append(self.snn.get_weights)
         #self.snn.set_weights(np.array([3000.,0,0]), np.array([0,3000.,0]), np.array([0,0,3000.]))
 
-    def set_reward(self, reward):
-        self.rewards.append(reward)
-
-        N = 1 # Number of element used in the rolling average
-        reward = [float(sum(y)) / N for y in zip(*self.rewards[-N:])]
+    def set_reward(self, reward, simulate=True):
+        reward = self.average_reward(reward)
+        replay = self.note_reward(reward)
+        if replay is not None:
+            # The rewarded decision came from the cache, simulate it so the reward finds its eligibility trace
+            self.snn.set_input(replay)
+            self.snn.reset_neurons()
+            simulate_decision([self.snn])
         self.snn.set_reward(reward)
-        self.snn.reset_neurons()
-        ai.nest_simulate()
-        self.w = self.snn.get_results()[1]
+
+        if simulate:
+            self.snn.reset_neurons()
+            ai.nest_simulate()
+        else:
+            # Without a reward window the traces of the previous input would pair with the next input
+            self.snn.reset_traces()
 
         return reward
 
-    def reset_agent(self):
-        self.w = []
-        self.rewards = []
-        self.snn = ai.TrazeSNN()
-        self.stats = AgentStatistics()
+    def note_reward(self, reward):
+        """
+        Keep the decision cache consistent with a reward that is about to be delivered.
+
+        Returns:
+            The input of the rewarded decision if it came from the cache and has to be simulated first, else None.
+        """
+        replay, self._replay = self._replay, None
+        if not any(reward):
+            return None
+        # The dopamine changes the weights
+        self._learned = True
+        return replay
+
+    def average_reward(self, reward):
+        """ Record the reward and return the aggregate delivered to the network, see reward_aggregation. """
+        return self.rewards.push(reward)
+
+    def reset_agent(self, forget=False):
+        """
+        Start over with the stored weights, or with initial weights if forget is set.
+        The network is created once and reinitialized in place, so resets add no nodes to the kernel.
+        """
+        self.rewards = RewardWindow()
+        self.weight_version = 0
+        self._version_weights = None
+        self._learned = True
+        self._replay = None
+        if self.cache is not None:
+            self.cache.clear()
+        if self.snn is None:
+            self.snn = ai.TrazeSNN()
+        else:
+            self.snn.reinitialize()
+        self.stats.reset()
+
+        if forget:
+            self.store.reset()
+        weights = self.store.latest()
+        if weights is not None:
+            self.snn.set_weights(*weights)
 
     def prepare_input(self, inputs):
         # Reflect negative values into positive ones onto the oposite sensor side and normalize them
@@ -50,30 +171,203 @@ class SNNAgent():
 
         return ALL_SNAKE_ACTIONS[random.choice(idx)]
 
+    def lookup_decision(self, observation, reward):
+        """
+        Look up the decision for the prepared observation in the cache.
+
+        Returns:
+            The cache key and the action, the action is None if the network has to simulate the decision.
+        """
+        if self.fused and reward is not None and any(reward):
+            # The reward of a fused window is only delivered by simulating it
+            return None, None
+        if self._learned:
+            # Weights change only while there is dopamine, a new version starts once they moved noticeably
+            self._learned = False
+            w = np.array(self.w)
+            if self._version_weights is None or np.abs(w - self._version_weights).max() > params.decision_cache_tolerance:
+                self.weight_version += 1
+                self._version_weights = w
+        key = self.cache.key(observation, self.weight_version)
+        action = self.cache.lookup(key)
+        # A reward for a decision from the cache has to simulate its input first, see set_reward
+        self._replay = None if action is None else observation
+        if action is not None:
+            self.stats.append(self._version_weights, 0.)
+            if self.verbose > 0:
+                print('Inp: %s, cached' % print_me(observation, '.2f'))
+        return key, action
+
+    def get_eligibility(self):
+        """ Eligibility traces of the network, the next reward acts on them. """
+        return self.snn.get_eligibility()
+
+    def set_eligibility(self, eligibility):
+        """ Restore eligibility traces read with get_eligibility, e.g. to forget a decision that was not taken. """
+        self.snn.set_eligibility(eligibility)
+
+    def get_learning_state(self):
+        """ Weights, eligibility traces and reward window, the state a reward changes. """
+        return np.array(self.w), self.get_eligibility(), copy.deepcopy(self.rewards)
+
+    def set_learning_state(self, state):
+        """ Restore a state read with get_learning_state, e.g. to take back a reward that was not given. """
+        weights, eligibility, rewards = state
+        self.snn.set_weights(*weights)
+        self.set_eligibility(eligibility)
+        self.rewards = copy.deepcopy(rewards)
+        # The weights may have moved back, the cache has to check its weight version again
+        self._learned = True
+
+    def deliver_reward(self, reward):
+        """ Deliver the reward like act does before it decides, returns the reward given to the network. """
+        return self.set_reward(reward, not self.fused)
+
     def act(self, observation, reward):
-        reward = self.set_reward(reward)
+        return self.decide(observation, self.deliver_reward(reward))
+
+    def decide(self, observation, reward=None):
+        """ Choose the action for the observation, the reward has to be delivered with set_reward before. """
         observation = self.prepare_input(observation)
-        self.snn.set_input(observation)
+        key = None
+        if self.cache is not None:
+            key, action = self.lookup_decision(observation, reward)
+            if action is not None:
+                return action
+
+        # A fused window starts with a quiet gap, so the STDP traces of the previous input decay before the next
+        gap = params.fused_reward_gap if self.fused else 0.
+        self.snn.set_input(observation, gap)
 
         self.snn.reset_neurons()
-        ai.nest_simulate()
+        window = simulate_decision([self.snn], gap)[0]
 
-        output, self.w = self.snn.get_results()
-        self.stats.append(self.w)
+        output = self.snn.get_output()
+        self.stats.append(self.snn.get_weights, window)
 
         if self.verbose > 0:
             print('Rew: %s\n---' % (print_me(reward, '+.2f')))
-            print('Inp: %s, Out: %s' % (print_me(observation, '.2f'), print_me(output, '.2f')))
+            print('Inp: %s, Out: %s, Win: %.1f ms' % (print_me(observation, '.2f'), print_me(output, '.2f'), window))
             print('W_L-F-R: %s-%s-%s' % (print_me(self.w[0], '4.0f'), print_me(self.w[1], '4.0f'), print_me(self.w[2], '4.0f')))
 
         output = self.prepare_output(output)
+        if key is not None:
+            self.cache.record(key, output)
         return output
 
+    def learn(self, inputs, reward):
+        """ Deliver the reward and stimulate the network with prepared inputs like act, without choosing an action. """
+        self.set_reward(reward, not self.fused)
+
+        gap = params.fused_reward_gap if self.fused else 0.
+        self.snn.set_input(inputs, gap)
+
+        self.snn.reset_neurons()
+        window = simulate_decision([self.snn], gap)[0]
+
+        self.snn.get_output()
+        self.stats.append(self.snn.get_weights, window)
+
     def end_episode(self, reward):
         reward = self.set_reward(reward)
 
         if self.verbose > 0:
             print('Rew: %s' % (print_me(reward, '+.2f')))
 
-        self.snn.save_model(self.w)
+        self.store.update(self.w)
         return self.w
+
+
+class RateAgent():
+    """
+    Represents a snake agent which acts with the frozen weights of a trained SNN without simulating it.
+    The rate model gives the expected spike counts of the output neurons, they are turned into an action
+    like the spike counts of the SNN. The agent does not learn, it has no network, weight store or
+    decision cache and its statistics stay empty.
+    """
+
+    # Inputs and outputs are those of the SNN agent
+    prepare_input = SNNAgent.prepare_input
+    prepare_output = SNNAgent.prepare_output
+
+    def __init__(self, model=None, verbose=1):
+        """
+        Args:
+            model: weights or policy file (default weights.h5), or a RateModel.
+        """
+        from .rate_model import RateModel
+
+        self.model = params.default_dir + params.weights_file if model is None else model
+        self.verbose = verbose
+        self.rate_model = self.model if isinstance(self.model, RateModel) else RateModel.load(self.model)
+        self.cache = None
+        self.stats = AgentStatistics()
+
+    @property
+    def w(self):
+        return self.rate_model.weights
+
+    def begin_episode(self):
+        pass
+
+    def reset_agent(self, forget=False):
+        pass
+
+    def get_eligibility(self):
+        return None
+
+    def set_eligibility(self, eligibility):
+        pass
+
+    def get_learning_state(self):
+        return None
+
+    def set_learning_state(self, state):
+        pass
+
+    def deliver_reward(self, reward):
+        return reward
+
+    def act(self, observation, reward):
+        return self.decide(observation, reward)
+
+    def decide(self, observation, reward=None):
+        observation = self.prepare_input(observation)
+        output = self.rate_model.expected_counts(observation)
+
+        if self.verbose > 0:
+            print('Inp: %s, Out: %s' % (print_me(observation, '.2f'), print_me(output, '.2f')))
+
+        return self.prepare_output(output)
+
+    def end_episode(self, reward):
+        return self.w
+
+
+def train_offline(agent, paths, passes=1):
+    """
+    Train the network of an SNN agent on recorded trajectories, without a game server.
+
+    Every step is replayed like SNNAgent.act: its reward is delivered and the network is stimulated with the
+    recorded input. The recorded action is not enforced, the rewards are given per output neuron and act on
+    the eligibility traces the network builds for the input. The weights are stored after every episode.
+
+    Args:
+        agent: an SNNAgent, its network continues from its current weights.
+        paths: trajectory files written by TrajectoryRecorder.
+        passes (int): how often all trajectories are replayed.
+
+    Returns:
+        The number of replayed episodes and steps.
+    """
+    episodes = steps = 0
+    for _ in range(passes):
+        for path in paths:
+            for inputs, rewards in read_trajectories(path):
+                agent.begin_episode()
+                for x, reward in zip(inputs[:-1], rewards[:-1]):
+                    agent.learn(x, reward)
+                agent.end_episode(rewards[-1])
+                episodes += 1
+                steps += len(inputs)
+    return episodes, steps
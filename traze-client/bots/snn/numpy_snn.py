@@ -0,0 +1,372 @@
+#!/usr/bin/env python
+
+import sys
+import weakref
+import h5py
+import numpy as np
+
+from .parameters import *
+from . import parameters as params
+
+# Pure NumPy re-implementation of the network in snn.py. The NEST models are reproduced with their
+# NEST 2.16 defaults (overridden by iaf_params) on the same time grid:
+# poisson_generator -> parrot_neuron -> stdp_dopamine_synapse -> iaf_psc_alpha -> spike_detector.
+# A simulation window is solved in one go instead of step by step: the subthreshold membrane potential is
+# the convolution of the input spikes with the alpha PSP kernel, output spikes are found by walking the
+# threshold crossings and the R-STDP eligibility trace and dopamine are integrated in closed form.
+# Weights are applied once per window, like NEST the weight change is the integral of c * n.
+# Spikes still in flight at the end of a window, the synaptic currents of recent spikes and the refractory
+# period are carried over, so a window can be simulated in several shorter ones.
+
+iaf_psc_alpha_defaults = {
+    "C_m": 250.,                    # Membrane capacitance in pF
+    "tau_m": 10.,                   # Membrane time constant in ms
+    "tau_syn_ex": 2.,               # Rise time of the excitatory synaptic alpha function in ms
+    "tau_syn_in": 2.,               # Rise time of the inhibitory synaptic alpha function in ms
+    "t_ref": 2.,                    # Refractory period in ms
+    "E_L": -70.,                    # Resting membrane potential in mV
+    "V_reset": -70.,                # Reset potential of the membrane in mV
+    "V_th": -55.,                   # Spike threshold in mV
+    "tau_minus": 20.,               # Time constant of the postsynaptic STDP trace in ms
+}
+tau_plus = 20.                      # Time constant of the presynaptic STDP trace in ms
+delay = 1.                          # Delay of every connection in ms
+
+neuron_params = dict(iaf_psc_alpha_defaults, **iaf_params)
+
+_networks = weakref.WeakSet()       # All networks advanced by nest_simulate
+_kernels = {}                       # Fourier transformed PSP kernels by window length and time resolution
+
+
+def psp_kernel(tau_syn, steps):
+    """Membrane response of the output neurons to a single 1 pA alpha shaped synaptic current.
+    :param tau_syn: Rise time of the synaptic current in ms
+    :param steps: Number of simulation steps
+    :return: Potential in mV for each simulation step after the spike
+    """
+    tau_m, C_m = neuron_params["tau_m"], neuron_params["C_m"]
+    t = np.arange(steps) * params.time_resolution
+    a = 1. / tau_syn - 1. / tau_m
+    if abs(a) < 1e-12:
+        response = t * t / 2.
+    else:
+        response = (1. - np.exp(-a * t) * (1. + a * t)) / (a * a)
+    return np.e / (tau_syn * C_m) * np.exp(-t / tau_m) * response
+
+
+def current_response(tau_syn, t):
+    """Membrane response of the output neurons to a decaying alpha shaped current exp(-t / tau_syn) * (A + B * t).
+    :param tau_syn: Rise time of the synaptic current in ms
+    :param t: Times in ms
+    :return: Potential in mV at the times for A = 1 pA and for B = 1 pA/ms
+    """
+    tau_m, C_m = neuron_params["tau_m"], neuron_params["C_m"]
+    a = 1. / tau_syn - 1. / tau_m
+    if abs(a) < 1e-12:
+        response_a, response_b = t, t * t / 2.
+    else:
+        response_a = -np.expm1(-a * t) / a
+        response_b = (1. - np.exp(-a * t) * (1. + a * t)) / (a * a)
+    decay = np.exp(-t / tau_m) / C_m
+    return decay * response_a, decay * response_b
+
+
+def get_kernels(steps):
+    """Return the Fourier transformed excitatory and inhibitory PSP kernels for a window of steps.
+    :param steps: Number of simulation steps of the window
+    :return: fft_size, kernel_ex, kernel_in
+    """
+    key = (steps, params.time_resolution)
+    if key not in _kernels:
+        fft_size = 1 << (2 * steps - 1).bit_length()
+        _kernels[key] = (fft_size,
+                           np.fft.rfft(psp_kernel(neuron_params["tau_syn_ex"], steps), fft_size),
+                           np.fft.rfft(psp_kernel(neuron_params["tau_syn_in"], steps), fft_size))
+    return _kernels[key]
+
+
+def trace_at(times, spike_times, spike_sources, initial, tau):
+    """Value of exponential spike traces at the given times, only spikes strictly before a time count.
+    :param times: Times to evaluate the traces at in ms
+    :param spike_times: Spike times in ms
+    :param spike_sources: Index of the source of each spike
+    :param initial: Value of each trace at the beginning of the window
+    :param tau: Time constant of the traces in ms
+    :return: Array of shape (len(times), len(initial))
+    """
+    lag = times[:, None] - spike_times[None, :]
+    contribution = np.where(lag > 0, np.exp(-np.abs(lag) / tau), 0.)
+    sources = np.eye(len(initial))[spike_sources]
+    return np.outer(np.exp(-times / tau), initial) + contribution.dot(sources)
+
+
+def find_spikes(v, v_th, v_reset, decay, ref_steps, refractory=0):
+    """Find the spikes of a neuron given its membrane potential without resets.
+    After each spike the potential is clamped for the refractory period and the remaining trajectory
+    is shifted down by the decaying reset, which is exact for the linear subthreshold dynamics.
+    :param v: Membrane potential of the neuron, modified in place
+    :param v_th: Spike threshold
+    :param v_reset: Reset potential
+    :param decay: Membrane decay factor for each simulation step
+    :param ref_steps: Number of simulation steps of the refractory period
+    :param refractory: Remaining refractory steps of a spike in the previous window
+    :return: Simulation steps of the spikes
+    """
+    spikes = []
+    start = min(refractory, v.size)
+    if start:
+        v[:start] = v_reset
+        if start < v.size:
+            v[start:] -= (v[start] - v_reset) * decay[:v.size - start]
+    while True:
+        above = np.flatnonzero(v[start:] >= v_th)
+        if above.size == 0:
+            return spikes
+        step = start + above[0]
+        spikes.append(step)
+        start = step + ref_steps
+        v[step:start] = v_reset
+        if start >= v.size:
+            return spikes
+        v[start:] -= (v[start] - v_reset) * decay[:v.size - start]
+
+
+def nest_simulate(duration=None):
+    """Simulate all networks
+    :param duration: Simulation time in ms, sim_time_step by default
+    """
+    if duration is None:
+        duration = params.sim_time_step
+    for network in list(_networks):
+        network.simulate(duration)
+
+
+def reset_kernel():
+    """Forget all networks, networks created before are not simulated any more.
+    Use TrazeSNN.reinitialize to start over with a network instead.
+    """
+    _networks.clear()
+
+
+def get_spike_counts_all(networks):
+    """Read the number of spikes of several networks without resetting them
+    :param networks: The networks
+    :return: Array of shape (len(networks), output_layer_size)
+    """
+    return np.array([network.get_spike_counts() for network in networks]).reshape(len(networks), output_layer_size)
+
+
+def stop_input_all(networks):
+    """Stop the inputs of several networks
+    :param networks: The networks
+    """
+    for network in networks:
+        network.stop_input()
+
+
+class TrazeSNN:
+    def __init__(self):
+        self.reinitialize()
+        _networks.add(self)
+
+    def reinitialize(self):
+        """Draw new initial weights and clear the state of the network in place.
+        The eligibility traces, the dopamine, the inputs, the membrane potentials and the spike counts are reset.
+        """
+        synapse = r_stdp_synapse_options["weight"]
+        self.weights = np.random.uniform(synapse["low"], synapse["high"], (output_layer_size, input_layer_size))
+        self.rates = np.zeros(input_layer_size)
+        self.input_delay = 0
+        self.input_steps = 0
+        self.v_m = np.full(output_layer_size, neuron_params["E_L"])
+        self.n_events = np.zeros(output_layer_size)
+        self.c = np.zeros((output_layer_size, input_layer_size))
+        self.n = np.zeros(output_layer_size)
+        self.k_plus = np.zeros(input_layer_size)
+        self.k_minus = np.zeros(output_layer_size)
+        # Carried over between windows: input spikes not sent or not arrived yet (steps from the start of the
+        # next window), the excitatory and inhibitory synaptic currents of the output neurons at the last step,
+        # as exp(-t / tau_syn) * (A + B * t), and the remaining refractory steps of the output neurons
+        self.pending = (np.zeros(0, dtype=int), np.zeros(0, dtype=int))
+        self.arrivals = (np.zeros(0, dtype=int), np.zeros(0, dtype=int))
+        self.currents = np.zeros((2, 2, output_layer_size))
+        self.refractory = np.zeros(output_layer_size, dtype=int)
+
+    def reset_neurons(self):
+        self.v_m[:] = V_reset
+        self.n_events[:] = 0
+
+    def set_reward(self, reward):
+        self.n[:] = reward
+
+    def reset_traces(self):
+        """Forget the STDP traces of the spikes before, the eligibility traces are kept for the reward."""
+        self.k_plus[:] = 0
+        self.k_minus[:] = 0
+
+    def get_eligibility(self):
+        return self.c.copy()
+
+    def set_eligibility(self, eligibility):
+        self.c[:] = np.reshape(eligibility, self.c.shape)
+
+    def set_input(self, state, start=0.):
+        self.rates = np.multiply(np.clip(state, 0, 1), params.max_poisson_freq)
+        self.input_delay = int(round(start / params.time_resolution))
+        self.input_steps = int(round((params.sim_time_step - 10) / params.time_resolution))
+
+    def stop_input(self):
+        self.input_delay = 0
+        self.input_steps = 0
+
+    def set_weights(self, weights_l, weights_f, weights_r):
+        self.weights[left_neuron] = weights_l
+        self.weights[forward_neuron] = weights_f
+        self.weights[right_neuron] = weights_r
+
+    def get_output(self):
+        output = self.n_events / params.n_max
+        self.n_events = np.zeros(output_layer_size)
+        return output
+
+    def get_spike_counts(self):
+        return self.n_events.copy()
+
+    def get_weights(self):
+        return [self.weights[left_neuron].copy(), self.weights[forward_neuron].copy(), self.weights[right_neuron].copy()]
+
+    def get_results(self):
+        return self.get_output(), self.get_weights()
+
+    def simulate(self, duration):
+        """Advance the network by duration ms.
+        :param duration: Length of the simulation window in ms
+        """
+        steps = int(round(duration / params.time_resolution))
+        delay_steps = int(round(delay / params.time_resolution))
+        t = np.arange(steps) * params.time_resolution
+        decay = np.exp(-t / neuron_params["tau_m"])
+
+        # Poisson spikes of the generators while they are active, repeated by the parrot neurons
+        quiet = min(steps, self.input_delay)
+        self.input_delay -= quiet
+        active = min(steps - quiet, self.input_steps)
+        self.input_steps -= active
+        counts = np.random.poisson(self.rates * active * params.time_resolution / 1000.)
+        pre_sources = np.concatenate([self.pending[0], np.repeat(np.arange(input_layer_size), counts)])
+        pre_steps = np.concatenate([self.pending[1],
+                                    np.random.randint(0, max(active, 1), counts.sum()) + quiet + delay_steps])
+        sent = pre_steps < steps
+        self.pending = (pre_sources[~sent], pre_steps[~sent] - steps)
+        pre_sources, pre_steps = pre_sources[sent], pre_steps[sent]
+
+        # Membrane potential without resets, the state of the last window is one step before this one
+        since_last = t + params.time_resolution
+        v = np.outer(np.exp(-since_last / neuron_params["tau_m"]), self.v_m - neuron_params["E_L"]) + neuron_params["E_L"]
+        arrival_sources = np.concatenate([self.arrivals[0], pre_sources])
+        arrival_steps = np.concatenate([self.arrivals[1], pre_steps + delay_steps])
+        arrived = arrival_steps < steps
+        self.arrivals = (arrival_sources[~arrived], arrival_steps[~arrived] - steps)
+        arrival_sources, arrival_steps = arrival_sources[arrived], arrival_steps[arrived]
+
+        synapses = ((np.maximum(self.weights, 0), neuron_params["tau_syn_ex"]),
+                    (np.minimum(self.weights, 0), neuron_params["tau_syn_in"]))
+        for (synapse_weights, tau_syn), (A, B) in zip(synapses, self.currents):
+            if A.any() or B.any():
+                response_a, response_b = current_response(tau_syn, since_last)
+                v += np.outer(response_a, A) + np.outer(response_b, B)
+        if arrival_sources.size:
+            spikes = np.zeros((steps, input_layer_size))
+            np.add.at(spikes, (arrival_steps, arrival_sources), 1.)
+            fft_size, kernel_ex, kernel_in = get_kernels(steps)
+            current = np.fft.rfft(spikes.dot(synapses[0][0].T), fft_size, axis=0) * kernel_ex[:, None]
+            if self.weights.min() < 0:
+                current += np.fft.rfft(spikes.dot(synapses[1][0].T), fft_size, axis=0) * kernel_in[:, None]
+            v += np.fft.irfft(current, fft_size, axis=0)[:steps]
+
+        # Synaptic currents at the last step, an alpha current has A = w e / tau_syn * s exp(-s / tau_syn)
+        # and B = w e / tau_syn * exp(-s / tau_syn) s ms after its spike
+        duration_steps = steps * params.time_resolution
+        age = (steps - 1 - arrival_steps) * params.time_resolution
+        for (synapse_weights, tau_syn), currents in zip(synapses, self.currents):
+            A, B = currents
+            currents[0] = np.exp(-duration_steps / tau_syn) * (A + B * duration_steps)
+            currents[1] = np.exp(-duration_steps / tau_syn) * B
+            if arrival_sources.size:
+                b = np.bincount(arrival_sources, np.e / tau_syn * np.exp(-age / tau_syn), input_layer_size)
+                a = np.bincount(arrival_sources, np.e / tau_syn * age * np.exp(-age / tau_syn), input_layer_size)
+                currents[0] += synapse_weights.dot(a)
+                currents[1] += synapse_weights.dot(b)
+
+        # Output spikes
+        ref_steps = max(1, int(round(neuron_params["t_ref"] / params.time_resolution)))
+        post_sources, post_steps = [], []
+        for i in range(output_layer_size):
+            neuron_spikes = find_spikes(v[:, i], neuron_params["V_th"], neuron_params["V_reset"], decay, ref_steps,
+                                        self.refractory[i])
+            self.refractory[i] = max(self.refractory[i] - steps, neuron_spikes[-1] + ref_steps - steps if neuron_spikes else 0, 0)
+            post_sources += [i] * len(neuron_spikes)
+            post_steps += neuron_spikes
+        post_sources = np.array(post_sources, dtype=int)
+        self.v_m = v[-1].copy()
+        self.n_events += np.bincount(post_sources, minlength=output_layer_size)
+        self.apply_r_stdp(pre_steps * params.time_resolution, pre_sources,
+                          np.array(post_steps) * params.time_resolution, post_sources, duration)
+
+    def apply_r_stdp(self, pre_times, pre_sources, post_times, post_sources, duration):
+        """Update the eligibility traces, dopamine and weights of the R-STDP synapses for one window.
+        :param pre_times: Times of the spikes of the input layer in ms
+        :param pre_sources: Index of the input neuron of each input spike
+        :param post_times: Times of the spikes of the output layer in ms
+        :param post_sources: Index of the output neuron of each output spike
+        :param duration: Length of the window in ms
+        """
+        taus = 1. / tau_c + 1. / tau_n
+        decay_c = lambda times: np.exp(-(duration - times) / tau_c)
+        dopamine = lambda times: np.exp(-times / tau_n) * -np.expm1(-taus * (duration - times)) / taus
+
+        # Facilitation at output spikes, depression at input spikes
+        k_plus = trace_at(post_times, pre_times, pre_sources, self.k_plus, tau_plus)
+        k_minus = trace_at(pre_times, post_times, post_sources, self.k_minus, neuron_params["tau_minus"])
+        post = np.eye(output_layer_size)[post_sources].T
+        pre = np.eye(input_layer_size)[pre_sources]
+        facilitate = A_plus * k_plus
+        depress = -A_minus * k_minus
+
+        c_dopamine = self.c * -np.expm1(-taus * duration) / taus
+        c_dopamine += post.dot(facilitate * dopamine(post_times)[:, None])
+        c_dopamine += (depress * dopamine(pre_times)[:, None]).T.dot(pre)
+        self.weights = np.clip(self.weights + self.n[:, None] * c_dopamine, w_min, w_max)
+
+        self.c = self.c * np.exp(-duration / tau_c)
+        self.c += post.dot(facilitate * decay_c(post_times)[:, None])
+        self.c += (depress * decay_c(pre_times)[:, None]).T.dot(pre)
+        self.n *= np.exp(-duration / tau_n)
+        self.k_plus = self.k_plus * np.exp(-duration / tau_plus) + pre.T.dot(np.exp(-(duration - pre_times) / tau_plus))
+        self.k_minus = self.k_minus * np.exp(-duration / neuron_params["tau_minus"]) + \
+            post.dot(np.exp(-(duration - post_times) / neuron_params["tau_minus"]))
+
+    def try_restore_model(self, model=None):
+        try:
+            path = default_dir + weights_file if model is None else model
+
+            with h5py.File(path, 'r+') as h5f:
+                w = np.array(h5f.get('w'))
+                self.set_weights(w[left_neuron], w[forward_neuron], w[right_neuron])
+                h5f.close()
+        except IOError as _:
+            pass
+        except:
+            print('Unexpected error:', sys.exc_info()[0])
+
+        return self.get_weights()
+
+    def save_model(self, model, path=None):
+        try:
+            path = default_dir + weights_file if path is None else path
+
+            with h5py.File(path, 'w') as h5f:
+                h5f.create_dataset('w', data=model)
+                h5f.close()
+        except:
+            print('Unexpected error:', sys.exc_info()[0])
@@ -1,22 +1,316 @@
+import sys
+import atexit
+import random
+import weakref
+from collections import Counter, OrderedDict
+import h5py
 import numpy as np
-import matplotlib.pyplot as plt
 
-class AgentStatistics(object):    
-    """ Represents the summary of the agent's performance. """
+from . import parameters as params
 
-    def __init__(self):
+_pending = weakref.WeakSet()    # Statistics and recorders with unwritten samples, flushed at exit if still alive
+
+
+class AgentStatistics(object):
+    """ Represents the summary of the agent's performance.
+
+    The weights and the length of the decision window are sampled every sample_every steps into a
+    preallocated chunk, which is appended to the training file when it is full. For plotting, a decimated
+    overview of the whole history is kept that halves its resolution whenever it is full, so memory stays
+    bounded however long the agent runs. If record (stats_record) is off, nothing is written and only the overview is kept.
+    """
+
+    def __init__(self, path=None, sample_every=params.stats_sample_every, chunk_size=params.stats_chunk_size,
+                 max_points=params.stats_max_points, record=None):
+        self.path = params.default_dir + params.training_file if path is None else path
+        self.record = params.stats_record if record is None else record
+        self.sample_every = sample_every
+        self.chunk_size = chunk_size
+        self.max_points = max_points
+        self.filled = 0
         self.reset()
 
     def reset(self):
-        self.w = []
-    
-    def append(self, w=None):
-        self.w.append(np.array(w).reshape(-1))
+        """ Start a new run, the samples of the previous run are written first. """
+        self.flush()
+        self.steps = 0
+        self.window_total = 0.
+        self.window_count = 0
+        self.chunk = None
+        self.chunk_steps = None
+        self.chunk_windows = None
+        self.filled = 0
+        self.overview = None
+        self.overview_steps = None
+        self.overview_size = 0
+        self.stride = self.sample_every
+        self.group = None
+
+    @property
+    def w(self):
+        """ Decimated overview of the recorded weights, one row per sample. """
+        return self.overview[:self.overview_size] if self.overview is not None else np.empty((0, 0))
+
+    @property
+    def mean_window(self):
+        """ Mean length of the decision windows of this run in ms. """
+        return self.window_total / self.window_count if self.window_count else np.nan
+
+    def append(self, w=None, window=None):
+        """
+        Record the weights and the length of the decision window in ms (NaN if unknown) of a step.
+        The weights can be given as a function returning them, it is only called on the sampled steps.
+        """
+        step = self.steps
+        self.steps += 1
+        if window is not None:
+            self.window_total += window
+            self.window_count += 1
+        if step % self.sample_every:
+            return
+
+        if callable(w):
+            w = w()
+        w = np.asarray(w, dtype=float).reshape(-1)
+        if self.overview is None:
+            self.overview = np.empty((self.max_points, w.size))
+            self.overview_steps = np.empty(self.max_points, dtype=np.int64)
+
+        if self.record:
+            if self.chunk is None:
+                self.chunk = np.empty((self.chunk_size, w.size))
+                self.chunk_steps = np.empty(self.chunk_size, dtype=np.int64)
+                self.chunk_windows = np.empty(self.chunk_size)
+            self.chunk[self.filled], self.chunk_steps[self.filled] = w, step
+            self.chunk_windows[self.filled] = np.nan if window is None else window
+            _pending.add(self)
+            self.filled += 1
+            if self.filled == self.chunk_size:
+                self.flush()
+
+        if step % self.stride:
+            return
+        if self.overview_size == self.max_points:
+            # Keep every second sample and continue with twice the stride
+            half = (self.max_points + 1) // 2
+            self.overview[:half] = self.overview[::2]
+            self.overview_steps[:half] = self.overview_steps[::2]
+            self.overview_size = half
+            self.stride *= 2
+            if step % self.stride:
+                return
+        self.overview[self.overview_size], self.overview_steps[self.overview_size] = w, step
+        self.overview_size += 1
+
+    def flush(self):
+        """ Append the samples of the current chunk to the training file. """
+        if not self.filled:
+            return
+        try:
+            with h5py.File(self.path, 'a') as h5f:
+                if self.group is None:
+                    # Every recorder writes its own run
+                    self.group = 'run_%d' % len(h5f)
+                    group = h5f.create_group(self.group)
+                    size = self.chunk.shape[1]
+                    group.create_dataset('w', (0, size), maxshape=(None, size), chunks=(self.chunk_size, size), dtype=float)
+                    group.create_dataset('step', (0,), maxshape=(None,), chunks=(self.chunk_size,), dtype=np.int64)
+                    group.create_dataset('window', (0,), maxshape=(None,), chunks=(self.chunk_size,), dtype=float)
+                w, step, window = h5f[self.group]['w'], h5f[self.group]['step'], h5f[self.group]['window']
+                start = len(step)
+                for dataset in (w, step, window):
+                    dataset.resize(start + self.filled, axis=0)
+                w[start:], step[start:] = self.chunk[:self.filled], self.chunk_steps[:self.filled]
+                window[start:] = self.chunk_windows[:self.filled]
+        except:
+            print('Unexpected error:', sys.exc_info()[0])
+        self.filled = 0
+        _pending.discard(self)
 
     def plot(self):
-        plt.plot(self.w)
+        import matplotlib.pyplot as plt
+
+        if self.overview is None:
+            return
+        plt.plot(self.overview_steps[:self.overview_size], self.w)
         plt.show()
 
 
+class RewardWindow(object):
+    """ Aggregates the rewards of the steps into the reward delivered to the network, in constant time and memory.
+
+    'mean' is the rolling mean of the last size rewards. They are kept in a ring buffer with their running sum,
+    which is summed up again whenever the buffer wraps around, so rounding errors do not accumulate. Like the
+    rolling mean it replaces, the sum is divided by size also while fewer rewards have been pushed.
+    'discounted' is the exponentially discounted average, every older reward weighs discount times less.
+    """
+
+    def __init__(self, aggregation=params.reward_aggregation, size=params.reward_window, discount=params.reward_discount):
+        if aggregation not in ('mean', 'discounted'):
+            raise ValueError('Unknown reward aggregation: %s' % aggregation)
+        self.aggregation = aggregation
+        self.size = size
+        self.discount = discount
+        self.reset()
+
+    def reset(self):
+        """ Forget all rewards. """
+        self.buffer = np.zeros((self.size, params.output_layer_size))
+        self.total = np.zeros(params.output_layer_size)
+        self.index = 0
+
+    def push(self, reward):
+        """ Add the reward of a step and return the aggregate, one value per output neuron. """
+        reward = np.asarray(reward, dtype=float)
+        if self.aggregation == 'discounted':
+            self.total = self.discount * self.total + (1. - self.discount) * reward
+            return self.total.tolist()
+
+        self.total += reward - self.buffer[self.index]
+        self.buffer[self.index] = reward
+        self.index = (self.index + 1) % self.size
+        if self.index == 0:
+            self.total = self.buffer.sum(axis=0)
+        return (self.total / self.size).tolist()
+
+
+class TrajectoryRecorder(object):
+    """ Records the steps of episodes to a trajectory file, which train_offline replays to train a network.
+
+    Every step holds the observation, the prepared input of the SNN, the reward received at the beginning of the
+    step and the action taken for it. The last step of an episode is marked done, it holds the terminal reward
+    and no action. The steps are collected in a preallocated chunk that is appended to the file when it is full,
+    recordings of several sessions are appended to the same file.
+    """
+
+    def __init__(self, path, chunk_size=params.stats_chunk_size):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.chunk = None
+        self.filled = 0
+        self.steps = 0
+        self.episodes = 0
+
+    def append(self, observation, inputs, reward, action=0, done=False):
+        """ Record a step, the action is the index of the action taken or the action itself. """
+        if self.chunk is None:
+            self.chunk = {
+                'observations': np.empty((self.chunk_size, np.size(observation)), dtype=np.float32),
+                'inputs': np.empty((self.chunk_size, np.size(inputs)), dtype=np.float32),
+                'rewards': np.empty((self.chunk_size, np.size(reward)), dtype=np.float32),
+                'actions': np.empty(self.chunk_size, dtype=np.int8),
+                'done': np.empty(self.chunk_size, dtype=bool),
+            }
+        i = self.filled
+        self.chunk['observations'][i] = np.ravel(observation)
+        self.chunk['inputs'][i] = np.ravel(inputs)
+        self.chunk['rewards'][i] = np.ravel(reward)
+        self.chunk['actions'][i], self.chunk['done'][i] = action, done
+        self.filled += 1
+        self.steps += 1
+        self.episodes += done
+        _pending.add(self)
+        if self.filled == self.chunk_size:
+            self.flush()
+
+    def end_episode(self, observation, inputs, reward):
+        """ Record the end of an episode with the terminal reward. """
+        self.append(observation, inputs, reward, done=True)
+
+    def flush(self):
+        """ Append the steps of the current chunk to the trajectory file. """
+        if not self.filled:
+            return
+        try:
+            with h5py.File(self.path, 'a') as h5f:
+                for name, chunk in self.chunk.items():
+                    if name not in h5f:
+                        shape = chunk.shape[1:]
+                        h5f.create_dataset(name, (0,) + shape, maxshape=(None,) + shape, chunks=(self.chunk_size,) + shape,
+                                           dtype=chunk.dtype)
+                    dataset = h5f[name]
+                    start = len(dataset)
+                    dataset.resize(start + self.filled, axis=0)
+                    dataset[start:] = chunk[:self.filled]
+        except:
+            print('Unexpected error:', sys.exc_info()[0])
+        self.filled = 0
+        _pending.discard(self)
+
+
+def read_trajectories(path):
+    """ Yield the prepared inputs and the rewards of every complete episode of a trajectory file. """
+    with h5py.File(path, 'r') as h5f:
+        inputs, rewards = h5f['inputs'], h5f['rewards']
+        # Steps after the last done belong to an episode that was not finished
+        start = 0
+        for end in np.flatnonzero(h5f['done'][()]) + 1:
+            yield inputs[start:end], rewards[start:end]
+            start = end
+
+
+class DecisionCache(object):
+    """ LRU cache of the decisions of a network for quantized inputs.
+
+    The key of an entry is the input rounded to multiples of resolution and the version of the weights that
+    decided, so entries of older weights are never served and age out. An entry counts the actions the network
+    chose for its input. Once it has seen samples decisions, lookup draws an action from their distribution
+    instead of simulating, so the randomness of the spiking decisions is kept.
+    """
+
+    def __init__(self, size=params.decision_cache_size, samples=params.decision_cache_samples,
+                 resolution=params.decision_cache_resolution):
+        self.size = size
+        self.samples = samples
+        self.resolution = resolution
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def key(self, inputs, version):
+        """ Key of the prepared inputs decided with the weights of the given version. """
+        return (version,) + tuple(int(round(x / self.resolution)) for x in inputs)
+
+    def lookup(self, key):
+        """ Return an action drawn from the decisions of the entry, None if it has not seen enough decisions. """
+        counts = self._entries.get(key)
+        if counts is None or sum(counts.values()) < self.samples:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return random.choices(list(counts), weights=list(counts.values()))[0]
+
+    def record(self, key, action):
+        """ Count a simulated decision, the least recently used entry is evicted if the cache is full. """
+        counts = self._entries.get(key)
+        if counts is None:
+            counts = self._entries[key] = Counter()
+            if len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        else:
+            self._entries.move_to_end(key)
+        counts[action] += 1
+
+    def clear(self):
+        self._entries.clear()
+
+    def summary(self):
+        lookups = self.hits + self.misses
+        return 'decision cache %d hits (%.0f%%), %d misses, %d evictions, %d entries' % (
+            self.hits, 100. * self.hits / max(lookups, 1), self.misses, self.evictions, len(self))
+
+
+@atexit.register
+def _flush_recorders():
+    for recorder in list(_pending):
+        recorder.flush()
+
+
 def print_me(array, style='.2f'):
     return str([format(x,style) for x in np.array(array).reshape(-1)]).replace('\'','')
@@ -0,0 +1,137 @@
+import queue
+import threading
+
+
+class Job(object):
+    """ Work for the agent on the worker thread, done is set when output holds the action. """
+
+    def __init__(self, work, observation=None, reward=None):
+        self.work = work
+        self.observation = observation
+        self.reward = reward
+        self.output = None
+        self.learning_state = None
+        self.eligibility = None
+        self.done = threading.Event()
+
+
+class SpeculativeAgent(object):
+    """
+    Runs an agent one tick ahead on a worker thread.
+
+    The reward of a decision and the next position of the bike are known as soon as the decision is made,
+    so speculate delivers the reward and decides for the observation predicted at the next position right
+    away. act returns that decision if the observation turns out as predicted and otherwise decides again
+    for the actual observation. A decision window leaves eligibility traces that the next reward acts on,
+    so the traces are read before the speculative decision and restored if the prediction misses, the decision
+    comes too late or the episode ends first. The next reward then only acts on decisions that were actually
+    taken. If the caller gives another reward than the one delivered, the weights, traces and reward window from
+    before the speculation are restored and the reward is delivered again, so only the actual reward is learned.
+    If the agent does not answer within budget seconds, act returns None and the caller has to choose.
+    """
+
+    def __init__(self, agent, budget=None):
+        self.agent = agent
+        self.budget = budget
+        self.hits = 0
+        self.misses = 0
+        self.late = 0
+        self._speculation = None
+        self._jobs = queue.Queue()
+        self._last_job = None
+        self._worker = threading.Thread(target=self._run, name='SpeculativeAgent', daemon=True)
+        self._worker.start()
+
+    def speculate(self, observation, reward):
+        """ Deliver the reward and decide for the predicted observation of the next tick. """
+        job = Job(None, observation, reward)
+
+        def work():
+            job.learning_state = self.agent.get_learning_state()
+            delivered = self.agent.deliver_reward(reward)
+            job.eligibility = self.agent.get_eligibility()
+            return self.agent.decide(observation, delivered)
+
+        job.work = work
+        self._speculation = self._submit(job)
+
+    def act(self, observation, reward):
+        """ Return the action for the observation, or None if it is not ready within the budget. """
+        speculation, self._speculation = self._speculation, None
+        if speculation is None:
+            return self._wait(self._submit(Job(lambda: self.agent.act(observation, reward))))
+        if speculation.reward != reward:
+            # The speculation delivered another reward, take it back and deliver the actual one
+            self.misses += 1
+            return self._wait(self._submit(Job(lambda: self._act_again(speculation, observation, reward))))
+
+        if not speculation.done.wait(self.budget):
+            # The caller chooses without the speculative decision, the next reward must not act on it
+            self.late += 1
+            self._submit(Job(lambda: self._forget(speculation)))
+            return None
+        if speculation.observation == observation:
+            self.hits += 1
+            return speculation.output
+
+        # The reward has been delivered already, only the decision is repeated
+        self.misses += 1
+        return self._wait(self._submit(Job(lambda: self._decide_again(speculation, observation, reward))))
+
+    def end_episode(self, reward):
+        """ Finish the pending work and end the episode of the agent. """
+        speculation, self._speculation = self._speculation, None
+        self.wait_idle()
+        if speculation is not None:
+            if speculation.reward == reward:
+                # The bike never reached the predicted position, the last reward must not act on its decision.
+                # The speculation has delivered the last reward already.
+                self._forget(speculation)
+                reward = [0] * len(reward)
+            else:
+                self.agent.set_learning_state(speculation.learning_state)
+        return self.agent.end_episode(reward)
+
+    def summary(self):
+        return 'speculation %d hits, %d misses, %d late' % (self.hits, self.misses, self.late)
+
+    def cancel(self):
+        """ Forget the speculation, e.g. because a new game starts. """
+        self._speculation = None
+
+    def wait_idle(self):
+        """ Block until all submitted work is done. """
+        if self._last_job is not None:
+            self._last_job.done.wait()
+
+    def _forget(self, speculation):
+        """ Restore the eligibility traces from before the speculative decision. """
+        if speculation.eligibility is not None:
+            self.agent.set_eligibility(speculation.eligibility)
+
+    def _decide_again(self, speculation, observation, reward):
+        self._forget(speculation)
+        return self.agent.decide(observation, reward)
+
+    def _act_again(self, speculation, observation, reward):
+        self.agent.set_learning_state(speculation.learning_state)
+        return self.agent.act(observation, reward)
+
+    def _submit(self, job):
+        self._last_job = job
+        self._jobs.put(job)
+        return job
+
+    def _wait(self, job):
+        if not job.done.wait(self.budget):
+            self.late += 1
+            return None
+        return job.output
+
+    def _run(self):
+        while True:
+            job = self._jobs.get()
+            try:
+                job.output = job.work()
+            finally:
+                job.done.set()
@@ -0,0 +1,10 @@
+import os
+import sys
+
+# The bot modules are imported like SNNBot.py does, from the bots directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import snn.parameters as params
+
+# The tests do not need NEST, the NumPy backend simulates the same network
+params.backend = 'numpy'
@@ -0,0 +1,74 @@
+import random
+import threading
+
+import numpy as np
+
+from snn.agent import SNNAgent, load_backend
+from speculation import Job, SpeculativeAgent
+
+
+def make_agent(path):
+    """ An agent whose network only depends on the seed, so two of them start out the same. """
+    # Every simulation advances all networks, only the new one may be simulated from now on
+    load_backend().reset_kernel()
+    np.random.seed(1)
+    random.seed(1)
+    agent = SNNAgent(str(path / 'weights.h5'), verbose=0)
+    agent.act([-1., -0.5, -0.2], [0, 0, 0])
+    return agent
+
+
+def record_rewards(agent):
+    """ Record the reward, weights and eligibility traces every time a reward is delivered. """
+    calls = []
+    set_reward = agent.set_reward
+
+    def recording_set_reward(reward, simulate=True):
+        calls.append((list(reward), np.array(agent.w), agent.get_eligibility()))
+        return set_reward(reward, simulate)
+
+    agent.set_reward = recording_set_reward
+    return calls
+
+
+def test_mismatched_reward_is_delivered_like_without_speculation(tmp_path):
+    observation, reward = [-0.4, -0.9, -0.3], [-1., 0.5, 0.5]
+    (tmp_path / 'plain').mkdir()
+    plain = make_agent(tmp_path / 'plain')
+    expected = record_rewards(plain)
+    plain.act(observation, reward)
+
+    (tmp_path / 'speculative').mkdir()
+    agent = make_agent(tmp_path / 'speculative')
+    speculation = SpeculativeAgent(agent)
+    speculation.speculate([-0.5, -0.3, -1.], [0.2, -0.1, -0.1])
+    speculation.wait_idle()
+    calls = record_rewards(agent)
+    speculation.act(observation, reward)
+    speculation.wait_idle()
+
+    # One delivery of the actual reward, on the weights and traces the agent had without speculating
+    assert len(calls) == len(expected) == 1
+    for (reward, weights, eligibility), (expected_reward, expected_weights, expected_eligibility) in zip(calls, expected):
+        assert reward == expected_reward
+        np.testing.assert_array_equal(weights, expected_weights)
+        np.testing.assert_array_equal(eligibility, expected_eligibility)
+    assert speculation.misses == 1
+
+
+def test_late_speculation_is_forgotten(tmp_path):
+    agent = make_agent(tmp_path)
+    speculation = SpeculativeAgent(agent, budget=0.)
+    # Hold the worker, so the speculative decision is not ready in time
+    release = threading.Event()
+    speculation._submit(Job(release.wait))
+    reward = [0.2, -0.1, -0.1]
+    speculation.speculate([-0.5, -0.3, -1.], reward)
+    job = speculation._speculation
+    assert speculation.act([-0.5, -0.3, -1.], reward) is None
+    release.set()
+    speculation.wait_idle()
+
+    assert speculation.late == 1
+    # The traces are those right after the reward, before the decision that was not taken
+    np.testing.assert_array_equal(agent.get_eligibility(), job.eligibility)
@@ -0,0 +1,238 @@
+"""
+In-process stand-in for the traze client (traze.bot and traze.client) to run bots without a server.
+
+The game ticks on a background thread. Every tick moves all bikes one cell, kills the bikes that crash,
+publishes a new grid and asks every living bot for its next action, like the bots see it on the server.
+
+    import traze_local
+    traze_local.install()       # before the bot imports traze
+    from SNNBot import SNNBot
+    bot = SNNBot(traze_local.World(opponents=3).games[0])
+"""
+
+import sys
+import time
+import types
+import random
+import threading
+from enum import Enum
+
+
+class Action(Enum):
+    """ Directions of a bike, in clockwise order. """
+    N = (0, 1)
+    E = (1, 0)
+    S = (0, -1)
+    W = (-1, 0)
+
+    def __init__(self, dX, dY):
+        self.dX = dX
+        self.dY = dY
+        self.index = len(self.__class__.__members__)
+
+
+class Grid(object):
+    """ Tiles of the game indexed [x][y], 0 is free, otherwise the id of the player whose trail it is. """
+
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.tiles = [[0] * height for _ in range(width)]
+        self.bikes = []
+
+    def valid(self, x, y):
+        return 0 <= x < self.width and 0 <= y < self.height and self.tiles[x][y] == 0
+
+
+class Game(object):
+    """ A game on a local grid that ticks every tick seconds while any player is joined. """
+
+    def __init__(self, name='local', width=62, height=62, tick=0.01, opponents=0):
+        self.name = name
+        self.tick = tick
+        self.grid = Grid(width, height)
+        self.games_played = 0
+        self._tiles = [[0] * height for _ in range(width)]
+        self._bikes = {}
+        self._joining = []
+        self._next_id = 1
+        self._lock = threading.RLock()
+        self._thread = None
+        self._running = False
+        self.opponents = [Opponent(self) for _ in range(opponents)]
+
+    def join(self, player):
+        """ Let the player spawn on the next tick. """
+        with self._lock:
+            if player not in self._joining and player._id not in self._bikes:
+                self._joining.append(player)
+            if self._thread is None:
+                self._running = True
+                self._thread = threading.Thread(target=self._run, name='LocalGame', daemon=True)
+                self._thread.start()
+
+    def leave(self, player):
+        with self._lock:
+            if player in self._joining:
+                self._joining.remove(player)
+            if player._id in self._bikes:
+                self._crash(player._id)
+
+    def close(self):
+        """ Stop ticking. """
+        self._running = False
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
+
+    def _run(self):
+        while self._running:
+            start = time.time()
+            self._step()
+            time.sleep(max(0., self.tick - (time.time() - start)))
+
+    def _step(self):
+        with self._lock:
+            for opponent in self.opponents:
+                if not opponent.alive and opponent not in self._joining:
+                    self.join(opponent)
+            for player in self._joining:
+                self._spawn(player)
+            self._joining = []
+
+            # Move all bikes at once, heads on the same cell crash into each other
+            heads = {}
+            for id, bike in self._bikes.items():
+                x, y = bike['currentLocation']
+                direction = bike['player']._direction
+                heads[id] = (x + direction.dX, y + direction.dY)
+            crashed = [id for id, (x, y) in heads.items()
+                       if not self._free(x, y) or list(heads.values()).count((x, y)) > 1]
+            for id, (x, y) in heads.items():
+                if id not in crashed:
+                    self._tiles[x][y] = id
+                    self._bikes[id]['currentLocation'] = [x, y]
+                    self._bikes[id]['trail'].append([x, y])
+            for id in crashed:
+                self._crash(id)
+
+            # Publish the new grid, every message is a new object
+            grid = self.grid
+            grid.tiles = [column[:] for column in self._tiles]
+            grid.bikes = [{key: value for key, value in bike.items() if key != 'player'} for bike in self._bikes.values()]
+            for bike in list(self._bikes.values()):
+                player = bike['player']
+                player._x, player._y = bike['currentLocation']
+                player.on_update(self._actions(player))
+
+    def _spawn(self, player):
+        free = [(x, y) for x in range(2, self.grid.width - 2) for y in range(2, self.grid.height - 2)
+                if self._tiles[x][y] == 0]
+        x, y = random.choice(free)
+        player._id, self._next_id = self._next_id, self._next_id + 1
+        player._x, player._y = x, y
+        player._direction = random.choice(list(Action))
+        player._alive = True
+        self._tiles[x][y] = player._id
+        self._bikes[player._id] = {'playerId': player._id, 'currentLocation': [x, y], 'trail': [[x, y]], 'player': player}
+
+    def _crash(self, id):
+        bike = self._bikes.pop(id)
+        for x, y in bike['trail']:
+            self._tiles[x][y] = 0
+        if not isinstance(bike['player'], Opponent):
+            self.games_played += 1
+        bike['player'].die()
+
+    def _free(self, x, y):
+        return 0 <= x < self.grid.width and 0 <= y < self.grid.height and self._tiles[x][y] == 0
+
+    def _actions(self, player):
+        """ The directions the player can take without crashing in the next tick. """
+        return {action for action in Action
+                if (action.dX, action.dY) != (-player._direction.dX, -player._direction.dY)
+                and self._free(player._x + action.dX, player._y + action.dY)}
+
+
+class World(object):
+    """ A world with a single local game. """
+
+    def __init__(self, *args, **kwargs):
+        self.games = [Game(*args, **kwargs)]
+
+
+class BotBase(object):
+    """ Player base class with the interface of traze.bot.BotBase. """
+
+    def __init__(self, game, name=None):
+        self.game = game
+        self.name = name
+        self._id = None
+        self._alive = False
+        self._x = None
+        self._y = None
+        self._direction = None
+
+    @property
+    def alive(self):
+        return self._alive
+
+    @property
+    def x(self):
+        return self._x
+
+    @property
+    def y(self):
+        return self._y
+
+    def join(self):
+        self.game.join(self)
+
+    def steer(self, action):
+        self._direction = action
+
+    def die(self):
+        self._alive = False
+        self.on_dead()
+
+    def destroy(self):
+        self.game.leave(self)
+
+    def on_update(self, actions):
+        next_action = self.next_action(actions)
+        if next_action:
+            self.steer(next_action)
+
+    def on_dead(self):
+        """ Called when the bike died. """
+        pass
+
+    def next_action(self, actions):
+        raise NotImplementedError()
+
+    def play(self, count=1):
+        for _ in range(count):
+            self.join()
+            while not self.alive:
+                time.sleep(0.01)
+            while self.alive:
+                time.sleep(0.5)
+        self.destroy()
+
+
+class Opponent(BotBase):
+    """ Keeps its direction as long as possible, rejoins after every crash. """
+
+    def next_action(self, actions):
+        if not actions or self._direction in actions:
+            return None
+        return random.choice(tuple(actions))
+
+
+def install():
+    """ Register this module as the traze package, so bots importing traze play locally. """
+    package = types.ModuleType('traze')
+    package.bot = package.client = sys.modules[__name__]
+    sys.modules['traze'] = package
+    sys.modules['traze.bot'] = sys.modules[__name__]
+    sys.modules['traze.client'] = sys.modules[__name__]